@@ -0,0 +1,366 @@
+"""
+Benchmarks for the binder jet image convertor
+The stacks benchmark converts synthetic stacks of several sizes, input
+formats and printer targets, timing each stage of the conversion, the
+overall layers per second and the peak memory, and writes the results as
+JSON so runs on different versions can be compared
+The encoders benchmark compares the encode time and file size of each
+output compression on a single layer
+"""
+
+
+import argparse
+import json
+import multiprocessing
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import PIL
+from PIL import Image
+from binder_jet_convertor import ImageConvertor, StackConvertor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Extension and bit depth each compression option is benchmarked with
+ENCODER_CASES = (('.tif', 'none', 1), ('.tif', 'packbits', 1), ('.tif', 'lzw', 1),
+                 ('.tif', 'group4', 1), ('.bmp', 'none', 8), ('.bmp', 'rle8', 8))
+
+# StackConvertor settings for each printer the stacks are converted for
+TARGETS = {'xaar': {'new_file_name_format': 'Layer', 'new_file_extension': '.bmp',
+                    'bit_depth': 8},
+           'meteor': {'new_file_name_format': 'Layer', 'new_file_extension': '.tif',
+                      'bit_depth': 1, 'compression': 'group4'}}
+
+DEFAULT_SIZES = ((1000, 500), (5000, 2500), (10000, 5000), (20000, 8000))
+STAGES = ('open', 'resize', 'convert', 'save')
+
+
+def make_synthetic_layer(size: tuple[int, int] = (4000, 2000), parts: int = 12,
+                         seed: int = 0) -> Image.Image:
+    """
+    Returns a greyscale layer resembling a printed slice, a few solid
+    ellipses of part cross section on an empty bed
+    Each ellipse is only drawn within its bounding box, so very large
+    layers are quick to make
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    pixels = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(parts):
+        centre_x, centre_y = rng.uniform(0, width), rng.uniform(0, height)
+        radius_x = rng.uniform(0.02, 0.1) * width
+        radius_y = rng.uniform(0.02, 0.1) * height
+        left, right = max(int(centre_x - radius_x), 0), min(int(centre_x + radius_x) + 1, width)
+        top, bottom = max(int(centre_y - radius_y), 0), min(int(centre_y + radius_y) + 1, height)
+        y, x = np.ogrid[top:bottom, left:right]
+        inside = ((x - centre_x) / radius_x) ** 2 + ((y - centre_y) / radius_y) ** 2 <= 1
+        pixels[top:bottom, left:right][inside] = 255
+    return Image.fromarray(pixels, 'L')
+
+
+def make_synthetic_stack(directory: Path, size: tuple[int, int], layers: int,
+                         extension: str = '.png', seed: int = 0) -> Path:
+    """
+    Writes a stack of synthetic layers to a folder called stack in the
+    directory, returning its path
+    Layers are seeded by their number, so the same settings always make the
+    same stack
+    """
+    stack_directory = Path(directory) / 'stack'
+    stack_directory.mkdir(parents=True, exist_ok=True)
+    for layer_number in range(1, layers + 1):
+        layer = make_synthetic_layer(size, seed=seed + layer_number)
+        layer.save(stack_directory / f'{layer_number:05d}{extension}')
+    return stack_directory
+
+
+def get_peak_rss() -> int | None:
+    """
+    Returns the peak resident memory in bytes of this process and its
+    finished child processes, or None where it cannot be measured
+    """
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def time_layer_stages(path: Path, target: dict, scale: float = 1.0,
+                      output_directory: Path = None) -> dict:
+    """
+    Converts a single layer one stage at a time, returning the seconds
+    spent opening, resizing, converting and saving it
+    The layer is saved to output_directory, or the default output folder if
+    blank
+    """
+    timings = {}
+    image_conversion = ImageConvertor(path)
+    image_conversion.set_output_directory(output_directory)
+
+    start = time.perf_counter()
+    image_conversion.open_image()
+    image_conversion.image.load()
+    timings['open'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    width, height = image_conversion.image.size
+    image_conversion.resize(max(round(width * scale), 1), max(round(height * scale), 1))
+    timings['resize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image_conversion.convert_image_depth(target.get('bit_depth'))
+    timings['convert'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image_conversion.get_new_file_name(path.stem)
+    image_conversion.get_new_file_extension(target.get('new_file_extension', path.suffix))
+    image_conversion.set_encoder_options(target.get('compression'))
+    image_conversion.save_file()
+    timings['save'] = time.perf_counter() - start
+    return timings
+
+
+def run_stack_case(size: tuple[int, int], layers: int, extension: str,
+                   target_name: str, workers: int = 1, scale: float = 1.0,
+                   seed: int = 0) -> dict:
+    """
+    Benchmarks one combination of stack size, input format and target
+    Every layer is first converted stage by stage for the stage timings,
+    then the whole stack is converted by StackConvertor for the throughput
+    Run in a fresh process so the peak memory belongs to this case alone
+    """
+    target = TARGETS[target_name]
+    with tempfile.TemporaryDirectory() as directory:
+        stack_directory = make_synthetic_stack(directory, size, layers, extension, seed)
+        layer_paths = sorted(stack_directory.iterdir())
+        # Kept apart from the stack output so only its files are measured
+        stage_directory = Path(directory) / 'stages'
+
+        stage_seconds = dict.fromkeys(STAGES, 0.0)
+        for path in layer_paths:
+            for stage, seconds in time_layer_stages(path, target, scale,
+                                                    stage_directory).items():
+                stage_seconds[stage] += seconds
+
+        x_dim = max(round(size[0] * scale), 1) if scale != 1.0 else None
+        y_dim = max(round(size[1] * scale), 1) if scale != 1.0 else None
+        stack_convertor = StackConvertor(stack_directory, x_dim=x_dim, y_dim=y_dim,
+                                         workers=workers, **target)
+        start = time.perf_counter()
+        stack_convertor.convert_image_stack()
+        stack_seconds = time.perf_counter() - start
+
+        output_bytes = sum(file.stat().st_size
+                           for file in stack_convertor.output_directory.iterdir()
+                           if file.suffix == target['new_file_extension'])
+
+    return {'width': size[0], 'height': size[1], 'layers': layers,
+            'input_format': extension, 'target': target_name, 'workers': workers,
+            'scale': scale,
+            'stage_seconds_per_layer': {stage: seconds / layers
+                                        for stage, seconds in stage_seconds.items()},
+            'stack_seconds': stack_seconds,
+            'layers_per_second': layers / stack_seconds,
+            'output_bytes': output_bytes,
+            'errors': len(stack_convertor.errors),
+            'peak_rss_bytes': get_peak_rss()}
+
+
+def get_environment() -> dict:
+    """
+    Returns the versions and machine the benchmark ran on
+    """
+    return {'python': platform.python_version(), 'pillow': PIL.__version__,
+            'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': multiprocessing.cpu_count()}
+
+
+def run_stack_suite(sizes=DEFAULT_SIZES, layer_counts=(10,), extensions=('.png',),
+                    targets=tuple(TARGETS), workers: int = 1, scale: float = 1.0,
+                    seed: int = 0, progress=None) -> dict:
+    """
+    Runs every combination of the given sizes, layer counts, input formats
+    and targets, each in a new process, returning the results with the
+    environment they were measured in
+    progress is called with the result of each case as it finishes
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in sizes:
+        for layers in layer_counts:
+            for extension in extensions:
+                for target_name in targets:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        result = executor.submit(run_stack_case, tuple(size), layers,
+                                                 extension, target_name, workers,
+                                                 scale, seed).result()
+                    results.append(result)
+                    if progress is not None:
+                        progress(result)
+    return {'environment': get_environment(), 'results': results}
+
+
+def get_case_key(result: dict) -> tuple:
+    """
+    Returns the settings that identify a benchmark case
+    """
+    return (result['width'], result['height'], result['layers'],
+            result['input_format'], result['target'], result['workers'],
+            result.get('scale', 1.0))
+
+
+def compare_results(baseline: dict, current: dict) -> list[dict]:
+    """
+    Matches the cases in two sets of results, returning the change in
+    layers per second and peak memory of each case found in both
+    A speedup above 1 means the current version is faster
+    """
+    baseline_cases = {get_case_key(result): result for result in baseline['results']}
+    comparisons = []
+    for result in current['results']:
+        old = baseline_cases.get(get_case_key(result))
+        if old is None:
+            continue
+        peak_ratio = None
+        if old.get('peak_rss_bytes') and result.get('peak_rss_bytes'):
+            peak_ratio = result['peak_rss_bytes'] / old['peak_rss_bytes']
+        comparisons.append({'case': get_case_key(result),
+                            'speedup': result['layers_per_second'] / old['layers_per_second'],
+                            'peak_rss_ratio': peak_ratio})
+    return comparisons
+
+
+def benchmark_encoders(image: Image.Image, repeats: int = 3,
+                       rows_per_strip: int = None) -> list[dict]:
+    """
+    Encodes the image with each compression option, returning the best
+    encode time in seconds and the encoded size in bytes of each
+    """
+    if not isinstance(repeats, (int)) or repeats <= 0:
+        raise ValueError('Repeats must be a positive, non-zero integer')
+
+    with tempfile.TemporaryDirectory() as directory:
+        layer_path = Path(directory) / 'layer.png'
+        image.save(layer_path)
+        return [benchmark_encoder(layer_path, image, extension, compression,
+                                  bit_depth, repeats, rows_per_strip)
+                for extension, compression, bit_depth in ENCODER_CASES]
+
+
+def benchmark_encoder(layer_path: Path, image: Image.Image, extension: str,
+                      compression: str, bit_depth: int, repeats: int,
+                      rows_per_strip: int = None) -> dict:
+    """
+    Times encoding the image with a single compression option
+    """
+    image_conversion = ImageConvertor(layer_path)
+    image_conversion.image = image
+    image_conversion.convert_image_depth(bit_depth)
+    image_conversion.get_new_file_extension(extension)
+    image_conversion.set_encoder_options(compression, rows_per_strip)
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        encoded = image_conversion.encode_file()
+        timings.append(time.perf_counter() - start)
+
+    return {'format': image_conversion.get_image_format(),
+            'compression': compression,
+            'bit_depth': bit_depth,
+            'seconds': min(timings),
+            'bytes': len(encoded)}
+
+
+def parse_size(text: str) -> tuple[int, int]:
+    """
+    Reads a layer size written as WIDTHxHEIGHT
+    """
+    try:
+        width, height = (int(value) for value in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'Sizes are written as WIDTHxHEIGHT, not {text}') from None
+    return width, height
+
+
+def print_stack_result(result: dict):
+    """
+    Prints the throughput, stage timings and peak memory of one case
+    """
+    stages = ' '.join(f'{stage} {seconds * 1000:.0f}ms'
+                      for stage, seconds in result['stage_seconds_per_layer'].items())
+    peak = result['peak_rss_bytes']
+    peak_text = f'{peak / 2 ** 20:.0f} MiB' if peak is not None else 'n/a'
+    print(f'{result["width"]}x{result["height"]} x{result["layers"]} '
+          f'{result["input_format"]} -> {result["target"]}: '
+          f'{result["layers_per_second"]:.2f} layers/s, {stages}, peak {peak_text}')
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description='Benchmark the binder jet '
+                                     'image convertor')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stacks = commands.add_parser('stacks', help='time the conversion of '
+                                 'synthetic stacks')
+    stacks.add_argument('--sizes', nargs='+', type=parse_size,
+                        default=list(DEFAULT_SIZES), help='layer sizes as WIDTHxHEIGHT')
+    stacks.add_argument('--layers', nargs='+', type=int, default=[10])
+    stacks.add_argument('--formats', nargs='+', default=['.png'],
+                        help='input file extensions')
+    stacks.add_argument('--targets', nargs='+', choices=sorted(TARGETS),
+                        default=sorted(TARGETS))
+    stacks.add_argument('--workers', type=int, default=1)
+    stacks.add_argument('--scale', type=float, default=1.0,
+                        help='resize each layer by this factor')
+    stacks.add_argument('--seed', type=int, default=0)
+    stacks.add_argument('--output', type=Path, help='write the results as JSON')
+    stacks.add_argument('--compare', type=Path,
+                        help='JSON results of an earlier run to compare against')
+
+    encoders = commands.add_parser('encoders', help='compare the output '
+                                   'compressions on one layer')
+    encoders.add_argument('--width', type=int, default=4000)
+    encoders.add_argument('--height', type=int, default=2000)
+    encoders.add_argument('--repeats', type=int, default=3)
+    encoders.add_argument('--rows-per-strip', type=int, default=None)
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == 'encoders':
+        layer = make_synthetic_layer((arguments.width, arguments.height))
+        results = benchmark_encoders(layer, arguments.repeats, arguments.rows_per_strip)
+
+        print(f'{"format":<8}{"compression":<14}{"bits":>5}{"ms":>10}{"bytes":>14}')
+        for result in results:
+            print(f'{result["format"]:<8}{result["compression"]:<14}'
+                  f'{result["bit_depth"]:>5}{result["seconds"] * 1000:>10.1f}'
+                  f'{result["bytes"]:>14,}')
+        return
+
+    suite = run_stack_suite(arguments.sizes, arguments.layers, arguments.formats,
+                            arguments.targets, arguments.workers, arguments.scale,
+                            arguments.seed, progress=print_stack_result)
+    if arguments.output is not None:
+        arguments.output.write_text(json.dumps(suite, indent=2))
+
+    if arguments.compare is not None:
+        baseline = json.loads(arguments.compare.read_text())
+        for comparison in compare_results(baseline, suite):
+            width, height, layers, extension, target, *_ = comparison['case']
+            print(f'{width}x{height} x{layers} {extension} -> {target}: '
+                  f'{comparison["speedup"]:.2f}x speed')
+
+
+if __name__ == '__main__':
+    main()
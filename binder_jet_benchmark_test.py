@@ -0,0 +1,80 @@
+import argparse
+import numpy as np
+import pytest
+from binder_jet_benchmark import (STAGES, ENCODER_CASES, TARGETS, benchmark_encoders,
+                                  compare_results, make_synthetic_layer,
+                                  make_synthetic_stack, parse_size,
+                                  run_stack_case, run_stack_suite)
+from binder_jet_convertor import StackConvertor
+
+
+class TestSyntheticStacks:
+
+    def test_layer_size_and_mode(self):
+        layer = make_synthetic_layer((300, 120))
+        assert layer.size == (300, 120)
+        assert layer.mode == 'L'
+        assert set(np.unique(np.asarray(layer))) <= {0, 255}
+
+    def test_stack_is_reproducible(self, tmp_path):
+        first = make_synthetic_stack(tmp_path / 'first', (200, 100), 3, '.bmp')
+        second = make_synthetic_stack(tmp_path / 'second', (200, 100), 3, '.bmp')
+        assert [file.read_bytes() for file in sorted(first.iterdir())] == \
+            [file.read_bytes() for file in sorted(second.iterdir())]
+        assert len(list(first.iterdir())) == 3
+
+
+class TestStackBenchmark:
+
+    @pytest.mark.parametrize('target_name', ['xaar', 'meteor'])
+    def test_stack_case(self, target_name):
+        result = run_stack_case((200, 100), 2, '.png', target_name, scale=0.5)
+        assert set(result['stage_seconds_per_layer']) == set(STAGES)
+        assert result['layers_per_second'] > 0
+        assert result['errors'] == 0
+        assert result['output_bytes'] > 0
+
+    def test_output_bytes_of_stack_only(self, tmp_path):
+        result = run_stack_case((200, 100), 2, '.png', 'xaar', scale=0.5)
+        stack_directory = make_synthetic_stack(tmp_path, (200, 100), 2, '.png')
+        stack_convertor = StackConvertor(stack_directory, x_dim=100, y_dim=50,
+                                         **TARGETS['xaar'])
+        stack_convertor.convert_image_stack()
+        assert result['output_bytes'] == sum(
+            file.stat().st_size for file in stack_convertor.output_directory.iterdir())
+
+    def test_suite_runs_each_case_in_a_new_process(self):
+        suite = run_stack_suite(sizes=[(120, 60)], layer_counts=[1],
+                                extensions=['.png', '.bmp'], targets=['xaar'])
+        assert [result['input_format'] for result in suite['results']] == ['.png', '.bmp']
+        assert 'pillow' in suite['environment']
+
+    def test_compare_results(self):
+        result = {'width': 100, 'height': 50, 'layers': 2, 'input_format': '.png',
+                  'target': 'xaar', 'workers': 1, 'scale': 1.0,
+                  'layers_per_second': 10.0, 'peak_rss_bytes': 100}
+        faster = {**result, 'layers_per_second': 20.0, 'peak_rss_bytes': 50}
+        other_case = {**result, 'layers': 3}
+        comparisons = compare_results({'results': [result]},
+                                      {'results': [faster, other_case]})
+        assert len(comparisons) == 1
+        assert comparisons[0]['speedup'] == pytest.approx(2)
+        assert comparisons[0]['peak_rss_ratio'] == pytest.approx(0.5)
+
+    def test_parse_size(self):
+        assert parse_size('20000x8000') == (20000, 8000)
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_size('20000')
+
+
+class TestEncoderBenchmark:
+
+    def test_every_encoder_measured(self):
+        results = benchmark_encoders(make_synthetic_layer((200, 100)), repeats=1)
+        assert [(result['compression'], result['bit_depth']) for result in results] == \
+            [(compression, bit_depth) for _, compression, bit_depth in ENCODER_CASES]
+        assert all(result['bytes'] > 0 for result in results)
+
+    def test_invalid_repeats(self):
+        with pytest.raises(ValueError):
+            benchmark_encoders(make_synthetic_layer((20, 10)), repeats=0)
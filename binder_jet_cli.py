@@ -0,0 +1,339 @@
+"""
+Command line entry point for converting image stacks without a display
+Converts the stacks given on the command line, or every stack listed in a
+JSON or TOML job file, and exits with a non-zero status if any failed
+"""
+
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from binder_jet_convertor import (COPY_MODES, DITHER_METHODS, BIT_DEPTH_MODES,
+                                  COMPRESSION_OPTIONS, RESAMPLE_FILTERS,
+                                  OUTPUT_FORMATS, RESIZE_MODES, VOLUME_DTYPES,
+                                  LAYER_ERRORS, ConversionMetrics, StackConvertor,
+                                  SwathLayout)
+
+try:
+    import tomllib
+except ImportError:  # Python 3.10 and earlier
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# StackConvertor settings that can be given on the command line or in a job
+STACK_SETTINGS = ('new_file_name_format', 'new_file_extension', 'x_dim', 'y_dim',
+                  'bit_depth', 'copies', 'copy_mode', 'workers', 'dither',
+                  'threshold', 'strip_height', 'incremental', 'resume',
+                  'pipeline', 'queue_depth', 'deduplicate', 'compression',
+                  'rows_per_strip', 'resample', 'resize_mode', 'memory_budget',
+                  'volume_shape', 'volume_dtype', 'swath', 'output_path',
+                  'output_format', 'statistics_path')
+
+# Multipliers of the suffixes accepted by memory sizes, such as 512M or 8G
+SIZE_SUFFIXES = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_memory_size(text: str | int) -> int:
+    """
+    Returns the number of bytes in a memory size such as 8G, 512M or 4096
+    """
+    if isinstance(text, int):
+        return text
+    number = str(text).strip().upper().removesuffix('B')
+    suffix = number[-1:] if number[-1:] in SIZE_SUFFIXES else ''
+    try:
+        return int(float(number[:len(number) - len(suffix)]) * SIZE_SUFFIXES[suffix])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text} is not a memory size, '
+                                         'for example 8G or 512M') from None
+
+
+def parse_volume_shape(text: str) -> tuple[int, ...]:
+    """
+    Returns the shape of a raw volume given as DEPTHxHEIGHTxWIDTH, with an
+    optional xCHANNELS
+    """
+    try:
+        shape = tuple(int(length) for length in text.lower().split('x'))
+    except ValueError:
+        shape = ()
+    if len(shape) not in (3, 4):
+        raise argparse.ArgumentTypeError(f'{text} is not a volume shape, '
+                                         'for example 500x2000x3000')
+    return shape
+
+
+def parse_stagger(text: str) -> tuple[int, ...]:
+    """
+    Returns the stagger offsets of the heads given as a comma separated list
+    """
+    try:
+        return tuple(int(offset) for offset in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text} is not a list of offsets, '
+                                         'for example 0,24,0,24') from None
+
+
+def get_swath(settings: dict) -> SwathLayout:
+    """
+    Returns the swath layout described by a table of a job file
+    """
+    if isinstance(settings, SwathLayout):
+        return settings
+    try:
+        return SwathLayout(**settings)
+    except TypeError as error:
+        raise ValueError(f'Invalid swath settings: {error}') from None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Returns the parser for the command line options
+    Every option defaults to None so job file settings are only overridden
+    by options that are actually given
+    """
+    compressions = sorted({option for options in COMPRESSION_OPTIONS.values()
+                           for option in options})
+    parser = argparse.ArgumentParser(
+        prog='binder_jet_cli',
+        description='Convert image stacks for binder jet printers')
+    parser.add_argument('paths', nargs='*', type=Path,
+                        help='folders of layer images, or multi-page TIFF, .npy '
+                        'or .raw volumes, to convert')
+    parser.add_argument('--job-file', type=Path,
+                        help='JSON or TOML file listing the stacks to convert')
+    parser.add_argument('--name-format', dest='new_file_name_format',
+                        help='output name style, for example Layer or Slice')
+    parser.add_argument('--extension', dest='new_file_extension',
+                        help='output file extension, for example .bmp')
+    parser.add_argument('--x-dim', type=int, help='output width in pixels')
+    parser.add_argument('--y-dim', type=int, help='output height in pixels')
+    parser.add_argument('--resample', choices=list(RESAMPLE_FILTERS),
+                        help='resize filter, nearest suits binary masks')
+    parser.add_argument('--resize-mode', choices=RESIZE_MODES,
+                        help='stretch to the size, fit inside it, or fit and pad')
+    parser.add_argument('--bit-depth', type=int, choices=sorted(BIT_DEPTH_MODES))
+    parser.add_argument('--copies', type=int, help='copies of each layer')
+    parser.add_argument('--copy-mode', choices=COPY_MODES)
+    parser.add_argument('--workers', type=int,
+                        help='number of conversion processes or threads')
+    parser.add_argument('--memory-budget', type=parse_memory_size,
+                        help='only start layers while their estimated memory '
+                        'fits in this size, for example 8G')
+    parser.add_argument('--dither', choices=DITHER_METHODS)
+    parser.add_argument('--threshold', type=int)
+    parser.add_argument('--strip-height', type=int,
+                        help='stream layers in strips of this many rows, only '
+                             'uncompressed BMP and TIFF sources are read a strip '
+                             'at a time')
+    parser.add_argument('--incremental', action='store_true', default=None,
+                        help='only convert layers that changed')
+    parser.add_argument('--resume', action='store_true', default=None,
+                        help='skip layers an interrupted run finished')
+    parser.add_argument('--pipeline', action='store_true', default=None,
+                        help='read, convert and write on separate threads')
+    parser.add_argument('--queue-depth', type=int)
+    parser.add_argument('--deduplicate', action='store_true', default=None,
+                        help='only convert identical layers once')
+    parser.add_argument('--compression', choices=compressions)
+    parser.add_argument('--volume-shape', type=parse_volume_shape,
+                        help='DEPTHxHEIGHTxWIDTH of .raw volumes')
+    parser.add_argument('--volume-dtype', choices=VOLUME_DTYPES,
+                        help='voxel type of .raw volumes')
+    parser.add_argument('--rows-per-strip', type=int)
+    parser.add_argument('--heads', type=int,
+                        help='split each layer into a swath for each of this '
+                        'many printheads')
+    parser.add_argument('--swath-width', type=int, help='width of each swath in pixels')
+    parser.add_argument('--swath-overlap', type=int, default=0,
+                        help='pixels shared by neighbouring swaths')
+    parser.add_argument('--swath-stagger', type=parse_stagger, default=(),
+                        help='row offset of each head, for example 0,24,0,24')
+    parser.add_argument('--output', dest='output_path', type=Path,
+                        help='folder or archive to write the layers to, instead '
+                        'of output next to the stack')
+    parser.add_argument('--output-format', choices=list(OUTPUT_FORMATS),
+                        help='write the layers as files, or stream them into a '
+                        'tar or zip archive')
+    parser.add_argument('--statistics', dest='statistics_path', type=Path,
+                        help='save the ink coverage, pixel count and bounding box '
+                        'of every layer to this .csv or .json file')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep converting layers as they are written, '
+                        'one stack at a time')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between checks of the folder when watching')
+    parser.add_argument('--settle-time', type=float, default=2.0,
+                        help='seconds a file must stay unchanged before it is '
+                        'converted when watching')
+    parser.add_argument('--idle-timeout', type=float,
+                        help='stop watching once nothing has changed for this '
+                        'many seconds')
+    parser.add_argument('--stop-on-error', action='store_true',
+                        help='stop at the first stack that fails')
+    parser.add_argument('--metrics', type=Path,
+                        help='write the stage timings of every stack to this JSON file')
+    parser.add_argument('--profile-dir', type=Path,
+                        help='save a cProfile of one layer of each stack here')
+    return parser
+
+
+def load_job_file(path: Path) -> list[dict]:
+    """
+    Reads the stacks from a JSON or TOML job file
+    The file holds a list of stacks under 'stacks', each with a 'path' and
+    any StackConvertor settings, and optional 'defaults' shared by them all
+    Relative stack, output and statistics paths are taken from the folder of
+    the job file
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.toml':
+        if tomllib is None:
+            raise ValueError('TOML job files need Python 3.11 or later, or tomli')
+        with open(path, 'rb') as job_file:
+            contents = tomllib.load(job_file)
+    else:
+        with open(path) as job_file:
+            contents = json.load(job_file)
+
+    if isinstance(contents, list):
+        contents = {'stacks': contents}
+    if not isinstance(contents, dict):
+        raise TypeError(f'{path} must hold a list of stacks or a table of settings')
+    if 'stacks' not in contents:
+        raise ValueError(f'{path} must list the stacks to convert under "stacks"')
+    if not isinstance(contents['stacks'], list):
+        raise TypeError(f'"stacks" in {path} must be a list')
+
+    defaults = contents.get('defaults', {})
+    jobs = []
+    for stack in contents['stacks']:
+        if isinstance(stack, str):
+            stack = {'path': stack}
+        job = {**defaults, **stack}
+        if 'path' not in job:
+            raise ValueError(f'Every stack in {path} needs a path')
+        unknown = set(job) - set(STACK_SETTINGS) - {'path'}
+        if unknown:
+            raise ValueError(f'Unknown settings in {path}: {", ".join(sorted(unknown))}')
+        job['path'] = path.parent / job['path']
+        for setting in ('output_path', 'statistics_path'):
+            if setting in job:
+                job[setting] = path.parent / job[setting]
+        if 'memory_budget' in job:
+            try:
+                job['memory_budget'] = parse_memory_size(job['memory_budget'])
+            except argparse.ArgumentTypeError as error:
+                raise ValueError(f'{path}: {error}') from None
+        if 'swath' in job:
+            job['swath'] = get_swath(job['swath'])
+        jobs.append(job)
+    return jobs
+
+
+def get_jobs(arguments: argparse.Namespace) -> list[dict]:
+    """
+    Returns the settings of every stack to convert, with the command line
+    options taking priority over the job file
+    """
+    jobs = [{'path': path} for path in arguments.paths]
+    if arguments.job_file is not None:
+        jobs.extend(load_job_file(arguments.job_file))
+
+    overrides = {setting: getattr(arguments, setting) for setting in STACK_SETTINGS
+                 if getattr(arguments, setting, None) is not None}
+    if arguments.heads is not None or arguments.swath_width is not None:
+        overrides['swath'] = SwathLayout(arguments.heads, arguments.swath_width,
+                                         arguments.swath_overlap, arguments.swath_stagger)
+    return [{**job, **overrides} for job in jobs]
+
+
+def run_job(job: dict, metrics: ConversionMetrics = None,
+            watch_settings: dict = None) -> StackConvertor:
+    """
+    Converts a single stack, returning the StackConvertor that ran it
+    With watch_settings, the folder is watched and converted as layers are
+    written, see StackConvertor.watch
+    """
+    settings = {setting: value for setting, value in job.items() if setting != 'path'}
+    stack_convertor = StackConvertor(job['path'], metrics=metrics, **settings)
+    if watch_settings is not None:
+        stack_convertor.watch(**watch_settings)
+    else:
+        stack_convertor.convert_image_stack()
+    return stack_convertor
+
+
+def main(argv: list[str] = None) -> int:
+    """
+    Converts each stack in turn, printing how long each took
+    Returns 0 if every stack converted, or 1 if any failed
+    """
+    parser = build_parser()
+    arguments = parser.parse_args(argv)
+    try:
+        jobs = get_jobs(arguments)
+    except (OSError, ValueError, TypeError) as error:
+        parser.error(str(error))
+    if not jobs:
+        parser.error('give at least one stack folder or a job file')
+
+    if arguments.profile_dir is not None:
+        arguments.profile_dir.mkdir(parents=True, exist_ok=True)
+
+    watch_settings = None
+    if arguments.watch:
+        watch_settings = {'poll_interval': arguments.poll_interval,
+                          'settle_time': arguments.settle_time,
+                          'idle_timeout': arguments.idle_timeout}
+
+    failures = 0
+    stack_metrics = {}
+    total_start = time.perf_counter()
+    for job_number, job in enumerate(jobs, 1):
+        metrics = None
+        if arguments.metrics is not None or arguments.profile_dir is not None:
+            metrics = ConversionMetrics()
+            stack_metrics[str(job['path'])] = metrics
+            if arguments.profile_dir is not None:
+                metrics.profile_path = (arguments.profile_dir /
+                                        f'{job_number:03d}_{Path(job["path"]).name}.prof')
+        start = time.perf_counter()
+        try:
+            stack_convertor = run_job(job, metrics, watch_settings)
+        except (*LAYER_ERRORS, TypeError) as error:
+            failures += 1
+            print(f'{job["path"]}: failed after {time.perf_counter() - start:.2f}s: '
+                  f'{error}', file=sys.stderr)
+            if arguments.stop_on_error:
+                break
+            continue
+
+        seconds = time.perf_counter() - start
+        layers = len(stack_convertor.stack_index)
+        rate = layers / seconds if seconds else 0
+        print(f'{job["path"]}: {layers} layers in {seconds:.2f}s '
+              f'({rate:.1f} layers/s)')
+        if stack_convertor.errors:
+            failures += 1
+            for layer_number, error in sorted(stack_convertor.errors.items()):
+                print(f'{job["path"]}: layer {layer_number} failed: {error}',
+                      file=sys.stderr)
+            if arguments.stop_on_error:
+                break
+
+    print(f'{len(jobs) - failures} of {len(jobs)} stacks converted in '
+          f'{time.perf_counter() - total_start:.2f}s')
+    if arguments.metrics is not None:
+        arguments.metrics.write_text(json.dumps(
+            {path: metrics.get_summary() for path, metrics in stack_metrics.items()},
+            indent=2))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import zipfile
+import numpy as np
+import pytest
+from pathlib import Path
+from PIL import Image
+from binder_jet_cli import (get_jobs, build_parser, load_job_file, main, tomllib,
+                            parse_memory_size, parse_volume_shape)
+from binder_jet_convertor import SwathLayout
+
+TEST_SINGLE_IMAGE_DIR = Path('test_image_single_directory')
+
+
+def make_stack(tmp_path, name, layers=2):
+    """
+    Copies the test png into a new stack directory with the given number
+    of layers
+    """
+    stack_directory = tmp_path / name / 'stack'
+    stack_directory.mkdir(parents=True)
+    for layer in range(layers):
+        shutil.copyfile(TEST_SINGLE_IMAGE_DIR / 'test_image.png',
+                        stack_directory / f'{layer}.png')
+    return stack_directory
+
+
+class TestCommandLine:
+
+    def test_cli_does_not_import_qt(self):
+        subprocess.run([sys.executable, '-c', 'import sys, binder_jet_cli; '
+                        'assert "PyQt6" not in sys.modules'], check=True)
+
+    def test_convert_stack(self, tmp_path, capsys):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(stack_directory), '--name-format', 'Layer',
+                     '--extension', '.bmp', '--bit-depth', '8']) == 0
+        output_directory = tmp_path / 'part' / 'output'
+        assert sorted(file.name for file in output_directory.glob('*.bmp')) == \
+            ['Layer_00001.bmp', 'Layer_00002.bmp']
+        with Image.open(output_directory / 'Layer_00001.bmp') as image:
+            assert image.mode == 'L'
+        assert '2 layers in' in capsys.readouterr().out
+
+    def test_failed_stack_exits_non_zero(self, tmp_path, capsys):
+        assert main([str(tmp_path / 'missing')]) == 1
+        assert 'failed' in capsys.readouterr().err
+
+    def test_failed_stack_does_not_stop_others(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(tmp_path / 'missing'), str(stack_directory)]) == 1
+        assert (tmp_path / 'part' / 'output').is_dir()
+
+    def test_stop_on_error(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(tmp_path / 'missing'), str(stack_directory),
+                     '--stop-on-error']) == 1
+        assert not (tmp_path / 'part' / 'output').exists()
+
+    def test_no_stacks_is_usage_error(self):
+        with pytest.raises(SystemExit) as exit_info:
+            main([])
+        assert exit_info.value.code == 2
+
+    def test_metrics_and_profile(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(stack_directory), '--metrics', str(tmp_path / 'metrics.json'),
+                     '--profile-dir', str(tmp_path / 'profiles')]) == 0
+        metrics = json.loads((tmp_path / 'metrics.json').read_text())
+        assert metrics[str(stack_directory)]['layers'] == 2
+        assert len(list((tmp_path / 'profiles').glob('*.prof'))) == 1
+
+    def test_watch_until_idle(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(stack_directory), '--watch', '--poll-interval', '0.02',
+                     '--settle-time', '0.05', '--idle-timeout', '0.1']) == 0
+        assert len(list((tmp_path / 'part' / 'output').glob('*.png'))) == 2
+
+    def test_memory_budget(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part', layers=3)
+        assert main([str(stack_directory), '--workers', '2',
+                     '--memory-budget', '512M']) == 0
+        assert len(list((tmp_path / 'part' / 'output').glob('*.png'))) == 3
+
+    @pytest.mark.parametrize('text, size', [('4096', 4096), ('512M', 512 * 2**20),
+                                            ('8G', 8 * 2**30), ('1.5GB', 3 * 2**29),
+                                            ('64k', 64 * 2**10)])
+    def test_parse_memory_size(self, text, size):
+        assert parse_memory_size(text) == size
+
+    def test_invalid_memory_size(self):
+        with pytest.raises(SystemExit):
+            build_parser().parse_args(['--memory-budget', 'lots'])
+
+    def test_raw_volume(self, tmp_path):
+        np.zeros((3, 20, 30), dtype=np.uint8).tofile(tmp_path / 'part.raw')
+        assert main([str(tmp_path / 'part.raw'), '--extension', '.bmp',
+                     '--volume-shape', '3x20x30']) == 0
+        assert len(list((tmp_path / 'output').glob('*.bmp'))) == 3
+
+    def test_parse_volume_shape(self):
+        assert parse_volume_shape('500x2000x3000') == (500, 2000, 3000)
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_volume_shape('2000x3000')
+
+    def test_swaths(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(stack_directory), '--x-dim', '76', '--y-dim', '30',
+                     '--heads', '2', '--swath-width', '40', '--swath-overlap', '4',
+                     '--swath-stagger', '0,8']) == 0
+        for head in ('head_01', 'head_02'):
+            assert len(list((tmp_path / 'part' / 'output' / head).glob('*.png'))) == 2
+
+    def test_swath_needs_heads(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        with pytest.raises(SystemExit):
+            main([str(stack_directory), '--swath-width', '40'])
+
+    def test_zip_output(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(stack_directory), '--name-format', 'Layer', '--output-format',
+                     'zip', '--output', str(tmp_path / 'transfer.zip')]) == 0
+        with zipfile.ZipFile(tmp_path / 'transfer.zip') as archive:
+            assert archive.namelist() == ['Layer_00001.png', 'Layer_00002.png']
+
+    def test_statistics(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(stack_directory), '--bit-depth', '1',
+                     '--statistics', str(tmp_path / 'ink.json')]) == 0
+        statistics = json.loads((tmp_path / 'ink.json').read_text())
+        assert [row['layer'] for row in statistics['layers']] == [1, 2]
+
+    def test_invalid_setting_fails(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 'part')
+        assert main([str(stack_directory), '--workers', '0']) == 1
+
+
+class TestJobFile:
+
+    def test_json_job_file(self, tmp_path):
+        first = make_stack(tmp_path, 'first')
+        second = make_stack(tmp_path, 'second', layers=1)
+        job_path = tmp_path / 'jobs.json'
+        job_path.write_text(json.dumps({
+            'defaults': {'new_file_name_format': 'Slice', 'new_file_extension': '.bmp'},
+            'stacks': [{'path': 'first/stack', 'copies': 2},
+                       'second/stack']}))
+
+        assert main(['--job-file', str(job_path)]) == 0
+        assert len(list((first.parent / 'output').glob('*.bmp'))) == 4
+        assert len(list((second.parent / 'output').glob('*.bmp'))) == 1
+
+    def test_toml_job_file(self, tmp_path):
+        if tomllib is None:
+            pytest.skip('needs tomllib or tomli')
+        job_path = tmp_path / 'jobs.toml'
+        job_path.write_text('[defaults]\nbit_depth = 1\n\n'
+                            '[[stacks]]\npath = "part/stack"\nworkers = 2\n')
+        assert load_job_file(job_path) == [{'path': tmp_path / 'part' / 'stack',
+                                            'bit_depth': 1, 'workers': 2}]
+
+    def test_command_line_overrides_job_file(self, tmp_path):
+        job_path = tmp_path / 'jobs.json'
+        job_path.write_text(json.dumps([{'path': 'stack', 'copies': 2,
+                                         'bit_depth': 8}]))
+        arguments = build_parser().parse_args(['--job-file', str(job_path),
+                                               '--copies', '3'])
+        assert get_jobs(arguments) == [{'path': tmp_path / 'stack', 'copies': 3,
+                                        'bit_depth': 8}]
+
+    def test_memory_budget_in_job_file(self, tmp_path):
+        job_path = tmp_path / 'jobs.json'
+        job_path.write_text(json.dumps({'defaults': {'memory_budget': '2G'},
+                                        'stacks': ['stack']}))
+        assert load_job_file(job_path)[0]['memory_budget'] == 2 * 2**30
+
+    def test_swath_in_job_file(self, tmp_path):
+        job_path = tmp_path / 'jobs.json'
+        job_path.write_text(json.dumps({'stacks': [{
+            'path': 'stack', 'swath': {'heads': 2, 'swath_width': 500,
+                                       'stagger': [0, 12]}}]}))
+        assert load_job_file(job_path)[0]['swath'] == SwathLayout(2, 500, stagger=(0, 12))
+
+    def test_output_path_relative_to_job_file(self, tmp_path):
+        job_path = tmp_path / 'jobs.json'
+        job_path.write_text(json.dumps({'stacks': [{
+            'path': 'stack', 'output_path': 'transfer/part.tar', 'output_format': 'tar'}]}))
+        assert load_job_file(job_path)[0]['output_path'] == tmp_path / 'transfer' / 'part.tar'
+
+    @pytest.mark.parametrize('contents', [{'stacks': [{'copies': 2}]},
+                                          {'stacks': [{'path': 'a', 'colour': 'red'}]},
+                                          {'stacks': [{'path': 'a',
+                                                       'memory_budget': 'lots'}]},
+                                          {'stacks': [{'path': 'a',
+                                                       'swath': {'heads': 2}}]},
+                                          {'jobs': []}])
+    def test_invalid_job_file(self, tmp_path, contents):
+        job_path = tmp_path / 'jobs.json'
+        job_path.write_text(json.dumps(contents))
+        with pytest.raises(ValueError):
+            load_job_file(job_path)
+
+    @pytest.mark.parametrize('contents', ['stack', {'stacks': 'stack'}])
+    def test_job_file_of_wrong_type(self, tmp_path, contents):
+        job_path = tmp_path / 'jobs.json'
+        job_path.write_text(json.dumps(contents))
+        with pytest.raises(TypeError):
+            load_job_file(job_path)
@@ -4,9 +4,682 @@ Binder Jet image convertor functions
 """
 
 
+import cProfile
+import csv
+import hashlib
+import io
+import json
+import os
+import queue
+import re
+import shutil
+import struct
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed, wait)
+from collections import Counter, deque
+from contextlib import ExitStack, contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
 from pathlib import Path
+
+import numpy as np
 from PIL import Image
 
+# File types that are treated as layers of a stack
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.tif', '.tiff', '.jpg', '.jpeg')
+
+# Single files that hold a whole stack, as the pages of a TIFF or the Z
+# slices of a NumPy or raw voxel volume
+VOLUME_EXTENSIONS = ('.tif', '.tiff', '.npy', '.raw')
+
+# Voxel types of NumPy and raw volumes that can be converted
+VOLUME_DTYPES = ('uint8', 'bool')
+
+# File type of bed files, which place several part stacks on one build bed
+BED_EXTENSION = '.json'
+
+# Bits per pixel of the image modes that can be converted
+MODE_BITS = {'1': 1, 'L': 8, 'P': 8, 'LA': 16, 'RGB': 24, 'RGBA': 32}
+
+# Ways of producing the extra copies of a layer once the first has been saved
+COPY_MODES = ('copy', 'hardlink', 'reflink')
+
+# Where the outputs of a stack are written, a folder of files or a single
+# archive, with the file extension of each archive
+OUTPUT_FORMATS = {'directory': '', 'tar': '.tar', 'zip': '.zip', 'zip-deflate': '.zip'}
+
+# Image modes for each output bit depth
+BIT_DEPTH_MODES = {1: '1', 8: 'L', 24: 'RGB', 32: 'RGBA'}
+
+# Bits per sample and photometric interpretation of the modes the strip
+# TIFF writer supports
+TIFF_STRIP_MODES = {'1': ((1,), 1), 'L': ((8,), 1), 'RGB': ((8, 8, 8), 2),
+                    'RGBA': ((8, 8, 8, 8), 2)}
+
+# Output compression for each file format, and the Pillow TIFF compression
+# each name corresponds to
+COMPRESSION_OPTIONS = {'TIFF': ('none', 'packbits', 'lzw', 'group4'),
+                       'BMP': ('none', 'rle8')}
+TIFF_COMPRESSION = {'none': 'raw', 'packbits': 'packbits', 'lzw': 'tiff_lzw',
+                    'group4': 'group4'}
+
+# TIFF tags that change how the stored strips of a page decode: bits and
+# samples per pixel, compression, photometric interpretation, fill order,
+# rows per strip, planar configuration, predictor, colour map, tile size,
+# extra samples, sample format, JPEG tables and YCbCr subsampling
+TIFF_DECODE_TAGS = (258, 259, 262, 266, 277, 278, 284, 317, 320, 322, 323, 338,
+                    339, 347, 530)
+
+# Bytes Pillow uses to hold each pixel of an image in memory, where it
+# differs from 4
+PIXEL_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2}
+
+# Memory used converting a layer on top of its pixel data, for decoder
+# buffers and other allocations
+LAYER_MEMORY_OVERHEAD = 16 * 2 ** 20
+
+# Errors a single layer can fail with while it is read, converted or saved,
+# recorded against the layer so the rest of the stack is still converted
+LAYER_ERRORS = (OSError, EOFError, SyntaxError, ValueError, MemoryError,
+                Image.DecompressionBombError)
+
+# Layers per worker process that can be converted ahead of the next layer
+# written to an archive, bounding the encoded layers held until their turn
+ARCHIVE_LAYERS_PER_WORKER = 2
+
+# Resampling filters that can be used to resize, by name
+RESAMPLE_FILTERS = {'nearest': Image.Resampling.NEAREST, 'box': Image.Resampling.BOX,
+                    'bilinear': Image.Resampling.BILINEAR,
+                    'hamming': Image.Resampling.HAMMING,
+                    'bicubic': Image.Resampling.BICUBIC,
+                    'lanczos': Image.Resampling.LANCZOS}
+
+# How the image is fitted to the requested size: stretched to it, scaled to
+# fit inside it keeping the aspect ratio, or fitted and padded out to it
+RESIZE_MODES = ('stretch', 'fit', 'pad')
+
+# Smallest ratio between the reduced and final size when an image is first
+# shrunk by a whole number factor before resampling
+REDUCING_GAP = 2.0
+
+# Ways of converting an image to 1 bit, error diffusion is Pillow's
+# Floyd-Steinberg dither and the others are vectorised thresholds
+DITHER_METHODS = ('error-diffusion', 'threshold', 'bayer', 'blue-noise')
+
+# Folder in the output folder for the swaths of each printhead, by head
+# number from 1
+HEAD_DIRECTORY_FORMAT = 'head_{:02d}'
+
+# File types the per-layer ink statistics can be saved as
+STATISTICS_EXTENSIONS = ('.csv', '.json')
+
+# Columns of the ink statistics of each layer
+STATISTICS_FIELDS = ('layer', 'source', 'width', 'height', 'ink_pixels', 'coverage',
+                     'ink_fraction', 'left', 'top', 'right', 'bottom')
+
+# File in the output folder recording what each output was made from
+MANIFEST_NAME = '.binder_jet_manifest.json'
+
+# Append only record of the layers finished by the current conversion, kept
+# until the conversion completes so an interrupted one can be resumed
+JOURNAL_NAME = '.binder_jet_journal'
+
+# Linux ioctl request number for cloning a file's extents (FICLONE)
+FICLONE = 0x40049409
+
+
+@contextmanager
+def atomic_write_path(path: Path):
+    """
+    Yields a temporary path next to path to write the file to
+    Once the block finishes the file is flushed to disk and renamed over
+    path in a single step, so a partly written file is never left under the
+    final name
+    The temporary name is random, so writers on other machines sharing the
+    folder never write to the same temporary file
+    """
+    temporary_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        yield temporary_path
+        with open(temporary_path, 'rb+') as temporary_file:
+            os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+
+def write_output_file(path: Path, data: bytes):
+    """
+    Writes already encoded file data to path in a single atomic step
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write_path(path) as temporary_path:
+        temporary_path.write_bytes(data)
+
+
+def _hardlink(source: Path, destination: Path) -> bool:
+    """
+    Attempts to hard link destination to source
+    Returns False if the filesystem does not support it
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        return False
+    return True
+
+
+def _reflink(source: Path, destination: Path) -> bool:
+    """
+    Attempts a copy-on-write clone of source to destination
+    Returns False if the platform or filesystem does not support it
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def copy_output_file(source: Path, destination: Path, copy_mode: str = 'copy'):
+    """
+    Creates a copy of an already encoded output file
+    'copy' writes the encoded bytes again, 'hardlink' and 'reflink' share the
+    data on filesystems that support it, and fall back to a byte copy otherwise
+    """
+    if copy_mode not in COPY_MODES:
+        raise ValueError(f'Copy mode must be one of {COPY_MODES}')
+
+    with atomic_write_path(destination) as temporary_path:
+        if copy_mode == 'hardlink' and _hardlink(source, temporary_path):
+            return
+        if copy_mode == 'reflink' and _reflink(source, temporary_path):
+            return
+        shutil.copyfile(source, temporary_path)
+
+
+@lru_cache
+def bayer_matrix(order: int = 8) -> np.ndarray:
+    """
+    Returns the ordered dither threshold matrix of the given size, which
+    must be a power of two, scaled to 8-bit grey levels
+    """
+    if order < 2 or order & (order - 1):
+        raise ValueError('Bayer matrix order must be a power of two')
+
+    matrix = np.zeros((1, 1), dtype=np.int64)
+    while matrix.shape[0] < order:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2],
+                           [4 * matrix + 3, 4 * matrix + 1]])
+    return _rank_thresholds(matrix)
+
+
+@lru_cache
+def blue_noise_mask(size: int = 64, seed: int = 0) -> np.ndarray:
+    """
+    Returns a tileable blue noise threshold mask scaled to 8-bit grey levels
+    White noise is high-pass filtered in the frequency domain, then ranked
+    so every threshold level is used equally often
+    """
+    noise = np.random.default_rng(seed).random((size, size))
+    frequencies = np.fft.fftfreq(size)
+    radius = np.hypot(frequencies[:, None], frequencies[None, :])
+    filtered = np.real(np.fft.ifft2(np.fft.fft2(noise) * radius))
+    ranks = filtered.argsort(axis=None).argsort().reshape(size, size)
+    return _rank_thresholds(ranks)
+
+
+def _rank_thresholds(ranks: np.ndarray) -> np.ndarray:
+    """
+    Converts a matrix of ranks 0 to n-1 into evenly spaced uint8 thresholds,
+    where a grey level greater than the threshold prints white
+    """
+    levels = (ranks + 0.5) * 255 / ranks.size
+    return np.floor(levels).astype(np.uint8)
+
+
+def binarise(image: Image.Image, method: str = 'error-diffusion',
+             threshold: int = 128, y_offset: int = 0) -> Image.Image:
+    """
+    Converts an image to 1 bit using the given dither method
+    The threshold method is a single lookup table pass, the bayer and
+    blue-noise methods compare each pixel against a tiled mask in one NumPy
+    operation and pack the result straight into a 1 bit image
+    y_offset is the row of the full image the first row belongs to, so the
+    dither pattern lines up when an image is processed in strips
+    """
+    if method not in DITHER_METHODS:
+        raise ValueError(f'Dither method must be one of {DITHER_METHODS}')
+
+    if method == 'error-diffusion':
+        return image.convert('1')
+
+    grey = image.convert('L')
+
+    if method == 'threshold':
+        lookup_table = [255 if level >= threshold else 0 for level in range(256)]
+        return grey.point(lookup_table, '1')
+
+    grey = np.asarray(grey)
+    height, width = grey.shape
+    mask = bayer_matrix() if method == 'bayer' else blue_noise_mask()
+    mask = np.roll(mask, -y_offset, axis=0)
+    repeats = (-(-height // mask.shape[0]), -(-width // mask.shape[1]))
+    white = grey > np.tile(mask, repeats)[:height, :width]
+
+    packed = np.packbits(white, axis=1)
+    return Image.frombuffer('1', (width, height), packed, 'raw', '1', 0, 1)
+
+
+def encode_bmp_rle8(image: Image.Image) -> bytes:
+    """
+    Encodes an 8 bit greyscale or palette image as a run length encoded BMP
+    The runs are found for the whole image at once with NumPy, and stored
+    as encoded runs of up to 255 pixels
+    Images whose runs would take more space than the pixels themselves,
+    such as noisy or dithered layers, are stored uncompressed instead
+    """
+    if image.mode not in ('L', 'P'):
+        raise ValueError('RLE8 BMP files can only store 8 bit images')
+
+    # BMP rows are stored bottom up
+    pixels = np.asarray(image)[::-1]
+    height, width = pixels.shape
+    run_starts_mask = np.ones((height, width), dtype=bool)
+    run_starts_mask[:, 1:] = pixels[:, 1:] != pixels[:, :-1]
+    run_starts = np.flatnonzero(run_starts_mask)
+    run_lengths = np.diff(np.append(run_starts, height * width))
+
+    # Split runs longer than 255 pixels into pieces
+    pieces = (run_lengths + 254) // 255
+    piece_run = np.repeat(np.arange(run_starts.size), pieces)
+    piece_number = np.arange(piece_run.size) - np.repeat(np.cumsum(pieces) - pieces,
+                                                         pieces)
+    piece_lengths = np.minimum(255, run_lengths[piece_run] - piece_number * 255)
+    piece_rows = run_starts[piece_run] // width
+
+    # Each row is followed by an end of line marker, shifting later pieces
+    tokens = np.zeros((piece_run.size + height, 2), dtype=np.uint8)
+    piece_slots = np.arange(piece_run.size) + piece_rows
+    tokens[piece_slots, 0] = piece_lengths
+    tokens[piece_slots, 1] = pixels.ravel()[run_starts[piece_run]]
+    pixel_data = tokens.tobytes() + b'\x00\x01'
+    compression = 1
+    row_bytes = (width + 3) & ~3
+    if len(pixel_data) > row_bytes * height:
+        padded = np.zeros((height, row_bytes), dtype=np.uint8)
+        padded[:, :width] = pixels
+        pixel_data = padded.tobytes()
+        compression = 0
+
+    if image.mode == 'P':
+        palette = np.array(image.getpalette('RGB'), dtype=np.uint8)
+        palette = np.resize(palette, 768).reshape(256, 3)
+    else:
+        palette = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1)
+    # Palette entries are stored as blue, green, red, reserved
+    colour_table = np.zeros((256, 4), dtype=np.uint8)
+    colour_table[:, :3] = palette[:, ::-1]
+
+    pixel_offset = 14 + 40 + colour_table.nbytes
+    file_header = struct.pack('<2sIHHI', b'BM', pixel_offset + len(pixel_data),
+                              0, 0, pixel_offset)
+    info_header = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 8, compression,
+                              len(pixel_data), 0, 0, 256, 0)
+    return file_header + info_header + colour_table.tobytes() + pixel_data
+
+
+class StripTiffWriter:
+    """
+    Writes an uncompressed baseline TIFF one horizontal strip at a time, so
+    the whole image never has to be held in memory
+    The strips are written first and the directory describing them is added
+    when the writer is closed
+    The writer does not own the file, which must be open for binary
+    writing at its start
+    """
+
+    def __init__(self, file, size: tuple[int, int], mode: str,
+                 rows_per_strip: int):
+        if mode not in TIFF_STRIP_MODES:
+            raise ValueError(f'Strip TIFF mode must be one of {tuple(TIFF_STRIP_MODES)}')
+
+        self.size = size
+        self.mode = mode
+        self.rows_per_strip = rows_per_strip
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.file = file
+        # Little endian header, the directory offset is filled in on close
+        self.file.write(b'II*\x00\x00\x00\x00\x00')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write_strip(self, strip: Image.Image):
+        """
+        Appends the rows of strip to the image
+        """
+        if strip.mode != self.mode or strip.width != self.size[0]:
+            raise ValueError('Strip does not match the mode and width of the image')
+
+        data = strip.tobytes()
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        """
+        Writes the image file directory, finishing the image
+        """
+        if self.file.tell() % 2:
+            self.file.write(b'\x00')
+        directory_offset = self.file.tell()
+
+        bits_per_sample, photometric = TIFF_STRIP_MODES[self.mode]
+        short, long = 3, 4
+        entries = [(256, long, [self.size[0]]),
+                   (257, long, [self.size[1]]),
+                   (258, short, list(bits_per_sample)),
+                   (259, short, [1]),
+                   (262, short, [photometric]),
+                   (273, long, self.strip_offsets),
+                   (277, short, [len(bits_per_sample)]),
+                   (278, long, [self.rows_per_strip]),
+                   (279, long, self.strip_byte_counts),
+                   (284, short, [1])]
+        if self.mode == 'RGBA':
+            entries.append((338, short, [2]))
+
+        # Values longer than four bytes are stored after the directory
+        external_offset = directory_offset + 2 + 12 * len(entries) + 4
+        directory = struct.pack('<H', len(entries))
+        external = b''
+        for tag, field_type, values in entries:
+            data = struct.pack(f'<{len(values)}{"H" if field_type == short else "I"}',
+                               *values)
+            if len(data) <= 4:
+                value = data.ljust(4, b'\x00')
+            else:
+                value = struct.pack('<I', external_offset + len(external))
+                external += data
+            directory += struct.pack('<HHI', tag, field_type, len(values)) + value
+        directory += b'\x00\x00\x00\x00'
+
+        self.file.write(directory + external)
+        self.file.seek(4)
+        self.file.write(struct.pack('<I', directory_offset))
+
+
+def _raw_row_layout(image: Image.Image) -> list | None:
+    """
+    Returns where the rows of an opened image are stored, as a list of
+    (top, bottom, offset, raw mode, stride, row direction) for each strip
+    Returns None if the pixel data is compressed or laid out in any other way
+    """
+    width = image.width
+    if not getattr(image, 'filename', None) or image.mode not in MODE_BITS:
+        return None
+
+    layout = []
+    previous_bottom = 0
+    for tile in image.tile:
+        codec, extents, offset, args = tile[0], tile[1], tile[2], tile[3]
+        if isinstance(args, str):
+            args = (args,)
+        if codec != 'raw' or extents[0] != 0 or extents[2] != width \
+                or extents[1] < previous_bottom:
+            return None
+
+        raw_mode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        row_direction = args[2] if len(args) > 2 else 1
+        if not stride:
+            if raw_mode != image.mode:
+                return None
+            stride = (width * MODE_BITS[image.mode] + 7) // 8
+
+        layout.append((extents[1], extents[3], offset, raw_mode, stride,
+                       row_direction))
+        previous_bottom = extents[3]
+
+    return layout or None
+
+
+def iter_image_bands(image: Image.Image, band_height: int):
+    """
+    Yields (top row, band) pairs that cover an opened image from top to bottom
+    Uncompressed BMP and TIFF files are read from the file one band at a
+    time, other formats are decoded in full and then cut into bands
+    """
+    width, height = image.size
+    layout = _raw_row_layout(image)
+
+    if layout is None:
+        image.load()
+        for top in range(0, height, band_height):
+            yield top, image.crop((0, top, width, min(top + band_height, height)))
+        return
+
+    with open(image.filename, 'rb') as file:
+        for top in range(0, height, band_height):
+            bottom = min(top + band_height, height)
+            band = Image.new(image.mode, (width, bottom - top))
+            for strip_top, strip_bottom, offset, raw_mode, stride, row_direction in layout:
+                first_row = max(top, strip_top)
+                last_row = min(bottom, strip_bottom)
+                if first_row >= last_row:
+                    continue
+                # Bottom up files store the last row of the strip first
+                if row_direction < 0:
+                    file.seek(offset + (strip_bottom - last_row) * stride)
+                else:
+                    file.seek(offset + (first_row - strip_top) * stride)
+                rows = last_row - first_row
+                part = Image.frombytes(image.mode, (width, rows),
+                                       file.read(rows * stride), 'raw',
+                                       raw_mode, stride, row_direction)
+                band.paste(part, (0, first_row - top))
+            if image.mode == 'P':
+                band.putpalette(image.palette.tobytes(), image.palette.mode)
+            yield top, band
+
+
+def get_resized_size(size: tuple[int, int], x_dim: int = None, y_dim: int = None,
+                     resize_mode: str = 'stretch') -> tuple[tuple, tuple]:
+    """
+    Returns the size the image content is scaled to and the size of the
+    finished image
+    When stretching, a missing dimension keeps its current size, when
+    fitting or padding it follows the aspect ratio, and with neither
+    dimension the size is unchanged
+    """
+    width, height = size
+    if resize_mode == 'stretch' or (not x_dim and not y_dim):
+        # With neither dimension there is nothing to fit to
+        new_size = (x_dim or width, y_dim or height)
+        return new_size, new_size
+
+    scale = min(x_dim / width if x_dim else float('inf'),
+                y_dim / height if y_dim else float('inf'))
+    content_size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    if resize_mode == 'pad':
+        return content_size, (x_dim or content_size[0], y_dim or content_size[1])
+    return content_size, content_size
+
+
+def _scale_factors(size: int, new_size: int) -> tuple[int, int]:
+    """
+    Returns the whole number (reduce, enlarge) factors that take size to
+    new_size
+    """
+    if new_size <= size and size % new_size == 0:
+        return size // new_size, 1
+    if new_size > size and new_size % size == 0:
+        return 1, new_size // size
+    raise ValueError('Strip conversion only supports whole number scale factors')
+
+
+@dataclass(frozen=True)
+class SwathLayout:
+    """
+    How a layer is divided between printheads side by side across its width
+    Each head prints a swath of swath_width pixels, starting overlap pixels
+    before the end of the previous head's swath
+    stagger gives the offset in rows of each head along the print
+    direction, every swath is padded at the top by its head's offset and at
+    the bottom to the largest offset, so they all have the same height
+    """
+    heads: int
+    swath_width: int
+    overlap: int = 0
+    stagger: tuple = ()
+
+    def __post_init__(self):
+        if not isinstance(self.heads, (int)) or self.heads <= 0:
+            raise ValueError('Heads must be a positive, non-zero integer')
+
+        if not isinstance(self.swath_width, (int)) or self.swath_width <= 0:
+            raise ValueError('Swath width must be a positive, non-zero integer')
+
+        if not isinstance(self.overlap, (int)) or not 0 <= self.overlap < self.swath_width:
+            raise ValueError('Overlap must be a positive integer less than the swath width')
+
+        # Job files give the offsets as a list
+        object.__setattr__(self, 'stagger', tuple(self.stagger))
+        if self.stagger and len(self.stagger) != self.heads:
+            raise ValueError('Stagger must give one offset for each head')
+
+        if not all(isinstance(offset, (int)) and offset >= 0 for offset in self.stagger):
+            raise ValueError('Stagger offsets must be positive integers')
+
+    def get_head_offset(self, head: int) -> tuple[int, int]:
+        """
+        Returns the column of the layer the swath of a head starts at, and
+        its row offset, counting heads from 0
+        """
+        row_offset = self.stagger[head] if self.stagger else 0
+        return head * (self.swath_width - self.overlap), row_offset
+
+    def get_swath_size(self, layer_height: int) -> tuple[int, int]:
+        """
+        Returns the size of every swath of a layer of the given height
+        """
+        return self.swath_width, layer_height + max(self.stagger, default=0)
+
+    def get_covered_width(self) -> int:
+        """
+        Returns the width of layer the heads print between them
+        """
+        return self.heads * (self.swath_width - self.overlap) + self.overlap
+
+
+def split_swaths(image: Image.Image, swath: SwathLayout,
+                 pad_colour: int = 0) -> list[Image.Image]:
+    """
+    Cuts an image into the swath of each head, in head order
+    Parts of a swath beyond the edge of the image and the stagger padding
+    are filled with pad_colour
+    Raises a ValueError if the heads do not cover the whole image width
+    """
+    if image.width > swath.get_covered_width():
+        raise ValueError(f'{swath.heads} heads cover {swath.get_covered_width()} px, '
+                         f'less than the layer width of {image.width} px')
+    swath_size = swath.get_swath_size(image.height)
+    swaths = []
+    for head in range(swath.heads):
+        left, top = swath.get_head_offset(head)
+        strip = image.crop((left, 0, left + swath.swath_width, image.height))
+        if strip.size != swath_size:
+            canvas = Image.new(image.mode, swath_size, pad_colour)
+            if image.mode == 'P':
+                canvas.putpalette(image.getpalette())
+            canvas.paste(strip, (0, top))
+            strip = canvas
+        swaths.append(strip)
+    return swaths
+
+
+@dataclass
+class LayerStatistics:
+    """
+    Ink coverage of a converted layer, counted from its pixels in memory
+    Non-zero pixels are printed, ink_pixels counts them and level_total
+    sums their greyscale levels, so ink_fraction weighs each pixel by its
+    drop size, and bbox is the (left, top, right, bottom) box around them
+    Picklable, so it can be returned from a worker process
+    """
+    width: int = 0
+    height: int = 0
+    ink_pixels: int = 0
+    level_total: int = 0
+    bbox: tuple | None = None
+
+    def add_band(self, band: Image.Image, top: int = 0):
+        """
+        Counts a band of rows of the layer starting at row top, the whole
+        layer being a single band
+        """
+        if band.mode not in ('1', 'L'):
+            band = band.convert('L')
+        histogram = np.array(band.histogram(), dtype=np.int64)
+        self.width = max(self.width, band.width)
+        self.height = max(self.height, top + band.height)
+        self.ink_pixels += band.width * band.height - int(histogram[0])
+        self.level_total += int(histogram @ np.arange(256))
+
+        band_box = band.getbbox()
+        if band_box is None:
+            return
+        left, band_top, right, band_bottom = band_box
+        band_box = (left, top + band_top, right, top + band_bottom)
+        if self.bbox is None:
+            self.bbox = band_box
+        else:
+            self.bbox = (min(self.bbox[0], band_box[0]), min(self.bbox[1], band_box[1]),
+                         max(self.bbox[2], band_box[2]), max(self.bbox[3], band_box[3]))
+
+    @property
+    def coverage(self) -> float:
+        """
+        Fraction of the layer's pixels that are printed
+        """
+        pixels = self.width * self.height
+        return self.ink_pixels / pixels if pixels else 0.0
+
+    @property
+    def ink_fraction(self) -> float:
+        """
+        Fraction of the most ink the layer could take, each pixel printing
+        in proportion to its level
+        """
+        pixels = self.width * self.height
+        return self.level_total / (255 * pixels) if pixels else 0.0
+
+
+def get_layer_statistics(image: Image.Image) -> LayerStatistics:
+    """
+    Returns the ink statistics of a whole converted layer
+    """
+    statistics = LayerStatistics()
+    statistics.add_band(image)
+    return statistics
+
 
 class ImageConvertor:
     """
@@ -23,38 +696,126 @@ class ImageConvertor:
         self.file_extension = self.path.suffix
         self.new_file_name = self.path.stem
         self.new_file_extension = self.path.suffix
+        self.compression = None
+        self.rows_per_strip = None
+        self.page = None
+        self.volume_shape = None
+        self.volume_dtype = 'uint8'
+        self.output_directory = None
+
+    def set_volume_page(self, page: int, volume_shape: tuple = None,
+                        volume_dtype: str = 'uint8'):
+        """
+        Makes the image a single page of a multi-page TIFF, or Z slice of a
+        NumPy or raw volume, named after the file and page number
+        volume_shape and volume_dtype describe raw volumes, see
+        open_volume_array
+        """
+        if not isinstance(page, (int)) or page < 0:
+            raise ValueError('Page must be a positive integer')
+
+        self.page = page
+        self.volume_shape = volume_shape
+        self.volume_dtype = volume_dtype
+        self.file_name = f'{self.path.stem}_{page:05d}'
+        self.new_file_name = self.file_name
 
-    def open_image(self):
+    def open_image(self, data: bytes | Image.Image = None):
         """
         Creates a PIL object of the image
+        If the file has already been read, its contents can be passed as data,
+        or for a page of a volume the page read by read_volume_page
         """
-        self.image = Image.open(self.path)
+        if isinstance(data, Image.Image):
+            self.image = data
+        elif data is not None:
+            self.image = Image.open(io.BytesIO(data))
+        elif self.page is not None:
+            self.image = read_volume_page(self.path, self.page, self.volume_shape,
+                                          self.volume_dtype)
+        else:
+            self.image = Image.open(self.path)
+
+    def draft(self, x_dim: int = None, y_dim: int = None,
+              resize_mode: str = 'stretch', mode: str = None):
+        """
+        Asks the decoder for a reduced resolution image no smaller than the
+        resized image will be, before the image is loaded
+        Only JPEG files can be decoded at reduced size, by a factor of up to
+        8, for other files and loaded images this does nothing
+        mode can request a greyscale decode of a colour JPEG
+        """
+        if self.image.format != 'JPEG' or self.image.tile == []:
+            return
+        content_size, _ = get_resized_size(self.image.size, x_dim, y_dim, resize_mode)
+        self.image.draft(mode or self.image.mode, content_size)
 
-    def resize(self, x_dim: int = None, y_dim: int = None):
+    def resize(self, x_dim: int = None, y_dim: int = None, resample: str = None,
+               resize_mode: str = 'stretch', pad_colour: int = 0):
         """
         Resize the image to the specified x and y in pixels
         If no argument is passed, it uses the current x and y dimensions
         of the image
+        resample names the filter from RESAMPLE_FILTERS, such as 'nearest'
+        for binary masks or 'box' or 'lanczos' for greyscale, if blank
+        Pillow's default for the image mode is used
+        resize_mode 'fit' keeps the aspect ratio inside x by y, and 'pad'
+        also pads the fitted image out to x by y with pad_colour
+        Downscaling decodes JPEG files at reduced size and shrinks by whole
+        number factors with reduce() before the final resample
         """
 
-        width, height = self.image.size
-        if x_dim is None:
-            x_dim = width
-        if y_dim is None:
-            y_dim = height
-
-        if not isinstance(x_dim, (int)) or x_dim <= 0:
+        if x_dim is not None and (not isinstance(x_dim, (int)) or x_dim <= 0):
             raise TypeError('X dimension must be a positive non-zero number')
 
-        if not isinstance(y_dim, (int)) or y_dim <= 0:
+        if y_dim is not None and (not isinstance(y_dim, (int)) or y_dim <= 0):
             raise TypeError('Y dimension must be a positive non-zero number')
 
-        self.image = self.image.resize((x_dim, y_dim))
+        if resample is not None and resample not in RESAMPLE_FILTERS:
+            raise ValueError(f'Resample must be one of {list(RESAMPLE_FILTERS)}')
+
+        if resize_mode not in RESIZE_MODES:
+            raise ValueError(f'Resize mode must be one of {list(RESIZE_MODES)}')
+
+        self.draft(x_dim, y_dim, resize_mode)
+        content_size, canvas_size = get_resized_size(self.image.size, x_dim, y_dim,
+                                                     resize_mode)
+        self.image = self.resample(content_size, resample)
+
+        if canvas_size != content_size:
+            canvas = Image.new(self.image.mode, canvas_size, pad_colour)
+            if self.image.mode == 'P':
+                canvas.putpalette(self.image.getpalette())
+            canvas.paste(self.image, ((canvas_size[0] - content_size[0]) // 2,
+                                      (canvas_size[1] - content_size[1]) // 2))
+            self.image = canvas
 
-    def convert_image_depth(self, bit_depth: int = None):
+    def resample(self, size: tuple[int, int], resample: str = None) -> Image.Image:
+        """
+        Returns the image resampled to size, shrinking it by whole number
+        factors first where the filter allows
+        """
+        width, height = self.image.size
+        if size == (width, height):
+            return self.image.copy()
+
+        resample_filter = RESAMPLE_FILTERS.get(resample)
+        if self.image.mode in ('1', 'P') or resample_filter == Image.Resampling.NEAREST:
+            # Modes that cannot be averaged, and nearest neighbour, are
+            # already fast and must not be blurred
+            return self.image.resize(size, resample_filter)
+
+        if resample_filter == Image.Resampling.BOX and \
+                width % size[0] == 0 and height % size[1] == 0:
+            return self.image.reduce((width // size[0], height // size[1]))
+        return self.image.resize(size, resample_filter, reducing_gap=REDUCING_GAP)
+
+    def convert_image_depth(self, bit_depth: int = None,
+                            dither: str = 'error-diffusion', threshold: int = 128):
         """
         Converts the image to the specified depth
         If no argument is passed, the mode of the original image is used
+        Conversion to 1 bit uses the dither method given, see binarise()
         """
 
         if bit_depth is None:
@@ -62,9 +823,8 @@ class ImageConvertor:
             self.image = self.image.convert(conversion_argument)
             return
 
-        bit_dict = {1: '1', 8: 'L', 24: 'RGB', 32: 'RGBA'}
-        if bit_depth in bit_dict:
-            conversion_argument = bit_dict[bit_depth]
+        if bit_depth in BIT_DEPTH_MODES:
+            conversion_argument = BIT_DEPTH_MODES[bit_depth]
         else:
             raise TypeError(
         """Invalid mode. Only 1 (B&W), 8 (8-bit pixels, B&W),
@@ -73,8 +833,83 @@ class ImageConvertor:
         """
         )
 
+        if bit_depth == 1:
+            self.image = binarise(self.image, dither, threshold)
+            return
+
         self.image = self.image.convert(conversion_argument)
 
+    def convert_strips(self, x_dim: int = None, y_dim: int = None,
+                       bit_depth: int = None, dither: str = 'error-diffusion',
+                       threshold: int = 128, strip_height: int = 256,
+                       statistics: LayerStatistics = None):
+        """
+        Resizes, converts and saves the image one horizontal strip at a time,
+        so peak memory depends on the strip height rather than the image size
+        Resizing is limited to whole number scale factors, and the output is
+        an uncompressed TIFF written strip by strip
+        Error diffusion does not carry over between strips
+        Passing statistics counts the ink of each strip as it is written
+        """
+        if self.new_file_extension.lower() not in ('.tif', '.tiff'):
+            raise ValueError('Strip conversion can only save TIFF files')
+
+        if not isinstance(strip_height, (int)) or strip_height <= 0:
+            raise ValueError('Strip height must be a positive, non-zero integer')
+
+        if bit_depth is not None and bit_depth not in BIT_DEPTH_MODES:
+            raise TypeError('Invalid mode. Only 1, 8, 24 or 32 bit depths are allowed.')
+
+        self.open_image()
+        width, height = self.image.size
+        if x_dim is None:
+            x_dim = width
+        if y_dim is None:
+            y_dim = height
+
+        if not isinstance(x_dim, (int)) or x_dim <= 0:
+            raise TypeError('X dimension must be a positive non-zero number')
+
+        if not isinstance(y_dim, (int)) or y_dim <= 0:
+            raise TypeError('Y dimension must be a positive non-zero number')
+
+        x_reduce, x_enlarge = _scale_factors(width, x_dim)
+        y_reduce, y_enlarge = _scale_factors(height, y_dim)
+        # Each strip has to come from a whole number of source rows
+        strip_height = -(-strip_height // y_enlarge) * y_enlarge
+        source_rows = strip_height // y_enlarge * y_reduce
+
+        if bit_depth is not None:
+            mode = BIT_DEPTH_MODES[bit_depth]
+        elif self.image.mode in TIFF_STRIP_MODES:
+            mode = self.image.mode
+        else:
+            mode = 'RGBA' if self.image.mode in ('LA', 'PA', 'RGBA') else 'RGB'
+
+        output_path = self.get_output_path()
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with atomic_write_path(output_path) as temporary_path, \
+                open(temporary_path, 'wb') as output_file, \
+                StripTiffWriter(output_file, (x_dim, y_dim), mode, strip_height) as writer:
+            for source_top, band in iter_image_bands(self.image, source_rows):
+                if x_reduce > 1 or y_reduce > 1:
+                    if band.mode in ('1', 'P'):
+                        band = band.convert('L' if band.mode == '1' else 'RGBA')
+                    band = band.reduce((x_reduce, y_reduce))
+                if x_enlarge > 1 or y_enlarge > 1:
+                    band = band.resize((band.width * x_enlarge, band.height * y_enlarge),
+                                       Image.Resampling.NEAREST)
+                if band.mode != mode:
+                    if mode == '1':
+                        top = source_top // y_reduce * y_enlarge
+                        band = binarise(band, dither, threshold, top)
+                    else:
+                        band = band.convert(mode)
+                if statistics is not None:
+                    statistics.add_band(band, source_top // y_reduce * y_enlarge)
+                writer.write_strip(band)
+
     def get_new_file_name(self, file_name: str = None):
         """
         Changes the file name to the passed argument
@@ -101,72 +936,2444 @@ class ImageConvertor:
 
         self.new_file_extension = file_extension
 
-    def save_file(self):
+    def set_output_directory(self, output_directory: Path = None):
         """
-        Saves the file to the higher directory in a folder called Output
+        Changes the folder the file is saved to
+        If blank, the folder called Output is used, see get_output_directory
         """
+        if output_directory is not None and not isinstance(output_directory, (str, Path)):
+            raise TypeError('Output directory must be a path')
 
-        output_directory = self.path.parent.parent / 'output'
+        self.output_directory = Path(output_directory) if output_directory is not None \
+            else None
 
-        output_directory.mkdir(parents=True, exist_ok=True)
+    def get_output_directory(self) -> Path:
+        """
+        Returns the folder called Output in the higher directory, unless
+        another folder has been set
+        A volume file holds the whole stack, so the pages of a volume are
+        saved to a folder called Output next to it
+        """
+        if self.output_directory is not None:
+            return self.output_directory
+        if self.page is not None:
+            return self.path.parent / 'output'
+        return self.path.parent.parent / 'output'
 
-        full_new_file_path = self.new_file_name + self. new_file_extension
+    def get_output_path(self, head: int = None) -> Path:
+        """
+        Returns the path the file will be saved to, in the higher directory
+        in a folder called Output
+        For the swath of a head, counted from 0, the file is saved to the
+        head's folder inside Output
+        """
+        output_directory = self.get_output_directory()
+        if head is not None:
+            output_directory = output_directory / HEAD_DIRECTORY_FORMAT.format(head + 1)
 
-        self.image.save(output_directory / full_new_file_path)
+        full_new_file_path = self.new_file_name + self.new_file_extension
 
+        return output_directory / full_new_file_path
 
-class StackConvertor:
-    """
-    Collects the image stack from the specified location, and then converts
-    each in turn by creating an ImageConvertor object
-    Default number of copies is 1, this can be increased for more images
-    """
-        
+    def save_file(self):
+        """
+        Saves the file to the higher directory in a folder called Output
+        The file is written under a temporary name and then renamed, so an
+        interrupted save never leaves a partial file behind
+        """
 
-    def __init__(self, path: str, new_file_name_format: str = None,
-                 new_file_extension: str = None, x_dim: int = None,
-                 y_dim: int = None, bit_depth: int = None, copies: int = 1):
-        self.path = Path(path)
-        self.new_file_name_format = new_file_name_format
-        self.new_file_extension = new_file_extension
-        self.x_dim = x_dim
-        self.y_dim = y_dim
-        self.bit_depth = bit_depth
-        self.copies = copies
+        output_path = self.get_output_path()
 
-        if not self.path.exists():
-            raise FileNotFoundError(f'The specified path does not exist: {self.path}')
+        output_path.parent.mkdir(parents=True, exist_ok=True)
 
-        if not self.path.is_dir():
-            raise ValueError(f'{self.path} is not a valid directory.')
+        with atomic_write_path(output_path) as temporary_path, \
+                open(temporary_path, 'wb') as output_file:
+            self.write_image(output_file)
 
-        if not isinstance(copies, (int)) or copies <= 0:
-            raise ValueError('Copies must be a positive, non-zero integer')
+    def save_swaths(self, swath: SwathLayout):
+        """
+        Splits the image into the swath of each head and saves each to its
+        head's folder, writing the heads in parallel
+        """
+        def save_swath(head, image):
+            output_path = self.get_output_path(head)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_write_path(output_path) as temporary_path, \
+                    open(temporary_path, 'wb') as output_file:
+                self.write_image(output_file, image)
 
-    def convert_image_stack(self):
+        swaths = split_swaths(self.image, swath)
+        with ThreadPoolExecutor(max_workers=len(swaths)) as executor:
+            # list() raises the first error of any head
+            list(executor.map(save_swath, range(len(swaths)), swaths))
+
+    def get_image_format(self) -> str:
         """
-        Runs through the specified folder, converting each image and saving
-        it as it goes
+        Returns the Pillow format name for the new file extension
         """
+        image_format = Image.registered_extensions().get(self.new_file_extension.lower())
+        if image_format is None:
+            raise ValueError(f'Unknown file extension: {self.new_file_extension}')
+        return image_format
 
-        layer_number = 1
+    def set_encoder_options(self, compression: str = None,
+                            rows_per_strip: int = None):
+        """
+        Sets how the file is compressed when it is saved
+        TIFF files accept 'none', 'packbits', 'lzw' or 'group4' (1 bit only),
+        BMP files accept 'none' or 'rle8' (8 bit only)
+        rows_per_strip sets the TIFF strip height, if blank Pillow picks it
+        Uncompressed TIFFs with a strip height are written by StripTiffWriter,
+        as Pillow ignores the strip size when it writes them itself
+        """
+        if rows_per_strip is not None and (not isinstance(rows_per_strip, (int))
+                                           or rows_per_strip <= 0):
+            raise ValueError('Rows per strip must be a positive, non-zero integer')
 
-        for file_path in self.path.iterdir():
-            if file_path.is_file():
-                for copy_number in range(0, self.copies):
-                    if self.new_file_name_format is not None:
-                        new_file_name = self.new_file_name_format + \
-                            '_' + str(layer_number).zfill(5)
-                    else:
-                        new_file_name = None
-                    image_conversion = ImageConvertor(file_path)
-                    image_conversion.open_image()
-                    if self.x_dim is not None or self.y_dim is not None:
-                        image_conversion.resize(self.x_dim, self.y_dim)
-                    if self.bit_depth is not None:
-                        image_conversion.convert_image_depth(self.bit_depth)
-                    image_conversion.get_new_file_name(new_file_name)
-                    image_conversion.get_new_file_extension(
-                        self.new_file_extension)
-                    image_conversion.save_file()
-                    layer_number += 1
+        self.compression = compression
+        self.rows_per_strip = rows_per_strip
+
+    def write_image(self, output_file, image: Image.Image = None):
+        """
+        Encodes the image, or another image such as one of its swaths, to an
+        open binary file using the encoder options
+        """
+        if image is None:
+            image = self.image
+        image_format = self.get_image_format()
+        compression = self.compression or 'none'
+        if compression not in COMPRESSION_OPTIONS.get(image_format, ('none',)):
+            raise ValueError(f'{compression} compression is not available for '
+                             f'{self.new_file_extension} files')
+
+        if image_format == 'BMP' and compression == 'rle8':
+            output_file.write(encode_bmp_rle8(image))
+            return
+
+        if image_format == 'TIFF' and compression == 'none' and self.rows_per_strip:
+            with StripTiffWriter(output_file, image.size, image.mode,
+                                 self.rows_per_strip) as writer:
+                for top in range(0, image.height, self.rows_per_strip):
+                    bottom = min(top + self.rows_per_strip, image.height)
+                    writer.write_strip(image.crop((0, top, image.width, bottom)))
+            return
+
+        save_options = {}
+        if image_format == 'TIFF':
+            if compression == 'group4' and image.mode != '1':
+                raise ValueError('Group 4 compression needs a 1 bit image')
+            save_options['compression'] = TIFF_COMPRESSION[compression]
+            if self.rows_per_strip is not None:
+                row_bytes = (image.width * MODE_BITS.get(image.mode, 32) + 7) // 8
+                save_options['strip_size'] = self.rows_per_strip * row_bytes
+        image.save(output_file, image_format, **save_options)
+
+    def encode_file(self, image: Image.Image = None) -> bytes:
+        """
+        Returns the contents the saved file would have, without writing it
+        """
+        buffer = io.BytesIO()
+        self.write_image(buffer, image)
+        return buffer.getvalue()
+
+    def encode_swaths(self, swath: SwathLayout) -> list[bytes]:
+        """
+        Returns the contents of the saved swath of each head, encoding the
+        heads in parallel
+        """
+        swaths = split_swaths(self.image, swath)
+        with ThreadPoolExecutor(max_workers=len(swaths)) as executor:
+            return list(executor.map(self.encode_file, swaths))
+
+
+def get_raw_size(image: Image.Image) -> int:
+    """
+    Returns the bytes the pixels of an image take uncompressed, with each
+    row padded to a whole byte
+    """
+    width, height = image.size
+    return (width * MODE_BITS.get(image.mode, 32) + 7) // 8 * height
+
+
+def natural_sort_key(path: Path) -> list:
+    """
+    Sort key that orders numbers within file names by value, so slice_2
+    comes before slice_10
+    """
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', path.name.lower())]
+
+
+@dataclass(frozen=True)
+class LayerInfo:
+    """
+    Header information of a single layer image, read without decoding the
+    pixel data
+    streamable is True if the rows are stored uncompressed, so strip mode
+    reads them from the file one band at a time rather than decoding the
+    whole image
+    """
+    path: Path
+    size: tuple[int, int]
+    mode: str
+    format: str
+    file_size: int
+    streamable: bool = False
+
+
+def read_layer_info(file_path: Path) -> LayerInfo:
+    """
+    Reads the size, mode and format of an image from its header
+    """
+    with Image.open(file_path) as image:
+        return LayerInfo(file_path, image.size, image.mode, image.format,
+                         file_path.stat().st_size, _raw_row_layout(image) is not None)
+
+
+# Multi-page TIFF open in each thread, kept so reading the next page does
+# not walk the chain of pages from the start of the file again
+_open_tiff_volumes = threading.local()
+
+
+def _open_tiff_volume(path: Path) -> Image.Image:
+    """
+    Returns the open TIFF file of this thread for path, reopening it if
+    the file has changed
+    """
+    stat = path.stat()
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    cached = getattr(_open_tiff_volumes, 'volume', None)
+    if cached is None or cached[0] != key:
+        if cached is not None:
+            cached[1].close()
+        _open_tiff_volumes.volume = (key, Image.open(path))
+    return _open_tiff_volumes.volume[1]
+
+
+def open_volume_array(path: Path, volume_shape: tuple = None,
+                      volume_dtype: str = 'uint8') -> np.ndarray:
+    """
+    Memory maps a NumPy .npy volume, or a raw volume of the given shape and
+    voxel type, without reading the voxels
+    Volumes are indexed (depth, height, width), with a fourth axis of 3 or 4
+    channels for colour
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.npy':
+        volume = np.load(path, mmap_mode='r')
+    else:
+        if volume_shape is None:
+            raise ValueError('Raw volumes need a volume shape of (depth, height, width)')
+        if volume_dtype not in VOLUME_DTYPES:
+            raise ValueError(f'Volume type must be one of {VOLUME_DTYPES}')
+        volume = np.memmap(path, dtype=volume_dtype, mode='r', shape=tuple(volume_shape))
+
+    if volume.dtype.name not in VOLUME_DTYPES:
+        raise ValueError(f'Volume type must be one of {VOLUME_DTYPES}, not {volume.dtype}')
+    if not (volume.ndim == 3 or (volume.ndim == 4 and volume.shape[3] in (3, 4)
+                                 and volume.dtype == np.uint8)):
+        raise ValueError('Volumes must be (depth, height, width), with an optional '
+                         'last axis of 3 or 4 channels')
+    return volume
+
+
+def read_volume_page(path: Path, page: int, volume_shape: tuple = None,
+                     volume_dtype: str = 'uint8') -> Image.Image:
+    """
+    Reads a single page of a multi-page TIFF, or Z slice of a volume, into
+    memory, leaving the rest of the file unread
+    """
+    path = Path(path)
+    if path.suffix.lower() in ('.tif', '.tiff'):
+        image = _open_tiff_volume(path)
+        image.seek(page)
+        image.load()
+        # The open file moves on to other pages, so it cannot be handed out
+        return image.copy()
+
+    volume = open_volume_array(path, volume_shape, volume_dtype)
+    return Image.fromarray(np.array(volume[page]))
+
+
+@dataclass(frozen=True)
+class PartPlacement:
+    """
+    Where a part stack is printed on the bed: the left and top of its
+    layers in bed pixels, and the bed layer its first layer is printed in
+    path is the folder or volume file of the part, raw volumes also need
+    their volume_shape and volume_dtype
+    """
+    path: Path
+    x: int = 0
+    y: int = 0
+    z: int = 0
+    volume_shape: tuple | None = None
+    volume_dtype: str = 'uint8'
+
+
+@dataclass(frozen=True)
+class BedLayer:
+    """
+    The part slices printed in one layer of a bed, as (placement, source
+    path, page) with page set for the slices of volume parts
+    """
+    size: tuple[int, int]
+    part_slices: tuple = ()
+
+
+def read_part_slice(placement: PartPlacement, source_path: Path,
+                    page: int = None) -> Image.Image:
+    """
+    Reads one slice of a part, from its layer file or volume
+    """
+    if page is None:
+        with Image.open(source_path) as image:
+            image.load()
+            return image
+    return read_volume_page(source_path, page, placement.volume_shape,
+                            placement.volume_dtype)
+
+
+def compose_bed_layer(bed_layer: BedLayer) -> Image.Image:
+    """
+    Builds a greyscale bed layer by copying each part slice into one
+    buffer at its placement, clipped to the bed
+    Where parts overlap, the brighter pixel is kept, so neither part's
+    background erases the other
+    """
+    width, height = bed_layer.size
+    bed = np.zeros((height, width), dtype=np.uint8)
+    for placement, source_path, page in bed_layer.part_slices:
+        part = np.asarray(read_part_slice(placement, source_path, page).convert('L'))
+        region = bed[placement.y:placement.y + part.shape[0],
+                     placement.x:placement.x + part.shape[1]]
+        np.maximum(region, part[:region.shape[0], :region.shape[1]], out=region)
+    return Image.fromarray(bed)
+
+
+class MemoryBudget:
+    """
+    Admission control for work that needs an estimated amount of memory
+    Work is admitted while the total in use stays within the budget, and
+    work larger than the whole budget is admitted once nothing else is
+    running, so it always makes progress
+    Safe to use from several threads at once
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.in_use = 0
+        self.running = 0
+        self.peak_in_use = 0
+        self.peak_running = 0
+        self.condition = threading.Condition()
+
+        if not isinstance(budget, (int)) or budget <= 0:
+            raise ValueError('Memory budget must be a positive, non-zero integer')
+
+    def try_acquire(self, size: int) -> bool:
+        """
+        Reserves size bytes if they fit in the budget, returning whether
+        they were reserved
+        """
+        with self.condition:
+            if self.running and self.in_use + size > self.budget:
+                return False
+            self.in_use += size
+            self.running += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.peak_running = max(self.peak_running, self.running)
+            return True
+
+    def acquire(self, size: int, cancel_event=None) -> bool:
+        """
+        Waits until size bytes fit in the budget and reserves them
+        Returns False without reserving if cancel_event is set first
+        """
+        with self.condition:
+            while not self.try_acquire(size):
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                self.condition.wait(0.1)
+            return True
+
+    def release(self, size: int):
+        """
+        Returns size bytes reserved earlier to the budget
+        """
+        with self.condition:
+            self.in_use -= size
+            self.running -= 1
+            self.condition.notify_all()
+
+
+class StackIndex:
+    """
+    The image files of a stack folder in natural sort order
+    The folder is listed once, and the header of each file is read at most
+    once and cached for later stages
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.files = sorted(
+            (file_path for file_path in self.path.iterdir()
+             if file_path.is_file() and file_path.suffix.lower() in IMAGE_EXTENSIONS),
+            key=natural_sort_key)
+        self.layer_info = {}
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def get_layer_info(self, file_path: Path) -> LayerInfo:
+        """
+        Returns the cached header information of a file, reading it if needed
+        """
+        if file_path not in self.layer_info:
+            self.layer_info[file_path] = read_layer_info(file_path)
+        return self.layer_info[file_path]
+
+    def load_layer_info(self, max_workers: int = None) -> dict:
+        """
+        Reads the headers of every file that is not cached yet, using a
+        thread pool as the work is dominated by file access
+        Files that cannot be read are returned with their exception
+        """
+        unread = [file_path for file_path in self.files
+                  if file_path not in self.layer_info]
+        errors = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(read_layer_info, file_path): file_path
+                       for file_path in unread}
+            for future in as_completed(futures):
+                error = future.exception()
+                if error is not None:
+                    errors[futures[future]] = error
+                else:
+                    self.layer_info[futures[future]] = future.result()
+
+        return errors
+
+
+def count_tiff_pages(image: Image.Image) -> int:
+    """
+    Returns the number of pages of an open TIFF file
+    Unlike n_frames, pages whose header Pillow cannot read are counted, so
+    they can be reported as unreadable layers
+    """
+    page = 0
+    while True:
+        try:
+            image.seek(page + 1)
+        except EOFError:
+            return page + 1
+        except SyntaxError:
+            pass
+        page += 1
+
+
+class VolumeIndex:
+    """
+    The pages of a multi-page TIFF, or Z slices of a NumPy or raw volume,
+    as the layers of a stack
+    Behaves like a StackIndex whose layers are page numbers, the voxels of
+    NumPy and raw volumes are memory mapped and only read when converted
+    """
+
+    def __init__(self, path: Path, volume_shape: tuple = None,
+                 volume_dtype: str = 'uint8'):
+        self.path = Path(path)
+        self.volume_shape = volume_shape
+        self.volume_dtype = volume_dtype
+        self.layer_info = {}
+        # Every slice of an array volume shares the same header information
+        self.slice_info = None
+
+        if self.path.suffix.lower() in ('.tif', '.tiff'):
+            with Image.open(self.path) as image:
+                self.pages = list(range(count_tiff_pages(image)))
+            return
+
+        volume = open_volume_array(self.path, volume_shape, volume_dtype)
+        depth, height, width = volume.shape[:3]
+        if volume.ndim == 4:
+            mode = 'RGB' if volume.shape[3] == 3 else 'RGBA'
+        else:
+            mode = '1' if volume.dtype == bool else 'L'
+        self.pages = list(range(depth))
+        self.slice_info = LayerInfo(self.path, (width, height), mode,
+                                    self.path.suffix[1:].upper(),
+                                    volume[0].nbytes if depth else 0)
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def get_layer_info(self, page: int) -> LayerInfo:
+        """
+        Returns the cached header information of a page, reading the headers
+        of every page the first time, as seeking to a TIFF page walks
+        through the pages before it
+        """
+        if self.slice_info is not None:
+            return self.slice_info
+        if page not in self.layer_info:
+            errors = self.load_layer_info()
+            if page in errors:
+                raise errors[page]
+        return self.layer_info[page]
+
+    def load_layer_info(self, max_workers: int = None) -> dict:
+        """
+        Reads the header of every page that is not cached yet in a single
+        pass through the file
+        Pages that cannot be read are returned with their exception
+        max_workers is ignored, as the pages share one file
+        """
+        if self.slice_info is not None:
+            self.layer_info = dict.fromkeys(self.pages, self.slice_info)
+            return {}
+
+        errors = {}
+        with Image.open(self.path) as image:
+            for page in self.pages:
+                if page in self.layer_info:
+                    continue
+                try:
+                    image.seek(page)
+                except SyntaxError as error:
+                    # Pillow cannot read this page, the pages after it can
+                    # still be reached
+                    errors[page] = error
+                    continue
+                except (OSError, EOFError) as error:
+                    errors.update(dict.fromkeys(self.pages[page:], error))
+                    break
+                # Pages are held decoded while converting, so count their
+                # uncompressed size
+                self.layer_info[page] = LayerInfo(self.path, image.size, image.mode,
+                                                  image.format, get_raw_size(image))
+        return errors
+
+
+class BedIndex:
+    """
+    The layers of a build bed made up of several part stacks, read from a
+    bed file
+    The bed file is JSON, with the parts to place under "parts", each with
+    the path of its folder or volume file relative to the bed file, its x
+    and y position in pixels and z layer offset, and the optional bed
+    "size" [width, height], which defaults to the extent of the parts
+    Behaves like a StackIndex whose layers are bed layer numbers, the parts
+    are only listed here and each bed layer is composed when it is converted
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.layer_info = {}
+
+        with open(self.path) as bed_file:
+            try:
+                bed = json.load(bed_file)
+                self.placements = [
+                    PartPlacement(self.path.parent / part['path'], part.get('x', 0),
+                                  part.get('y', 0), part.get('z', 0),
+                                  tuple(part['volume_shape']) if 'volume_shape' in part
+                                  else None, part.get('volume_dtype', 'uint8'))
+                    for part in bed['parts']]
+                size = tuple(bed['size']) if 'size' in bed else None
+            except (ValueError, KeyError, TypeError) as error:
+                raise ValueError(f'{self.path} is not a valid bed file: {error}') from None
+
+        if not self.placements:
+            raise ValueError(f'{self.path} does not place any parts')
+
+        if not all(isinstance(position, int) and position >= 0
+                   for placement in self.placements
+                   for position in (placement.x, placement.y, placement.z)):
+            raise ValueError('Part positions and layer offsets must be positive integers')
+
+        if size is not None and (len(size) != 2 or
+                                 not all(isinstance(length, int) and length > 0
+                                         for length in size)):
+            raise ValueError('Bed size must be a positive integer width and height')
+
+        self.part_indexes = [StackIndex(placement.path) if placement.path.is_dir()
+                             else VolumeIndex(placement.path, placement.volume_shape,
+                                              placement.volume_dtype)
+                             for placement in self.placements]
+
+        self.size = size if size is not None else self.get_parts_extent()
+
+        self.layers = list(range(max(placement.z + len(part_index)
+                                     for placement, part_index
+                                     in zip(self.placements, self.part_indexes))))
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def get_parts_extent(self) -> tuple[int, int]:
+        """
+        Returns the size of the smallest bed that holds every part, from
+        the header of each part's first layer
+        """
+        width = height = 0
+        for placement, part_index in zip(self.placements, self.part_indexes):
+            for layer in part_index:
+                part_width, part_height = part_index.get_layer_info(layer).size
+                width = max(width, placement.x + part_width)
+                height = max(height, placement.y + part_height)
+                break
+        return width, height
+
+    def get_part_layers(self, layer: int) -> list[tuple]:
+        """
+        Returns the (placement, part index, part layer) of each part printed
+        in a bed layer, where the part layer is a file path, or a page
+        number for a volume
+        """
+        part_layers = []
+        for placement, part_index in zip(self.placements, self.part_indexes):
+            part_layer = layer - placement.z
+            if not 0 <= part_layer < len(part_index):
+                continue
+            if isinstance(part_index, VolumeIndex):
+                part_layers.append((placement, part_index, part_index.pages[part_layer]))
+            else:
+                part_layers.append((placement, part_index, part_index.files[part_layer]))
+        return part_layers
+
+    def get_bed_layer(self, layer: int) -> BedLayer:
+        """
+        Returns the part slices printed in a bed layer
+        """
+        part_slices = []
+        for placement, part_index, part_layer in self.get_part_layers(layer):
+            if isinstance(part_index, VolumeIndex):
+                part_slices.append((placement, part_index.path, part_layer))
+            else:
+                part_slices.append((placement, part_layer, None))
+        return BedLayer(self.size, tuple(part_slices))
+
+    def get_layer_info(self, layer: int) -> LayerInfo:
+        """
+        Returns the header information of a bed layer, which is always a
+        greyscale image of the bed size, counting the part slices it reads
+        as its file size
+        """
+        if layer not in self.layer_info:
+            width, height = self.size
+            part_bytes = sum(part_index.get_layer_info(part_layer).file_size
+                             for _, part_index, part_layer in self.get_part_layers(layer))
+            self.layer_info[layer] = LayerInfo(self.path, self.size, 'L', 'BED',
+                                               width * height + part_bytes)
+        return self.layer_info[layer]
+
+    def load_layer_info(self, max_workers: int = None) -> dict:
+        """
+        Reads the headers of every part, returning the bed layers that use
+        a part slice that cannot be read with its exception
+        """
+        errors = {}
+        for placement, part_index in zip(self.placements, self.part_indexes):
+            part_errors = part_index.load_layer_info(max_workers)
+            for part_number, part_layer in enumerate(part_index):
+                if part_layer in part_errors:
+                    errors[placement.z + part_number] = part_errors[part_layer]
+
+        for layer in self.layers:
+            if layer not in errors:
+                self.get_layer_info(layer)
+        return errors
+
+
+@dataclass
+class ValidationReport:
+    """
+    Result of checking the headers of every layer in a stack before
+    converting it
+    """
+    layer_count: int = 0
+    sizes: dict = field(default_factory=dict)
+    inconsistent_sizes: list = field(default_factory=list)
+    unreadable: dict = field(default_factory=dict)
+    unexpected_modes: list = field(default_factory=list)
+    uncovered_layers: list = field(default_factory=list)
+    # Layers strip mode has to decode in full, as they are compressed, a
+    # warning rather than an error
+    unstreamable_layers: list = field(default_factory=list)
+    projected_output_bytes: int = 0
+
+    @property
+    def is_valid(self) -> bool:
+        """
+        True if every layer could be read, has the same size and a
+        supported mode, and fits within the printhead swaths
+        """
+        return not (self.inconsistent_sizes or self.unreadable
+                    or self.unexpected_modes or self.uncovered_layers)
+
+
+@dataclass
+class DeduplicationStats:
+    """
+    Number of layers written, and how many of them had to be encoded rather
+    than copied from an identical layer
+    """
+    layers: int = 0
+    encoded_layers: int = 0
+
+    @property
+    def ratio(self) -> float:
+        """
+        Layers written for each layer encoded
+        """
+        if not self.encoded_layers:
+            return 1.0
+        return self.layers / self.encoded_layers
+
+
+@dataclass
+class LayerMetrics:
+    """
+    Time spent in each stage of converting one layer, with the bytes and
+    pixels it read and wrote, and its ink statistics when they are collected
+    Picklable, so it can be returned from a worker process
+    """
+    layer_number: int
+    source_name: str
+    stage_seconds: dict = field(default_factory=dict)
+    bytes_read: int = 0
+    bytes_written: int = 0
+    source_pixels: int = 0
+    output_pixels: int = 0
+    statistics: LayerStatistics | None = None
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        """
+        Adds the time spent inside the with block to the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage] = (self.stage_seconds.get(stage, 0.0)
+                                         + time.perf_counter() - start)
+
+
+def time_stage(layer_metrics: LayerMetrics | None, stage: str):
+    """
+    Times a stage of a layer, or does nothing if the layer is not measured
+    """
+    if layer_metrics is None:
+        return nullcontext()
+    return layer_metrics.time_stage(stage)
+
+
+@dataclass
+class ConversionMetrics:
+    """
+    Collects the LayerMetrics of every layer a StackConvertor converts
+    Setting profile_path also runs one layer under cProfile and saves the
+    profile there, profile_layer picks the layer, by default the middle one
+    """
+    profile_path: Path | None = None
+    profile_layer: int | None = None
+    layers: dict = field(default_factory=dict)
+    wall_seconds: float = 0.0
+
+    def add_layer(self, layer_metrics: LayerMetrics):
+        """
+        Records the measurements of a layer, replacing any earlier ones
+        """
+        self.layers[layer_metrics.layer_number] = layer_metrics
+
+    def get_summary(self) -> dict:
+        """
+        Returns the totals of every layer, the total, mean and slowest time
+        of each stage, and the slowest layers
+        """
+        stages = {}
+        for layer_metrics in self.layers.values():
+            for stage, seconds in layer_metrics.stage_seconds.items():
+                stages.setdefault(stage, []).append(seconds)
+        layer_seconds = {layer_number: sum(layer_metrics.stage_seconds.values())
+                         for layer_number, layer_metrics in self.layers.items()}
+
+        return {
+            'layers': len(self.layers),
+            'wall_seconds': self.wall_seconds,
+            'layers_per_second': (len(self.layers) / self.wall_seconds
+                                  if self.wall_seconds else None),
+            'bytes_read': sum(layer.bytes_read for layer in self.layers.values()),
+            'bytes_written': sum(layer.bytes_written for layer in self.layers.values()),
+            'source_pixels': sum(layer.source_pixels for layer in self.layers.values()),
+            'output_pixels': sum(layer.output_pixels for layer in self.layers.values()),
+            'stages': {stage: {'total_seconds': sum(seconds),
+                               'mean_seconds': sum(seconds) / len(seconds),
+                               'max_seconds': max(seconds)}
+                       for stage, seconds in stages.items()},
+            'slowest_layers': sorted(layer_seconds, key=layer_seconds.get,
+                                     reverse=True)[:5],
+        }
+
+    def write_json(self, path: Path, include_layers: bool = False):
+        """
+        Saves the summary as JSON, with the measurements of every layer if
+        include_layers is set
+        """
+        summary = self.get_summary()
+        if include_layers:
+            summary['layer_metrics'] = [asdict(self.layers[layer_number])
+                                        for layer_number in sorted(self.layers)]
+        write_output_file(Path(path), json.dumps(summary, indent=2).encode())
+
+
+class DirectoryOutput:
+    """
+    Writes encoded outputs as files in a folder
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def write_group(self, output_names: list[str], data: bytes, copy_mode: str = 'copy',
+                    layer_metrics: LayerMetrics = None):
+        """
+        Writes data under the first name, relative to the folder, and copies
+        it to the other names using copy_mode
+        """
+        first_path = self.path / output_names[0]
+        with time_stage(layer_metrics, 'write_output_file'):
+            write_output_file(first_path, data)
+        with time_stage(layer_metrics, 'copies'):
+            for output_name in output_names[1:]:
+                copy_output_file(first_path, self.path / output_name, copy_mode)
+
+        if layer_metrics is not None:
+            # Linked copies share the data of the first output
+            copies_written = len(output_names) if copy_mode == 'copy' else 1
+            layer_metrics.bytes_written += len(data) * copies_written
+
+    def close(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+class ArchiveOutput:
+    """
+    Streams encoded outputs into a single tar or zip archive, in the order
+    they are written, without temporary files for the outputs
+    The archive is written under a temporary name and only replaces path
+    once it is closed, discard() deletes it instead
+    """
+
+    def __init__(self, path: Path, output_format: str = 'tar'):
+        if output_format not in OUTPUT_FORMATS or output_format == 'directory':
+            raise ValueError(f'Archive format must be one of '
+                             f'{[name for name in OUTPUT_FORMATS if name != "directory"]}')
+
+        self.path = Path(path)
+        self.output_format = output_format
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.temporary_path = self.path.with_name(f'.{self.path.name}.{uuid.uuid4().hex}.tmp')
+        with ExitStack() as exit_stack:
+            self.file = exit_stack.enter_context(open(self.temporary_path, 'wb'))
+            if output_format == 'tar':
+                self.archive = exit_stack.enter_context(
+                    tarfile.open(fileobj=self.file, mode='w'))
+            else:
+                compression = zipfile.ZIP_DEFLATED if output_format == 'zip-deflate' \
+                    else zipfile.ZIP_STORED
+                self.archive = exit_stack.enter_context(
+                    zipfile.ZipFile(self.file, 'w', compression))
+            # Kept open until close() or discard(), which close the handles
+            # even if finishing the archive fails
+            self.exit_stack = exit_stack.pop_all()
+
+    def write_member(self, output_name: str, data: bytes):
+        if self.output_format == 'tar':
+            member = tarfile.TarInfo(output_name)
+            member.size = len(data)
+            member.mtime = int(time.time())
+            self.archive.addfile(member, io.BytesIO(data))
+        else:
+            self.archive.writestr(output_name, data)
+
+    def write_group(self, output_names: list[str], data: bytes, copy_mode: str = 'copy',
+                    layer_metrics: LayerMetrics = None):
+        """
+        Adds data to the archive under each of the names
+        In a tar archive, linked copy modes add the copies as hard links to
+        the first member, zip archives always store the data again
+        """
+        with time_stage(layer_metrics, 'write_output_file'):
+            self.write_member(output_names[0], data)
+        copies_written = 1
+        with time_stage(layer_metrics, 'copies'):
+            for output_name in output_names[1:]:
+                if self.output_format == 'tar' and copy_mode != 'copy':
+                    member = tarfile.TarInfo(output_name)
+                    member.type = tarfile.LNKTYPE
+                    member.linkname = output_names[0]
+                    member.mtime = int(time.time())
+                    self.archive.addfile(member)
+                else:
+                    self.write_member(output_name, data)
+                    copies_written += 1
+
+        if layer_metrics is not None:
+            layer_metrics.bytes_written += len(data) * copies_written
+
+    def close(self):
+        """
+        Finishes the archive and moves it into place
+        """
+        with self.exit_stack:
+            self.archive.close()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        os.replace(self.temporary_path, self.path)
+
+    def discard(self):
+        """
+        Abandons the archive, leaving any earlier archive at path untouched
+        """
+        try:
+            self.exit_stack.close()
+        finally:
+            self.temporary_path.unlink(missing_ok=True)
+
+
+def save_statistics(path: Path, rows: list[dict]):
+    """
+    Saves the ink statistics rows of each layer, see
+    StackConvertor.get_statistics_rows, as CSV or as JSON with the totals
+    for the build, depending on the file extension of path
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.csv':
+        contents = io.StringIO()
+        writer = csv.DictWriter(contents, STATISTICS_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+        contents = contents.getvalue()
+    else:
+        contents = json.dumps({'layers': rows,
+                               'ink_pixels': sum(row['ink_pixels'] for row in rows),
+                               'mean_coverage': (sum(row['coverage'] for row in rows) /
+                                                 len(rows) if rows else 0.0)},
+                              indent=1)
+    write_output_file(path, contents.encode())
+
+
+def open_output(path: Path, output_format: str = 'directory') -> DirectoryOutput | ArchiveOutput:
+    """
+    Returns the output that writes to path in the given format, one of
+    OUTPUT_FORMATS
+    """
+    if output_format == 'directory':
+        return DirectoryOutput(path)
+    return ArchiveOutput(path, output_format)
+
+
+def get_pixel_hash(image: Image.Image) -> bytes:
+    """
+    Returns a hash of the mode, size and pixel data of an image
+    """
+    pixel_hash = hashlib.blake2b(f'{image.mode}{image.size}'.encode())
+    pixel_hash.update(image.tobytes())
+    return pixel_hash.digest()
+
+
+def get_file_hash(path: Path) -> bytes:
+    """
+    Returns a hash of the contents of a file, read in chunks
+    """
+    file_hash = hashlib.blake2b()
+    with open(path, 'rb') as source_file:
+        while chunk := source_file.read(1 << 20):
+            file_hash.update(chunk)
+    return file_hash.digest()
+
+
+def get_page_hash(path: Path, page: int, volume_shape: tuple = None,
+                  volume_dtype: str = 'uint8') -> bytes:
+    """
+    Returns a hash of the stored data of one page of a volume, without
+    decoding it
+    TIFF pages are hashed from their strips or tiles as stored, along with
+    the tags that control decoding, so pages hash the same only if they
+    decode to the same pixels, other volumes from the voxels of the page
+    """
+    path = Path(path)
+    page_hash = hashlib.blake2b()
+    if path.suffix.lower() not in ('.tif', '.tiff'):
+        volume = open_volume_array(path, volume_shape, volume_dtype)
+        page_hash.update(f'{volume.dtype}{volume.shape[1:]}'.encode())
+        page_hash.update(np.ascontiguousarray(volume[page]))
+        return page_hash.digest()
+
+    image = _open_tiff_volume(path)
+    image.seek(page)
+    offsets = image.tag_v2.get(273) or image.tag_v2.get(324)
+    byte_counts = image.tag_v2.get(279) or image.tag_v2.get(325)
+    if not offsets or not byte_counts:
+        return get_pixel_hash(read_volume_page(path, page))
+    decode_tags = [(tag, image.tag_v2.get(tag)) for tag in TIFF_DECODE_TAGS]
+    page_hash.update(f'{image.mode}{image.size}{decode_tags}'.encode())
+    with open(path, 'rb') as volume_file:
+        for offset, byte_count in zip(offsets, byte_counts):
+            volume_file.seek(offset)
+            page_hash.update(volume_file.read(byte_count))
+    return page_hash.digest()
+
+
+@dataclass(frozen=True)
+class ConversionOptions:
+    """
+    The operations applied to every image in a stack, and how the outputs
+    are named
+    """
+    new_file_name_format: str | None = None
+    new_file_extension: str | None = None
+    x_dim: int | None = None
+    y_dim: int | None = None
+    bit_depth: int | None = None
+    copies: int = 1
+    copy_mode: str = 'copy'
+    dither: str = 'error-diffusion'
+    threshold: int = 128
+    strip_height: int | None = None
+    compression: str | None = None
+    rows_per_strip: int | None = None
+    resample: str | None = None
+    resize_mode: str = 'stretch'
+    volume_shape: tuple | None = None
+    volume_dtype: str = 'uint8'
+    swath: SwathLayout | None = None
+    output_directory: Path | None = None
+    statistics: bool = False
+
+    def get_layer_name(self, layer_number: int) -> str | None:
+        """
+        Returns the new file name for the given layer number, or None if the
+        original name style is being kept
+        """
+        if self.new_file_name_format is None:
+            return None
+        return self.new_file_name_format + '_' + str(layer_number).zfill(5)
+
+
+@dataclass(frozen=True)
+class LayerJob:
+    """
+    The conversion of one source image, numbered from layer_number onwards
+    page is set when the source is one page or Z slice of a volume file,
+    or one layer of a bed file, with the part slices it is composed of in
+    bed_layer
+    Picklable, so it can be sent to a worker process
+    """
+    source_path: Path
+    layer_number: int
+    options: ConversionOptions
+    page: int | None = None
+    bed_layer: BedLayer | None = None
+
+    @property
+    def source_name(self) -> str:
+        """
+        Identifies the source in the manifest, journal and metrics
+        """
+        if self.page is None:
+            return self.source_path.name
+        return f'{self.source_path.name}#{self.page}'
+
+    def read_page(self) -> Image.Image:
+        """
+        Reads the page of the volume the job converts into memory, or
+        composes the bed layer from its part slices
+        """
+        if self.bed_layer is not None:
+            return compose_bed_layer(self.bed_layer)
+        return read_volume_page(self.source_path, self.page, self.options.volume_shape,
+                                self.options.volume_dtype)
+
+    def get_output_groups(self) -> list[list[str]]:
+        """
+        Returns the file names the job saves, relative to the output folder,
+        without repeats
+        There is one group of copies for the whole layer, or one for the
+        swath of each head in its head folder, the first file of each group
+        is the one encoded and the rest are copied from it
+        """
+        extension = self.options.new_file_extension or self.source_path.suffix
+        source_stem = self.source_path.stem
+        if self.page is not None:
+            source_stem = f'{source_stem}_{self.page:05d}'
+        output_names = []
+        for layer_number in range(self.layer_number,
+                                  self.layer_number + self.options.copies):
+            file_name = self.options.get_layer_name(layer_number) or source_stem
+            if file_name + extension not in output_names:
+                output_names.append(file_name + extension)
+
+        if self.options.swath is None:
+            return [output_names]
+        return [[f'{HEAD_DIRECTORY_FORMAT.format(head + 1)}/{output_name}'
+                 for output_name in output_names]
+                for head in range(self.options.swath.heads)]
+
+    def get_output_names(self) -> list[str]:
+        """
+        Returns the file names the job saves, relative to the output folder,
+        without repeats
+        """
+        return [output_name for output_group in self.get_output_groups()
+                for output_name in output_group]
+
+
+def estimate_layer_memory(layer_info: LayerInfo, options: ConversionOptions) -> int:
+    """
+    Estimates the peak memory in bytes of converting a layer, from its
+    header and the conversion settings
+    The peak is taken as the largest set of images alive at once: the
+    source and resized image while resizing, the resized and converted
+    image plus dithering buffers while converting, and the converted image
+    and encoded file while saving, on top of the file contents
+    In strip mode only one strip of each image is alive at a time, but a
+    compressed source is still decoded in full first
+    """
+    width, height = layer_info.size
+    _, (new_width, new_height) = get_resized_size(layer_info.size, options.x_dim,
+                                                  options.y_dim, options.resize_mode)
+    output_mode = BIT_DEPTH_MODES.get(options.bit_depth, layer_info.mode)
+    source_pixel_bytes = PIXEL_BYTES.get(layer_info.mode, 4)
+    output_pixel_bytes = PIXEL_BYTES.get(output_mode, 4)
+
+    source = width * height * source_pixel_bytes
+    resized = new_width * new_height * source_pixel_bytes
+    converted = new_width * new_height * output_pixel_bytes
+    # Greyscale copy, tiled mask and comparison result of ordered dithering
+    dithering = new_width * new_height * 3 if output_mode == '1' else 0
+    encoded = (new_width * MODE_BITS.get(output_mode, 32) + 7) // 8 * new_height
+
+    peak = max(source + resized, resized + converted + dithering, converted + encoded)
+    if options.strip_height is not None:
+        peak = peak * min(options.strip_height / new_height, 1)
+        if not layer_info.streamable:
+            peak += source
+        return int(peak) + LAYER_MEMORY_OVERHEAD
+    return int(peak) + layer_info.file_size + LAYER_MEMORY_OVERHEAD
+
+
+def create_layer_convertor(job: LayerJob) -> ImageConvertor:
+    """
+    Returns an ImageConvertor for the source of a job, named for its first
+    layer
+    """
+    image_conversion = ImageConvertor(job.source_path)
+    if job.page is not None:
+        image_conversion.set_volume_page(job.page, job.options.volume_shape,
+                                         job.options.volume_dtype)
+    image_conversion.get_new_file_name(job.options.get_layer_name(job.layer_number))
+    image_conversion.get_new_file_extension(job.options.new_file_extension)
+    image_conversion.set_encoder_options(job.options.compression,
+                                         job.options.rows_per_strip)
+    image_conversion.set_output_directory(job.options.output_directory)
+    return image_conversion
+
+
+def transform_layer(job: LayerJob, data: bytes = None,
+                    layer_metrics: LayerMetrics = None) -> ImageConvertor:
+    """
+    Opens the source image of a job and applies the resize and bit depth
+    conversion
+    If the source file, or page of a volume or bed, has already been read,
+    it can be passed as data
+    When the layer is measured, the image is decoded in the open stage so
+    decoding is not counted as part of the later stages, and the ink
+    statistics of the converted image are added if the options ask for them
+    """
+    options = job.options
+
+    image_conversion = create_layer_convertor(job)
+    with time_stage(layer_metrics, 'open_image'):
+        if data is None and job.page is not None:
+            data = job.read_page()
+        image_conversion.open_image(data)
+        # 1 and 8 bit outputs only need the greyscale of a colour JPEG
+        image_conversion.draft(options.x_dim, options.y_dim, options.resize_mode,
+                               'L' if options.bit_depth in (1, 8) else None)
+        if layer_metrics is not None:
+            image_conversion.image.load()
+            width, height = image_conversion.image.size
+            layer_metrics.source_pixels = width * height
+            if job.page is not None:
+                layer_metrics.bytes_read = get_raw_size(image_conversion.image)
+    if options.x_dim is not None or options.y_dim is not None:
+        with time_stage(layer_metrics, 'resize'):
+            image_conversion.resize(options.x_dim, options.y_dim, options.resample,
+                                    options.resize_mode)
+    if options.bit_depth is not None:
+        with time_stage(layer_metrics, 'convert_image_depth'):
+            image_conversion.convert_image_depth(options.bit_depth, options.dither,
+                                                 options.threshold)
+
+    if layer_metrics is not None:
+        width, height = image_conversion.image.size
+        layer_metrics.output_pixels = width * height
+        if isinstance(data, bytes):
+            layer_metrics.bytes_read = len(data)
+        elif job.page is None:
+            layer_metrics.bytes_read = job.source_path.stat().st_size
+        if options.statistics:
+            with time_stage(layer_metrics, 'statistics'):
+                layer_metrics.statistics = get_layer_statistics(image_conversion.image)
+    return image_conversion
+
+
+def make_layer_copies(job: LayerJob, output_directory: Path,
+                      layer_metrics: LayerMetrics = None) -> list[Path]:
+    """
+    Creates the extra copies of a saved layer from the first output of each
+    output group
+    Returns the output paths in layer order, head by head
+    """
+    output_paths = []
+    for output_group in job.get_output_groups():
+        group_paths = [output_directory / output_name for output_name in output_group]
+        with time_stage(layer_metrics, 'copies'):
+            for output_path in group_paths[1:]:
+                copy_output_file(group_paths[0], output_path, job.options.copy_mode)
+
+        if layer_metrics is not None:
+            # Linked copies share the data of the first output
+            copies_written = len(group_paths) if job.options.copy_mode == 'copy' else 1
+            layer_metrics.bytes_written += group_paths[0].stat().st_size * copies_written
+        output_paths.extend(group_paths)
+    return output_paths
+
+
+def save_layer(job: LayerJob, image_conversion: ImageConvertor,
+               layer_metrics: LayerMetrics = None) -> list[Path]:
+    """
+    Saves a transformed layer, split into the swath of each head when the
+    job has a swath layout, then creates the extra copies
+    Returns the output paths in layer order, head by head
+    """
+    with time_stage(layer_metrics, 'save_file'):
+        if job.options.swath is None:
+            image_conversion.save_file()
+        else:
+            image_conversion.save_swaths(job.options.swath)
+    return make_layer_copies(job, image_conversion.get_output_directory(), layer_metrics)
+
+
+def encode_outputs(job: LayerJob, image_conversion: ImageConvertor,
+                   layer_metrics: LayerMetrics = None) -> list[bytes]:
+    """
+    Returns the encoded first file of each output group of a transformed
+    layer, split into the swath of each head when the job has a swath layout
+    """
+    with time_stage(layer_metrics, 'encode_file'):
+        if job.options.swath is not None:
+            return image_conversion.encode_swaths(job.options.swath)
+        return [image_conversion.encode_file()]
+
+
+def encode_layer(job: LayerJob, layer_metrics: LayerMetrics = None) -> list[bytes]:
+    """
+    Opens and transforms a single source image, returning its encoded
+    outputs instead of saving them, see encode_outputs
+    """
+    image_conversion = transform_layer(job, layer_metrics=layer_metrics)
+    return encode_outputs(job, image_conversion, layer_metrics)
+
+
+def convert_layer(job: LayerJob, layer_metrics: LayerMetrics = None) -> list[Path]:
+    """
+    Opens, transforms and saves a single source image, then creates the extra
+    copies from the saved file
+    Returns the output paths in layer order, head by head
+    """
+    options = job.options
+
+    if options.strip_height is not None:
+        image_conversion = create_layer_convertor(job)
+        statistics = None
+        if layer_metrics is not None and options.statistics:
+            statistics = layer_metrics.statistics = LayerStatistics()
+        with time_stage(layer_metrics, 'convert_strips'):
+            image_conversion.convert_strips(options.x_dim, options.y_dim,
+                                            options.bit_depth, options.dither,
+                                            options.threshold, options.strip_height,
+                                            statistics)
+        if layer_metrics is not None:
+            width, height = image_conversion.image.size
+            if job.page is None:
+                layer_metrics.bytes_read = job.source_path.stat().st_size
+            else:
+                layer_metrics.bytes_read = get_raw_size(image_conversion.image)
+            layer_metrics.source_pixels = width * height
+            layer_metrics.output_pixels = (options.x_dim or width) * (options.y_dim or height)
+        return make_layer_copies(job, image_conversion.get_output_directory(),
+                                 layer_metrics)
+
+    image_conversion = transform_layer(job, layer_metrics=layer_metrics)
+    return save_layer(job, image_conversion, layer_metrics)
+
+
+def run_profiled(profile_path: Path, function, *args):
+    """
+    Calls the function under cProfile, saving the profile to profile_path
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(profile_path)
+
+
+def measure_layer(job: LayerJob, profile_path: Path = None) -> LayerMetrics:
+    """
+    Converts a layer as convert_layer does, returning its measurements
+    Profiles the conversion if a profile_path is given
+    """
+    layer_metrics = LayerMetrics(job.layer_number, job.source_name)
+    if profile_path is None:
+        convert_layer(job, layer_metrics)
+    else:
+        run_profiled(profile_path, convert_layer, job, layer_metrics)
+    return layer_metrics
+
+
+def measure_encoded_layer(job: LayerJob,
+                          profile_path: Path = None) -> tuple[list[bytes], LayerMetrics]:
+    """
+    Encodes a layer as encode_layer does, returning its outputs and
+    measurements
+    Profiles the conversion if a profile_path is given
+    """
+    layer_metrics = LayerMetrics(job.layer_number, job.source_name)
+    if profile_path is None:
+        data = encode_layer(job, layer_metrics)
+    else:
+        data = run_profiled(profile_path, encode_layer, job, layer_metrics)
+    return data, layer_metrics
+
+
+class StackConvertor:
+    """
+    Collects the image stack from the specified location, and then converts
+    each in turn by creating an ImageConvertor object
+    The location is a folder of layer images, or a single multi-page TIFF,
+    NumPy .npy or raw volume whose pages or Z slices are the layers, read
+    one page at a time without unpacking the file; raw volumes need their
+    volume_shape (depth, height, width) and volume_dtype
+    It can also be a bed file placing several part stacks on one bed, see
+    BedIndex, and each bed layer is composed in memory as it is converted
+    Default number of copies is 1, this can be increased for more images
+    Each image is only converted once, the extra copies are made from the
+    first saved file using copy_mode ('copy', 'hardlink' or 'reflink')
+    dither and threshold choose how images are converted to 1 bit
+    Setting strip_height streams each image through in strips of that many
+    rows, writing TIFF files, to bound memory on very large layers, only
+    uncompressed BMP and TIFF sources are read a strip at a time, others
+    such as PNG and JPEG are still decoded in full
+    With more than one worker, the images are spread across a process pool
+    In every mode, layers that fail are collected in self.errors by layer
+    number and the rest of the stack is still converted
+    In pipeline mode, reading, converting and writing run at the same time
+    on separate threads, with workers setting the number of conversion
+    threads and queue_depth the number of layers waiting between stages
+    With deduplicate=True, identical layers are only converted once, the
+    others are copied using copy_mode, and self.dedup_stats reports the
+    saving
+    compression and rows_per_strip set the encoder options of each output,
+    see ImageConvertor.set_encoder_options
+    resample and resize_mode choose the resize filter and whether the aspect
+    ratio is kept, see ImageConvertor.resize
+    With a SwathLayout as swath, each converted layer is cut in memory into
+    the swath of each printhead, saved to a head_01, head_02... folder in
+    the output folder
+    With a memory_budget in bytes, the process pool and pipeline only start
+    a layer while the estimated memory of the layers in progress stays
+    within it, so fewer large layers run at once than small ones, with
+    workers as the upper limit, or the number of CPUs if workers is None
+    Passing a ConversionMetrics records the time spent in each stage of
+    every layer, with the bytes and pixels read and written
+    In incremental mode a manifest in the output folder records the source
+    and settings of every output, and only layers whose source or settings
+    have changed are converted again
+    Every finished layer is recorded in a journal in the output folder,
+    which is removed once the whole stack is converted, and resume=True
+    skips the layers an interrupted conversion already finished
+    watch() converts layers as they are written into the folder
+    Outputs are saved to a folder called Output next to the stack, or to
+    output_path; with an output_format of 'tar', 'zip' or 'zip-deflate'
+    they are streamed from memory into a single archive in layer order,
+    output.tar or output.zip by default, for quicker transfer to the
+    printer than many small files
+    With a .csv or .json statistics_path, the ink coverage, pixel count and
+    bounding box of every converted layer is counted while it is in memory
+    and saved there, see LayerStatistics; layers skipped because they were
+    finished by an interrupted run are left out
+    """
+
+
+    def __init__(self, path: str, new_file_name_format: str = None,
+                 new_file_extension: str = None, x_dim: int = None,
+                 y_dim: int = None, bit_depth: int = None, copies: int = 1,
+                 copy_mode: str = 'copy', workers: int = 1,
+                 dither: str = 'error-diffusion', threshold: int = 128,
+                 strip_height: int = None, incremental: bool = False,
+                 resume: bool = False, pipeline: bool = False,
+                 queue_depth: int = 4, deduplicate: bool = False,
+                 compression: str = None, rows_per_strip: int = None,
+                 metrics: ConversionMetrics = None, resample: str = None,
+                 resize_mode: str = 'stretch', memory_budget: int = None,
+                 volume_shape: tuple = None, volume_dtype: str = 'uint8',
+                 swath: SwathLayout = None, output_path: str = None,
+                 output_format: str = 'directory', statistics_path: str = None):
+        self.path = Path(path)
+        self.new_file_name_format = new_file_name_format
+        self.new_file_extension = new_file_extension
+        self.x_dim = x_dim
+        self.y_dim = y_dim
+        self.bit_depth = bit_depth
+        self.copies = copies
+        self.copy_mode = copy_mode
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.dither = dither
+        self.threshold = threshold
+        self.strip_height = strip_height
+        self.incremental = incremental
+        self.resume = resume
+        self.pipeline = pipeline
+        self.queue_depth = queue_depth
+        self.deduplicate = deduplicate
+        self.compression = compression
+        self.rows_per_strip = rows_per_strip
+        self.metrics = metrics
+        self.resample = resample
+        self.resize_mode = resize_mode
+        self.memory_budget = memory_budget
+        self.volume_shape = tuple(volume_shape) if volume_shape is not None else None
+        self.volume_dtype = volume_dtype
+        self.swath = swath
+        self.output_format = output_format
+        self.memory_tracker = None
+        self.profiled_layer = None
+        self.held_sources = set()
+        self.output_directory = self.path.parent / 'output'
+        self.output_path = self.output_directory.with_suffix(
+            OUTPUT_FORMATS.get(output_format, ''))
+        if output_path is not None:
+            self.output_path = Path(output_path)
+            if output_format == 'directory':
+                self.output_directory = self.output_path
+        self.output_sink = None
+        self.output_order = None
+        self.encoded_layers = {}
+        self.statistics_path = Path(statistics_path) if statistics_path is not None \
+            else None
+        # Layers are measured to collect their statistics
+        self.measure_layers = metrics is not None or statistics_path is not None
+        self.layer_statistics = {}
+        self.errors = {}
+        self.cancelled = False
+        self.completed_jobs = []
+        self.skipped_layers = 0
+        self.journal = None
+        self.journaled_jobs = set()
+        self.dedup_stats = DeduplicationStats()
+
+        if not self.path.exists():
+            raise FileNotFoundError(f'The specified path does not exist: {self.path}')
+
+        is_volume = self.path.is_file() and self.path.suffix.lower() in VOLUME_EXTENSIONS
+        is_bed = self.path.is_file() and self.path.suffix.lower() == BED_EXTENSION
+        if not self.path.is_dir() and not is_volume and not is_bed:
+            raise ValueError(f'{self.path} is not a valid directory, volume or bed file.')
+
+        if (is_bed or self.path.suffix.lower() in ('.npy', '.raw')) and \
+                new_file_extension is None:
+            raise ValueError('Layers of a NumPy, raw or bed file need a new file extension')
+
+        if is_bed and strip_height is not None:
+            raise ValueError('Bed layers are composed in memory, so cannot be '
+                             'converted in strips')
+
+        if self.volume_shape is not None and (
+                len(self.volume_shape) not in (3, 4) or
+                not all(isinstance(length, (int)) and length > 0
+                        for length in self.volume_shape)):
+            raise ValueError('Volume shape must be 3 or 4 positive, non-zero integers')
+
+        if volume_dtype not in VOLUME_DTYPES:
+            raise ValueError(f'Volume type must be one of {VOLUME_DTYPES}')
+
+        if not isinstance(copies, (int)) or copies <= 0:
+            raise ValueError('Copies must be a positive, non-zero integer')
+
+        if copy_mode not in COPY_MODES:
+            raise ValueError(f'Copy mode must be one of {COPY_MODES}')
+
+        if not isinstance(self.workers, (int)) or self.workers <= 0:
+            raise ValueError('Workers must be a positive, non-zero integer')
+
+        if memory_budget is not None and (not isinstance(memory_budget, (int))
+                                          or memory_budget <= 0):
+            raise ValueError('Memory budget must be a positive, non-zero integer')
+
+        if dither not in DITHER_METHODS:
+            raise ValueError(f'Dither method must be one of {DITHER_METHODS}')
+
+        if strip_height is not None and (new_file_extension or '').lower() \
+                not in ('.tif', '.tiff'):
+            raise ValueError('Strip conversion needs a .tif or .tiff file extension')
+
+        if pipeline and strip_height is not None:
+            raise ValueError('Pipeline mode cannot be combined with strip conversion')
+
+        if not isinstance(queue_depth, (int)) or queue_depth <= 0:
+            raise ValueError('Queue depth must be a positive, non-zero integer')
+
+        all_compressions = {option for options in COMPRESSION_OPTIONS.values()
+                            for option in options}
+        if compression is not None and compression not in all_compressions:
+            raise ValueError(f'Compression must be one of {sorted(all_compressions)}')
+
+        image_format = Image.registered_extensions().get((new_file_extension or '').lower())
+        if compression is not None and image_format is not None and \
+                compression not in COMPRESSION_OPTIONS.get(image_format, ('none',)):
+            raise ValueError(f'{compression} compression is not available for '
+                             f'{new_file_extension} files')
+
+        if strip_height is not None and compression not in (None, 'none'):
+            raise ValueError('Strip conversion only writes uncompressed TIFF files')
+
+        if rows_per_strip is not None and (not isinstance(rows_per_strip, (int))
+                                           or rows_per_strip <= 0):
+            raise ValueError('Rows per strip must be a positive, non-zero integer')
+
+        if resample is not None and resample not in RESAMPLE_FILTERS:
+            raise ValueError(f'Resample must be one of {list(RESAMPLE_FILTERS)}')
+
+        if resize_mode not in RESIZE_MODES:
+            raise ValueError(f'Resize mode must be one of {list(RESIZE_MODES)}')
+
+        if strip_height is not None and (resample is not None or resize_mode != 'stretch'):
+            raise ValueError('Strip conversion only resizes by whole number factors, '
+                             'without a choice of filter or resize mode')
+
+        if swath is not None and not isinstance(swath, SwathLayout):
+            raise TypeError('Swath must be a SwathLayout')
+
+        if swath is not None and strip_height is not None:
+            raise ValueError('Swath splitting cannot be combined with strip conversion')
+
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'Output format must be one of {list(OUTPUT_FORMATS)}')
+
+        if self.statistics_path is not None and \
+                self.statistics_path.suffix.lower() not in STATISTICS_EXTENSIONS:
+            raise ValueError(f'Statistics can be saved as {STATISTICS_EXTENSIONS} files')
+
+        if output_format != 'directory' and (incremental or resume or deduplicate or
+                                             strip_height is not None):
+            raise ValueError('Archives are written in one pass, so incremental, resumed, '
+                             'deduplicated and strip conversion need a directory output')
+
+        if is_volume:
+            self.stack_index = VolumeIndex(self.path, self.volume_shape, volume_dtype)
+        elif is_bed:
+            self.stack_index = BedIndex(self.path)
+        else:
+            self.stack_index = StackIndex(self.path)
+
+    def validate(self, max_workers: int = None) -> ValidationReport:
+        """
+        Reads the header of every layer, without decoding the pixel data, and
+        reports layers that cannot be read, do not match the most common size,
+        have a mode that cannot be converted, or are wider than the swaths
+        of the printheads cover
+        In strip mode it also lists the layers that are decoded in full
+        rather than read a band at a time, which strip_height does not
+        keep small
+        The projected output size assumes uncompressed output, and counts the
+        extra copies only when they are written as separate files
+        """
+        report = ValidationReport(layer_count=len(self.stack_index))
+        report.unreadable = self.stack_index.load_layer_info(max_workers)
+
+        # Layers are file paths, or page numbers for a volume
+        layer_infos = {layer: self.stack_index.layer_info[layer]
+                       for layer in self.stack_index
+                       if layer in self.stack_index.layer_info}
+        report.sizes = dict(Counter(layer_info.size for layer_info in layer_infos.values()))
+        if not report.sizes:
+            return report
+        expected_size = max(report.sizes, key=report.sizes.get)
+
+        copies_on_disk = self.copies if self.copy_mode == 'copy' else 1
+        extension = (self.new_file_extension or '').lower()
+
+        for layer, layer_info in layer_infos.items():
+            if layer_info.size != expected_size:
+                report.inconsistent_sizes.append(layer)
+            if self.strip_height is not None and not layer_info.streamable:
+                report.unstreamable_layers.append(layer)
+            if layer_info.mode not in MODE_BITS:
+                report.unexpected_modes.append(layer)
+                continue
+
+            _, (width, height) = get_resized_size(layer_info.size, self.x_dim, self.y_dim,
+                                                  self.resize_mode)
+            files = 1
+            if self.swath is not None:
+                if width > self.swath.get_covered_width():
+                    report.uncovered_layers.append(layer)
+                width, height = self.swath.get_swath_size(height)
+                files = self.swath.heads
+            bits = self.bit_depth or MODE_BITS[layer_info.mode]
+            row_bytes = (width * bits + 7) // 8
+            if extension == '.bmp' or (not extension and layer_info.format == 'BMP'):
+                row_bytes = (row_bytes + 3) & ~3
+            report.projected_output_bytes += row_bytes * height * copies_on_disk * files
+
+        return report
+
+    def get_conversion_options(self) -> ConversionOptions:
+        """
+        Collects the conversion settings into a single picklable object
+        """
+        return ConversionOptions(
+            new_file_name_format=self.new_file_name_format,
+            new_file_extension=self.new_file_extension,
+            x_dim=self.x_dim, y_dim=self.y_dim, bit_depth=self.bit_depth,
+            copies=self.copies, copy_mode=self.copy_mode,
+            dither=self.dither, threshold=self.threshold,
+            strip_height=self.strip_height, compression=self.compression,
+            rows_per_strip=self.rows_per_strip, resample=self.resample,
+            resize_mode=self.resize_mode, volume_shape=self.volume_shape,
+            volume_dtype=self.volume_dtype, swath=self.swath,
+            output_directory=self.output_directory,
+            statistics=self.statistics_path is not None)
+
+    def get_parameters_hash(self) -> str:
+        """
+        Returns a hash of the conversion settings, which changes whenever the
+        outputs would be different
+        """
+        options = json.dumps(asdict(self.get_conversion_options()), sort_keys=True,
+                             default=str)
+        return hashlib.sha256(options.encode()).hexdigest()
+
+    def get_layer_jobs(self) -> list[LayerJob]:
+        """
+        Creates a job for each image in the folder, numbering the layers in
+        natural sort order so each source image takes one layer per copy
+        For a volume there is a job for each page, in page order, and for a
+        bed a job for each bed layer
+        """
+        options = self.get_conversion_options()
+
+        if isinstance(self.stack_index, BedIndex):
+            return [LayerJob(self.path, 1 + layer * self.copies, options, layer,
+                             self.stack_index.get_bed_layer(layer))
+                    for layer in self.stack_index]
+        if isinstance(self.stack_index, VolumeIndex):
+            return [LayerJob(self.path, 1 + index * self.copies, options, page)
+                    for index, page in enumerate(self.stack_index)]
+        return [LayerJob(file_path, 1 + index * self.copies, options)
+                for index, file_path in enumerate(self.stack_index)]
+
+    def read_manifest(self) -> dict:
+        """
+        Returns the layers recorded by the last incremental conversion, by
+        source name
+        """
+        manifest_path = self.output_directory / MANIFEST_NAME
+        try:
+            with open(manifest_path) as manifest_file:
+                return json.load(manifest_file)['layers']
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def write_manifest(self, layers: dict):
+        """
+        Saves the manifest of converted layers, replacing the old one in a
+        single step so an interrupted write cannot corrupt it
+        """
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.output_directory / MANIFEST_NAME
+        temporary_path = manifest_path.with_name(manifest_path.name + '.tmp')
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump({'layers': layers}, manifest_file, indent=1)
+        os.replace(temporary_path, manifest_path)
+
+    def get_manifest_entry(self, job: LayerJob) -> dict:
+        """
+        Describes the source and settings that the outputs of a job come from
+        The pages of a volume share the signature of the volume file, so
+        every page is converted again when the file changes
+        Bed layers also record the signature of each part slice
+        """
+        stat = job.source_path.stat()
+        entry = {'source_mtime_ns': stat.st_mtime_ns,
+                 'source_size': stat.st_size,
+                 'parameters': self.get_parameters_hash(),
+                 'layer_number': job.layer_number,
+                 'outputs': job.get_output_names()}
+        if job.bed_layer is not None:
+            entry['parts'] = []
+            for _, source_path, page in job.bed_layer.part_slices:
+                part_stat = source_path.stat()
+                entry['parts'].append([str(source_path), page, part_stat.st_size,
+                                       part_stat.st_mtime_ns])
+        return entry
+
+    def convert_image_stack(self, progress_callback=None, cancel_event=None):
+        """
+        Runs through the specified folder, converting each image and saving
+        it as it goes
+        progress_callback is called with the number of source images done and
+        the total after each one finishes
+        Setting cancel_event (a threading.Event) stops the conversion once
+        the images already being converted are finished
+        In incremental mode, up to date layers are skipped and outputs that
+        are no longer part of the stack are deleted
+        When resuming, layers recorded in the journal are skipped
+        """
+        jobs = self.get_layer_jobs()
+        self.clear_results()
+
+        if self.output_format != 'directory':
+            self.convert_to_archive(jobs, progress_callback, cancel_event)
+            self.write_statistics(jobs)
+            return
+
+        self.output_sink = DirectoryOutput(self.output_directory)
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        journal_path = self.output_directory / JOURNAL_NAME
+        self.journaled_jobs = self.read_journal() if self.resume else set()
+
+        start = time.perf_counter()
+        with open(journal_path, 'a' if self.resume else 'w') as journal:
+            self.journal = journal
+            try:
+                if self.incremental:
+                    self.convert_incremental(jobs, progress_callback, cancel_event)
+                else:
+                    self.run_layer_jobs(self.skip_journaled_jobs(jobs),
+                                        progress_callback, cancel_event)
+            finally:
+                self.journal = None
+                if self.metrics is not None:
+                    self.metrics.wall_seconds += time.perf_counter() - start
+
+        if not self.errors and not self.cancelled:
+            journal_path.unlink()
+        self.write_statistics(jobs)
+
+    def write_statistics(self, jobs: list[LayerJob]):
+        """
+        Saves the ink statistics of the layers to statistics_path, see
+        save_statistics
+        """
+        if self.statistics_path is not None:
+            save_statistics(self.statistics_path, self.get_statistics_rows(jobs))
+
+    def get_statistics_rows(self, jobs: list[LayerJob]) -> list[dict]:
+        """
+        Returns the ink statistics of the converted jobs, one row per layer
+        so every copy is listed, with the columns in STATISTICS_FIELDS
+        """
+        rows = []
+        for job in jobs:
+            statistics = self.layer_statistics.get(job)
+            if statistics is None:
+                continue
+            left, top, right, bottom = statistics.bbox or (None,) * 4
+            for layer_number in range(job.layer_number, job.layer_number + job.options.copies):
+                rows.append({'layer': layer_number, 'source': job.source_name,
+                             'width': statistics.width, 'height': statistics.height,
+                             'ink_pixels': statistics.ink_pixels,
+                             'coverage': statistics.coverage,
+                             'ink_fraction': statistics.ink_fraction,
+                             'left': left, 'top': top, 'right': right, 'bottom': bottom})
+        return rows
+
+    def clear_results(self):
+        """
+        Forgets the outcome of the last conversion, before starting another
+        """
+        self.errors = {}
+        self.cancelled = False
+        self.completed_jobs = []
+        self.skipped_layers = 0
+        self.dedup_stats = DeduplicationStats()
+        self.layer_statistics = {}
+
+    def convert_layer_range(self, start: int, stop: int, progress_callback=None,
+                            cancel_event=None) -> list[LayerJob]:
+        """
+        Converts the layers of the stack from index start up to stop, named
+        and numbered as they are when the whole stack is converted, and
+        returns their jobs
+        Lets several workers share a stack, see binder_jet_distributed, so
+        the manifest, journal and statistics file are not written
+        """
+        if self.output_format != 'directory' or self.incremental or self.resume:
+            raise ValueError('Layer ranges can only be converted to a directory, '
+                             'without incremental or resumed conversion')
+
+        jobs = self.get_layer_jobs()[start:stop]
+        self.clear_results()
+        self.output_sink = DirectoryOutput(self.output_directory)
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        self.run_layer_jobs(jobs, progress_callback, cancel_event)
+        return jobs
+
+    def convert_to_archive(self, jobs: list[LayerJob], progress_callback=None,
+                           cancel_event=None):
+        """
+        Converts every job into a new archive at output_path, which replaces
+        the old one once all the layers are done
+        Layers that fail are left out, and a cancelled archive is discarded
+        """
+        start = time.perf_counter()
+        self.output_sink = open_output(self.output_path, self.output_format)
+        try:
+            self.run_layer_jobs(jobs, progress_callback, cancel_event)
+        except BaseException:
+            self.output_sink.discard()
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.wall_seconds += time.perf_counter() - start
+
+        if self.cancelled:
+            self.output_sink.discard()
+        else:
+            self.output_sink.close()
+
+    def convert_incremental(self, jobs: list[LayerJob], progress_callback=None,
+                            cancel_event=None):
+        """
+        Converts only the jobs whose source or settings changed since the
+        manifest was written, and deletes outputs no longer in the stack
+        """
+        old_layers = self.read_manifest()
+        layers = {}
+        pending = {}
+        for job in jobs:
+            if job.source_name in self.held_sources:
+                # Being rewritten, so its outputs are kept until it settles
+                if job.source_name in old_layers:
+                    layers[job.source_name] = old_layers[job.source_name]
+                continue
+            entry = self.get_manifest_entry(job)
+            old_entry = dict(old_layers.get(job.source_name, {}))
+            # The statistics of skipped layers are kept from the manifest
+            statistics = old_entry.pop('statistics', None)
+            if old_entry == entry and all(
+                    (self.output_directory / output_name).is_file()
+                    for output_name in entry['outputs']):
+                layers[job.source_name] = old_layers[job.source_name]
+                if statistics is not None:
+                    self.layer_statistics[job] = LayerStatistics(**statistics)
+            else:
+                pending[job] = entry
+        self.skipped_layers = len(layers)
+
+        current_outputs = {output_name for entry in [*layers.values(), *pending.values()]
+                           for output_name in entry['outputs']}
+        for entry in old_layers.values():
+            for output_name in set(entry.get('outputs', [])) - current_outputs:
+                (self.output_directory / output_name).unlink(missing_ok=True)
+
+        try:
+            self.run_layer_jobs(self.skip_journaled_jobs(list(pending)),
+                                progress_callback, cancel_event)
+        finally:
+            for job in self.completed_jobs:
+                layers[job.source_name] = pending[job]
+                if job in self.layer_statistics:
+                    pending[job]['statistics'] = asdict(self.layer_statistics[job])
+            self.write_manifest(layers)
+
+    def watch(self, poll_interval: float = 1.0, settle_time: float = 2.0,
+              idle_timeout: float = None, progress_callback=None,
+              cancel_event=None):
+        """
+        Polls the folder and converts layers as they are written, numbering
+        them in natural sort order as convert_image_stack does
+        A file is converted once its size and modification time have not
+        changed for settle_time seconds
+        Each batch is converted incrementally, so a restarted watch skips
+        the layers that are already done, and a finished layer that is
+        rewritten keeps its place in the stack until it settles again
+        Stops when cancel_event is set, or once no file has changed for
+        idle_timeout seconds after every file has been converted
+        """
+        if isinstance(self.stack_index, (VolumeIndex, BedIndex)):
+            raise ValueError('Only folders of layer images can be watched')
+
+        if self.output_format != 'directory':
+            raise ValueError('Watched folders can only be converted to a directory')
+
+        if not isinstance(poll_interval, (int, float)) or poll_interval <= 0:
+            raise ValueError('Poll interval must be a positive, non-zero number')
+
+        if not isinstance(settle_time, (int, float)) or settle_time < 0:
+            raise ValueError('Settle time must be a positive number')
+
+        self.incremental = True
+        # Layers converted by an earlier watch are settled if unchanged
+        file_signatures = {self.path / source_name: ((entry['source_size'],
+                                                     entry['source_mtime_ns']),
+                                                    float('-inf'))
+                           for source_name, entry in self.read_manifest().items()}
+        indexed_files = set()
+        converted_state = None
+        last_change = time.monotonic()
+
+        while cancel_event is None or not cancel_event.is_set():
+            now = time.monotonic()
+            stack_index = StackIndex(self.path)
+            previous_signatures = file_signatures
+            file_signatures = {}
+            stable_files = set()
+            for file_path in stack_index:
+                try:
+                    stat = file_path.stat()
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                previous_signature, unchanged_since = previous_signatures.get(
+                    file_path, (None, now))
+                if previous_signature != signature:
+                    unchanged_since = last_change = now
+                file_signatures[file_path] = (signature, unchanged_since)
+                if stat.st_size and now - unchanged_since >= settle_time:
+                    stable_files.add(file_path)
+
+            # Files that settled before stay in the index while rewritten
+            indexed_files = stable_files | (indexed_files & set(file_signatures))
+            stack_index.files = [file_path for file_path in stack_index
+                                 if file_path in indexed_files]
+            self.held_sources = {file_path.name for file_path in indexed_files - stable_files}
+
+            state = (tuple(stack_index.files), frozenset(self.held_sources),
+                     frozenset(file_signatures[file_path][0] for file_path in stable_files))
+            if state != converted_state and stack_index.files:
+                stack_index.layer_info = self.stack_index.layer_info
+                self.stack_index = stack_index
+                self.convert_image_stack(progress_callback, cancel_event)
+                converted_state = state
+
+            if idle_timeout is not None and stable_files and \
+                    len(stable_files) == len(file_signatures) and \
+                    now - last_change >= idle_timeout:
+                break
+
+            if cancel_event is not None:
+                cancel_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+
+        self.held_sources = set()
+
+    def get_journal_key(self, job: LayerJob) -> str:
+        """
+        Identifies a job in the journal by its layer, source and settings
+        """
+        return f'{job.layer_number}:{job.source_name}:{self.get_parameters_hash()}'
+
+    def read_journal(self) -> set:
+        """
+        Returns the keys of the jobs recorded in the journal, ignoring a
+        last line that was only partly written
+        """
+        try:
+            with open(self.output_directory / JOURNAL_NAME) as journal:
+                return {line.rstrip('\n') for line in journal if line.endswith('\n')}
+        except OSError:
+            return set()
+
+    def record_completed_job(self, job: LayerJob):
+        """
+        Marks the job as finished, appending it to the journal and flushing
+        it to disk straight away
+        """
+        self.completed_jobs.append(job)
+        if self.journal is not None:
+            self.journal.write(self.get_journal_key(job) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def skip_journaled_jobs(self, jobs: list[LayerJob]) -> list[LayerJob]:
+        """
+        Returns the jobs still to do, counting the ones the journal records
+        as finished, with all their outputs present, as completed
+        """
+        remaining = []
+        for job in jobs:
+            if self.get_journal_key(job) in self.journaled_jobs and all(
+                    (self.output_directory / output_name).is_file()
+                    for output_name in job.get_output_names()):
+                self.record_completed_job(job)
+                self.skipped_layers += 1
+            else:
+                remaining.append(job)
+        return remaining
+
+    def run_layer_jobs(self, jobs: list[LayerJob], progress_callback=None,
+                       cancel_event=None):
+        """
+        Converts each job, in this process, in a pipeline or across the
+        process pool, recording the jobs that succeed
+        When deduplicating, sources with identical contents are converted
+        once and the other layers are copied from the first one's outputs
+        """
+        duplicate_sources = {}
+        if self.deduplicate:
+            jobs, duplicate_sources = self.find_duplicate_sources(jobs)
+
+        self.memory_tracker = None
+        if self.memory_budget is not None:
+            self.memory_tracker = MemoryBudget(self.memory_budget)
+
+        # Archives are written in layer order
+        self.output_order = deque(jobs) if self.output_format != 'directory' else None
+        self.encoded_layers = {}
+
+        self.profiled_layer = None
+        if self.metrics is not None and self.metrics.profile_path is not None and jobs:
+            self.profiled_layer = self.metrics.profile_layer
+            if self.profiled_layer is None:
+                self.profiled_layer = jobs[len(jobs) // 2].layer_number
+
+        if self.pipeline:
+            self.run_pipeline(jobs, progress_callback, cancel_event)
+        elif self.workers == 1:
+            self.run_serial(jobs, progress_callback, cancel_event)
+        else:
+            self.run_process_pool(jobs, progress_callback, cancel_event)
+
+        completed_jobs = set(self.completed_jobs)
+        for job, original_job in duplicate_sources.items():
+            if original_job not in completed_jobs:
+                continue
+            try:
+                self.copy_duplicate_layer(job, original_job)
+            except OSError as error:
+                self.finish_layer(job, error)
+            else:
+                self.finish_layer(job, encoded=False)
+
+    def find_duplicate_sources(self, jobs: list[LayerJob]) -> tuple[list, dict]:
+        """
+        Hashes the contents of each source file, returning the jobs with a
+        unique source, and the others mapped to the job with the same source
+        The pages of a volume are compared by their stored data, and bed
+        layers by the position and source of each part slice, so nothing is
+        decoded here
+        """
+        unique_jobs = []
+        duplicate_sources = {}
+        jobs_by_hash = {}
+        # Each part slice is usually printed in several bed layers
+        slice_hashes = {}
+        for job in jobs:
+            if job.bed_layer is not None:
+                source_hash = hashlib.blake2b(f'{job.bed_layer.size}'.encode())
+                for placement, source_path, page in job.bed_layer.part_slices:
+                    if (source_path, page) not in slice_hashes:
+                        slice_hashes[source_path, page] = get_file_hash(source_path) \
+                            if page is None else get_page_hash(
+                                source_path, page, placement.volume_shape,
+                                placement.volume_dtype)
+                    source_hash.update(f'{placement.x},{placement.y}'.encode())
+                    source_hash.update(slice_hashes[source_path, page])
+                source_digest = source_hash.digest()
+            elif job.page is not None:
+                source_digest = get_page_hash(job.source_path, job.page,
+                                              job.options.volume_shape,
+                                              job.options.volume_dtype)
+            else:
+                source_digest = get_file_hash(job.source_path)
+            original_job = jobs_by_hash.setdefault(source_digest, job)
+            if original_job is job:
+                unique_jobs.append(job)
+            else:
+                duplicate_sources[job] = original_job
+        return unique_jobs, duplicate_sources
+
+    def copy_duplicate_layer(self, job: LayerJob, original_job: LayerJob):
+        """
+        Creates the outputs of job by copying the first outputs of an
+        identical layer that has already been saved
+        """
+        for output_group, original_group in zip(job.get_output_groups(),
+                                                original_job.get_output_groups()):
+            original_output_path = self.output_directory / original_group[0]
+            first_output_path = self.output_directory / output_group[0]
+            if first_output_path != original_output_path:
+                copy_output_file(original_output_path, first_output_path,
+                                 job.options.copy_mode)
+        make_layer_copies(job, self.output_directory)
+        if original_job in self.layer_statistics:
+            self.layer_statistics[job] = self.layer_statistics[original_job]
+
+    def finish_layer(self, job: LayerJob, error: Exception = None,
+                     encoded: bool = True, layer_metrics: LayerMetrics = None):
+        """
+        Records the outcome of a job, adding its outputs to the deduplication
+        statistics and its measurements to the metrics if it succeeded
+        encoded is False for layers copied from an identical layer
+        """
+        if error is not None:
+            self.errors[job.layer_number] = error
+            return
+        if self.metrics is not None and layer_metrics is not None:
+            self.metrics.add_layer(layer_metrics)
+        if layer_metrics is not None and layer_metrics.statistics is not None:
+            self.layer_statistics[job] = layer_metrics.statistics
+        # Count the copies of the layer, not the file of every head
+        self.dedup_stats.layers += len(job.get_output_groups()[0])
+        if encoded:
+            self.dedup_stats.encoded_layers += 1
+        self.record_completed_job(job)
+
+    def finish_encoded_layer(self, job: LayerJob, data: list[bytes] = None,
+                             error: Exception = None, layer_metrics: LayerMetrics = None):
+        """
+        Writes the encoded first file of each output group of a job to the
+        output with its copies, and records the outcome
+        Archives are written in layer order, so a job that finishes early is
+        held until every job before it has finished
+        """
+        self.encoded_layers[job] = (data, error, layer_metrics)
+        while self.encoded_layers:
+            next_job = job if self.output_order is None else self.output_order[0]
+            if next_job not in self.encoded_layers:
+                return
+            if self.output_order is not None:
+                self.output_order.popleft()
+            data, error, layer_metrics = self.encoded_layers.pop(next_job)
+            if error is None:
+                try:
+                    for output_group, file_data in zip(next_job.get_output_groups(), data):
+                        self.output_sink.write_group(output_group, file_data,
+                                                     next_job.options.copy_mode,
+                                                     layer_metrics)
+                except OSError as write_error:
+                    error = write_error
+            self.finish_layer(next_job, error, layer_metrics=layer_metrics)
+
+    def estimate_job_memory(self, job: LayerJob) -> int:
+        """
+        Returns the estimated peak memory of converting a job, using the
+        cached header of its source
+        Sources whose header cannot be read only count the fixed overhead,
+        their error is reported when they are converted
+        """
+        try:
+            layer_info = self.stack_index.get_layer_info(
+                job.source_path if job.page is None else job.page)
+        except (OSError, EOFError, SyntaxError, Image.DecompressionBombError):
+            return LAYER_MEMORY_OVERHEAD
+        return estimate_layer_memory(layer_info, job.options)
+
+    def get_profile_path(self, job: LayerJob) -> Path | None:
+        """
+        Returns where to save the profile of the job, or None if it is not
+        the layer being profiled
+        """
+        if job.layer_number != self.profiled_layer:
+            return None
+        return self.metrics.profile_path
+
+    def run_serial(self, jobs: list[LayerJob], progress_callback=None,
+                   cancel_event=None):
+        """
+        Converts the jobs one after another in this process, collecting any
+        errors by layer number
+        When deduplicating, layers whose converted pixels match an earlier
+        layer are copied instead of being encoded again
+        """
+        saved_pixels = {}
+        for layers_done, job in enumerate(jobs, 1):
+            if cancel_event is not None and cancel_event.is_set():
+                self.cancelled = True
+                return
+
+            try:
+                self.convert_serial_job(job, saved_pixels)
+            except LAYER_ERRORS as error:
+                if self.output_order is not None:
+                    self.finish_encoded_layer(job, error=error)
+                else:
+                    self.finish_layer(job, error)
+
+            if progress_callback is not None:
+                progress_callback(layers_done, len(jobs))
+
+    def convert_serial_job(self, job: LayerJob, saved_pixels: dict):
+        """
+        Converts a single job in this process and records its outcome
+        saved_pixels maps the pixel hash of each layer saved so far to its
+        job, for deduplication
+        """
+        if self.deduplicate and job.options.strip_height is None:
+            layer_metrics = None
+            if self.measure_layers:
+                layer_metrics = LayerMetrics(job.layer_number, job.source_name)
+            profile_path = self.get_profile_path(job) if layer_metrics else None
+            if profile_path is None:
+                image_conversion = transform_layer(job, layer_metrics=layer_metrics)
+            else:
+                image_conversion = run_profiled(profile_path, transform_layer,
+                                                job, None, layer_metrics)
+            original_job = saved_pixels.setdefault(
+                get_pixel_hash(image_conversion.image), job)
+            if original_job is job:
+                save_layer(job, image_conversion, layer_metrics)
+                self.finish_layer(job, layer_metrics=layer_metrics)
+            else:
+                self.copy_duplicate_layer(job, original_job)
+                self.finish_layer(job, encoded=False)
+        elif self.output_order is not None:
+            if self.measure_layers:
+                data, layer_metrics = measure_encoded_layer(job,
+                                                            self.get_profile_path(job))
+            else:
+                data, layer_metrics = encode_layer(job), None
+            self.finish_encoded_layer(job, data, layer_metrics=layer_metrics)
+        elif self.measure_layers:
+            self.finish_layer(job, layer_metrics=measure_layer(
+                job, self.get_profile_path(job)))
+        else:
+            convert_layer(job)
+            self.finish_layer(job)
+
+    def run_process_pool(self, jobs: list[LayerJob], progress_callback=None,
+                         cancel_event=None):
+        """
+        Spreads the jobs across a pool of worker processes, collecting any
+        errors by layer number
+        With a memory budget, jobs are submitted in order only while their
+        estimated memory fits alongside the jobs already running
+        For an archive, the workers return the encoded outputs and this
+        process writes them, with at most ARCHIVE_LAYERS_PER_WORKER layers
+        per worker converted or held past the next layer to write
+        """
+        waiting_jobs = deque(jobs)
+        running = {}
+        layers_done = 0
+
+        def submit_jobs():
+            while waiting_jobs:
+                if self.output_order is not None and \
+                        len(running) + len(self.encoded_layers) >= \
+                        self.workers * ARCHIVE_LAYERS_PER_WORKER:
+                    return
+                job = waiting_jobs[0]
+                memory = 0
+                if self.memory_tracker is not None:
+                    memory = self.estimate_job_memory(job)
+                    if len(running) >= self.workers or \
+                            not self.memory_tracker.try_acquire(memory):
+                        return
+                waiting_jobs.popleft()
+                if self.output_order is not None and self.measure_layers:
+                    future = executor.submit(measure_encoded_layer, job,
+                                             self.get_profile_path(job))
+                elif self.output_order is not None:
+                    future = executor.submit(encode_layer, job)
+                elif self.measure_layers:
+                    future = executor.submit(measure_layer, job, self.get_profile_path(job))
+                else:
+                    future = executor.submit(convert_layer, job)
+                running[future] = (job, memory)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            submit_jobs()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, memory = running.pop(future)
+                    if self.memory_tracker is not None:
+                        self.memory_tracker.release(memory)
+                    error = future.exception()
+                    data = layer_metrics = None
+                    if error is None and self.output_order is not None:
+                        data = future.result()
+                        if self.measure_layers:
+                            data, layer_metrics = data
+                    elif error is None and self.measure_layers:
+                        layer_metrics = future.result()
+
+                    if self.output_order is not None:
+                        self.finish_encoded_layer(job, data, error, layer_metrics)
+                    else:
+                        self.finish_layer(job, error, layer_metrics=layer_metrics)
+                    layers_done += 1
+                    if progress_callback is not None:
+                        progress_callback(layers_done, len(jobs))
+                if cancel_event is not None and cancel_event.is_set():
+                    self.cancelled = True
+                    executor.shutdown(cancel_futures=True)
+                    return
+                submit_jobs()
+
+    def run_pipeline(self, jobs: list[LayerJob], progress_callback=None,
+                     cancel_event=None):
+        """
+        Converts the jobs in a streaming pipeline: a reader thread loads the
+        source files, worker threads decode, transform and encode them, and
+        this thread writes the outputs
+        The bounded queues between the stages let disk access overlap with
+        processing, while capping how many layers are held in memory
+        When deduplicating, only the first layer with each set of converted
+        pixels is encoded, and the rest are copied once it is written
+        """
+        read_queue = queue.Queue(self.queue_depth)
+        write_queue = queue.Queue(self.queue_depth)
+        pixel_owners = {}
+        pixel_owners_lock = threading.Lock()
+        job_memory = {}
+
+        def read_sources():
+            for job in jobs:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                if self.memory_tracker is not None:
+                    job_memory[job] = self.estimate_job_memory(job)
+                    if not self.memory_tracker.acquire(job_memory[job], cancel_event):
+                        break
+                layer_metrics = None
+                if self.measure_layers:
+                    layer_metrics = LayerMetrics(job.layer_number, job.source_name)
+                try:
+                    with time_stage(layer_metrics, 'read'):
+                        if job.bed_layer is not None:
+                            # Composed by the conversion threads, as it
+                            # decodes every part slice
+                            data = None
+                        elif job.page is not None:
+                            data = job.read_page()
+                        else:
+                            data = job.source_path.read_bytes()
+                    read_queue.put((job, data, None, layer_metrics))
+                except (OSError, EOFError, SyntaxError, ValueError) as error:
+                    read_queue.put((job, None, error, layer_metrics))
+            for _ in range(self.workers):
+                read_queue.put(None)
+
+        def transform_source(job, data, layer_metrics):
+            # Returns the encoded first file of each output group, or None
+            # for a duplicate, and its pixel hash when deduplicating
+            image_conversion = transform_layer(job, data, layer_metrics)
+            pixel_hash = None
+            if self.deduplicate:
+                pixel_hash = get_pixel_hash(image_conversion.image)
+                with pixel_owners_lock:
+                    if pixel_owners.setdefault(pixel_hash, job) is not job:
+                        return None, pixel_hash
+            return encode_outputs(job, image_conversion, layer_metrics), pixel_hash
+
+        def transform_sources():
+            while (item := read_queue.get()) is not None:
+                job, data, error, layer_metrics = item
+                pixel_hash = None
+                if error is None:
+                    try:
+                        profile_path = self.get_profile_path(job)
+                        if profile_path is None:
+                            data, pixel_hash = transform_source(job, data, layer_metrics)
+                        else:
+                            data, pixel_hash = run_profiled(profile_path, transform_source,
+                                                            job, data, layer_metrics)
+                    except Exception as transform_error:
+                        data = None
+                        error = transform_error
+                write_queue.put((job, data, error, pixel_hash, layer_metrics))
+            write_queue.put(None)
+
+        threads = [threading.Thread(target=read_sources, daemon=True)]
+        threads += [threading.Thread(target=transform_sources, daemon=True)
+                    for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        # Duplicates can arrive before the layer they copy has been written,
+        # so they wait for it, keyed by pixel hash
+        written_pixels = {}
+        waiting_duplicates = {}
+        finished_workers = 0
+        layers_done = 0
+
+        def finish(job, data=None, error=None, encoded=True, layer_metrics=None):
+            nonlocal layers_done
+            if self.memory_tracker is not None:
+                self.memory_tracker.release(job_memory.pop(job))
+            if encoded:
+                self.finish_encoded_layer(job, data, error, layer_metrics)
+            else:
+                self.finish_layer(job, error, encoded=False)
+            layers_done += 1
+            if progress_callback is not None:
+                progress_callback(layers_done, len(jobs))
+
+        def copy_from(job, original):
+            # original is the job that wrote the pixels, or the error it hit
+            error = original if isinstance(original, Exception) else None
+            if error is None:
+                try:
+                    self.copy_duplicate_layer(job, original)
+                except OSError as copy_error:
+                    error = copy_error
+            finish(job, error=error, encoded=False)
+
+        while finished_workers < self.workers:
+            item = write_queue.get()
+            if item is None:
+                finished_workers += 1
+                continue
+            job, data, error, pixel_hash, layer_metrics = item
+
+            if error is None and data is None:
+                if pixel_hash in written_pixels:
+                    copy_from(job, written_pixels[pixel_hash])
+                else:
+                    waiting_duplicates.setdefault(pixel_hash, []).append(job)
+                continue
+
+            finish(job, data, error, layer_metrics=layer_metrics)
+
+            if pixel_hash is not None:
+                written_pixels[pixel_hash] = self.errors.get(job.layer_number, job)
+                for duplicate_job in waiting_duplicates.pop(pixel_hash, []):
+                    copy_from(duplicate_job, written_pixels[pixel_hash])
+
+        for thread in threads:
+            thread.join()
+        if layers_done < len(jobs):
+            self.cancelled = True
@@ -1,13 +1,48 @@
+import csv
+import io
+import json
 import os
+import pstats
+import shutil
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+import numpy as np
 import pytest
 from pathlib import Path
 from PIL import Image
-from binder_jet_convertor import ImageConvertor, StackConvertor 
+from binder_jet_convertor import (ARCHIVE_LAYERS_PER_WORKER, LAYER_MEMORY_OVERHEAD,
+                                  RESAMPLE_FILTERS,
+                                  ArchiveOutput, ConversionMetrics, ConversionOptions, DeduplicationStats,
+                                  ImageConvertor, LayerInfo, LayerStatistics,
+                                  MemoryBudget,
+                                  StackConvertor, StackIndex, SwathLayout,
+                                  BedIndex, VolumeIndex,
+                                  StripTiffWriter, bayer_matrix, binarise,
+                                  compose_bed_layer, encode_bmp_rle8,
+                                  estimate_layer_memory, get_page_hash,
+                                  get_layer_statistics, get_resized_size,
+                                  iter_image_bands,
+                                  read_volume_page, split_swaths)
 
 TEST_IMAGES_DIR = Path('test_image_directory')
 TEST_SINGLE_IMAGE_DIR = Path('test_image_single_directory')
 
 
+def make_stack(tmp_path, names):
+    """
+    Copies the test png into a new stack directory under the names given
+    """
+    stack_directory = tmp_path / 'stack'
+    stack_directory.mkdir()
+    for name in names:
+        shutil.copyfile(TEST_SINGLE_IMAGE_DIR / 'test_image.png',
+                        stack_directory / name)
+    return stack_directory
+
+
 class TestImageConvertor:
 
     def test_init_with_valid_path(self):
@@ -420,3 +455,1617 @@ class TestStackConvertor:
         os.remove(expected_output_path_5)
         output_image_6.close()
         os.remove(expected_output_path_6)
+
+    def test_invalid_copy_mode(self):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, copy_mode='symlink')
+
+    def test_copies_hardlink(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice.png'])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp',
+                                         copies=3, copy_mode='hardlink')
+        stack_convertor.convert_image_stack()
+
+        output_directory = tmp_path / 'output'
+        outputs = sorted(output_directory.iterdir())
+        assert [file.name for file in outputs] == ['Layer_00001.bmp',
+                                                   'Layer_00002.bmp',
+                                                   'Layer_00003.bmp']
+        assert outputs[0].stat().st_ino == outputs[2].stat().st_ino
+
+    def test_copies_identical_bytes(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice.png'])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.tiff',
+                                         40, 50, 1, 2, copy_mode='reflink')
+        stack_convertor.convert_image_stack()
+
+        output_directory = tmp_path / 'output'
+        first = (output_directory / 'Layer_00001.tiff').read_bytes()
+        second = (output_directory / 'Layer_00002.tiff').read_bytes()
+        assert first == second
+
+    def test_conv_zero_workers(self):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, workers=0)
+
+    def test_parallel_matches_serial_naming(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png', 'c.png'])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.tiff', 40,
+                                         50, 1, 2, workers=2)
+        stack_convertor.convert_image_stack()
+
+        output_directory = tmp_path / 'output'
+        names = sorted(file.name for file in output_directory.iterdir())
+        assert names == [f'Layer_0000{number}.tiff' for number in range(1, 7)]
+        assert stack_convertor.errors == {}
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_collects_errors(self, tmp_path, workers):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        (stack_directory / 'b.png').write_bytes(b'not an image')
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.tiff',
+                                         workers=workers)
+        stack_convertor.convert_image_stack()
+
+        assert len(stack_convertor.errors) == 1
+        assert [file.name for file in (tmp_path / 'output').glob('*.tiff')] == \
+            ['Layer_00001.tiff']
+
+    def test_progress_callback(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png', 'c.png'])
+        progress = []
+        StackConvertor(stack_directory, 'Layer', '.png').convert_image_stack(
+            lambda done, total: progress.append((done, total)))
+        assert progress == [(1, 3), (2, 3), (3, 3)]
+
+    def test_cancel_after_current_layer(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png', 'c.png'])
+        cancel_event = threading.Event()
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.png')
+        stack_convertor.convert_image_stack(lambda done, total: cancel_event.set(),
+                                            cancel_event)
+        assert stack_convertor.cancelled
+        assert [file.name for file in (tmp_path / 'output').glob('*.png')] == \
+            ['Layer_00001.png']
+
+
+class TestStackIndex:
+
+    def test_natural_sort_order(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_10.png', 'slice_2.png',
+                                                'slice_1.png'])
+        stack_index = StackIndex(stack_directory)
+        assert [file.name for file in stack_index] == ['slice_1.png',
+                                                       'slice_2.png',
+                                                       'slice_10.png']
+
+    def test_ignores_non_images(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png'])
+        (stack_directory / 'notes.txt').write_text('not a layer')
+        (stack_directory / 'subfolder.png').mkdir()
+        assert len(StackIndex(stack_directory)) == 1
+
+    def test_layer_info_cached(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png'])
+        stack_index = StackIndex(stack_directory)
+        assert stack_index.load_layer_info() == {}
+
+        layer_info = stack_index.get_layer_info(stack_directory / 'slice_1.png')
+        assert layer_info.format == 'PNG'
+        assert layer_info.size == Image.open(layer_info.path).size
+        assert layer_info is stack_index.layer_info[layer_info.path]
+
+    def test_stack_numbered_in_natural_order(self, tmp_path):
+        stack_directory = tmp_path / 'stack'
+        stack_directory.mkdir()
+        for number in (1, 2, 10):
+            Image.new('L', (number, 5)).save(stack_directory / f'slice_{number}.png')
+
+        StackConvertor(stack_directory, 'Layer', '.png').convert_image_stack()
+
+        output_directory = tmp_path / 'output'
+        widths = [Image.open(output_directory / f'Layer_0000{number}.png').size[0]
+                  for number in (1, 2, 3)]
+        assert widths == [1, 2, 10]
+
+
+class TestValidation:
+
+    def test_valid_stack(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png'])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 40,
+                                         50, 1, 2)
+        report = stack_convertor.validate()
+        assert report.is_valid
+        assert report.layer_count == 2
+        # 40 px at 1 bit is 5 bytes, padded to 8 per BMP row
+        assert report.projected_output_bytes == 8 * 50 * 2 * 2
+
+    def test_reports_problems(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png'])
+        Image.new('L', (3, 3)).save(stack_directory / 'slice_3.png')
+        Image.new('I', (3, 3)).save(stack_directory / 'slice_4.tif')
+        (stack_directory / 'slice_5.png').write_bytes(b'not an image')
+
+        report = StackConvertor(stack_directory).validate()
+        assert not report.is_valid
+        assert [file.name for file in report.unreadable] == ['slice_5.png']
+        assert sorted(file.name for file in report.inconsistent_sizes) == \
+            ['slice_3.png', 'slice_4.tif']
+        assert [file.name for file in report.unexpected_modes] == ['slice_4.tif']
+
+
+class TestBinarise:
+
+    def test_threshold(self):
+        image = Image.fromarray(np.array([[0, 127, 128, 255]], dtype=np.uint8))
+        binary = binarise(image, 'threshold', 128)
+        assert binary.mode == '1'
+        assert list(np.asarray(binary)[0]) == [False, False, True, True]
+
+    def test_bayer_matrix_order_2(self):
+        assert bayer_matrix(2).tolist() == [[31, 159], [223, 95]]
+
+    def test_bayer_matrix_invalid_order(self):
+        with pytest.raises(ValueError):
+            bayer_matrix(6)
+
+    @pytest.mark.parametrize('method', ['bayer', 'blue-noise'])
+    def test_ordered_coverage(self, method):
+        grey = Image.new('L', (128, 96), 64)
+        white = np.asarray(binarise(grey, method))
+        assert white.mean() == pytest.approx(0.25, abs=0.01)
+        assert np.asarray(binarise(Image.new('L', (9, 9), 255), method)).all()
+        assert not np.asarray(binarise(Image.new('L', (9, 9), 0), method)).any()
+
+    def test_y_offset_continues_pattern(self):
+        grey = Image.fromarray(np.tile(np.arange(0, 256, 4, dtype=np.uint8), (16, 1)))
+        whole = np.asarray(binarise(grey, 'bayer'))
+        lower = np.asarray(binarise(grey.crop((0, 5, 64, 16)), 'bayer', y_offset=5))
+        assert (whole[5:] == lower).all()
+
+    def test_invalid_method(self):
+        with pytest.raises(ValueError):
+            binarise(Image.new('L', (4, 4)), 'atkinson')
+
+    def test_image_convertor_dither(self):
+        image_convertor = ImageConvertor(TEST_IMAGES_DIR / 'test_image.jpg')
+        image_convertor.open_image()
+        image_convertor.convert_image_depth(1, dither='bayer')
+        assert image_convertor.image.mode == '1'
+
+
+def random_image(mode, size, seed=0):
+    """
+    Creates an image of random noise in the given mode
+    """
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 4),
+                                                  dtype=np.uint8)
+    return Image.fromarray(pixels, 'RGBA').convert(mode)
+
+
+class TestStripConversion:
+
+    @pytest.mark.parametrize('mode', ['1', 'L', 'RGB', 'RGBA'])
+    def test_strip_writer_round_trip(self, tmp_path, mode):
+        image = random_image(mode, (37, 23))
+        output_path = tmp_path / 'strips.tif'
+        with open(output_path, 'wb') as output_file, \
+                StripTiffWriter(output_file, image.size, mode, 5) as writer:
+            for top in range(0, image.height, 5):
+                writer.write_strip(image.crop((0, top, image.width,
+                                               min(top + 5, image.height))))
+
+        with Image.open(output_path) as written:
+            assert written.mode == mode
+            assert written.tobytes() == image.tobytes()
+
+    @pytest.mark.parametrize('extension', ['.bmp', '.tif', '.png'])
+    def test_bands_cover_image(self, tmp_path, extension):
+        image = random_image('RGB', (31, 20))
+        image_path = tmp_path / ('image' + extension)
+        image.save(image_path)
+
+        with Image.open(image_path) as opened:
+            bands = list(iter_image_bands(opened, 6))
+        assert [top for top, _ in bands] == [0, 6, 12, 18]
+        assembled = Image.new('RGB', image.size)
+        for top, band in bands:
+            assembled.paste(band, (0, top))
+        assert assembled.tobytes() == image.tobytes()
+
+    def test_compressed_layers_reported_in_strip_mode(self, tmp_path):
+        stack_directory = tmp_path / 'stack'
+        stack_directory.mkdir()
+        image = random_image('L', (40, 30))
+        image.save(stack_directory / '1.png')
+        image.save(stack_directory / '2.bmp')
+        image.save(stack_directory / '3.tif', compression='tiff_lzw')
+        image.save(stack_directory / '4.tif')
+        report = StackConvertor(stack_directory, 'Layer', '.tif',
+                                strip_height=8).validate()
+        assert report.is_valid
+        assert [file.name for file in report.unstreamable_layers] == ['1.png', '3.tif']
+        assert StackConvertor(stack_directory, 'Layer', '.tif').validate() \
+            .unstreamable_layers == []
+
+    def test_convert_strips_reduce(self, tmp_path):
+        image = random_image('L', (40, 30))
+        image_path = tmp_path / 'stack' / 'image.bmp'
+        image_path.parent.mkdir()
+        image.save(image_path)
+
+        image_convertor = ImageConvertor(image_path)
+        image_convertor.get_new_file_extension('.tif')
+        image_convertor.convert_strips(20, 15, 8, strip_height=4)
+
+        with Image.open(tmp_path / 'output' / 'image.tif') as written:
+            assert written.size == (20, 15)
+            assert written.tobytes() == image.reduce(2).tobytes()
+
+    def test_convert_strips_fractional_scale(self):
+        image_convertor = ImageConvertor(TEST_IMAGES_DIR / 'test_image.png')
+        image_convertor.get_new_file_extension('.tif')
+        with pytest.raises(ValueError):
+            image_convertor.convert_strips(7, 7)
+
+    def test_convert_strips_needs_tiff(self):
+        image_convertor = ImageConvertor(TEST_IMAGES_DIR / 'test_image.png')
+        with pytest.raises(ValueError):
+            image_convertor.convert_strips()
+
+    def test_stack_strip_height_needs_tiff(self):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, 'Layer', '.bmp', strip_height=64)
+
+    def test_stack_strips(self, tmp_path):
+        stack_directory = tmp_path / 'stack'
+        stack_directory.mkdir()
+        random_image('L', (64, 48)).save(stack_directory / 'slice_1.bmp')
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.tif', 128,
+                                         96, 1, dither='bayer', strip_height=16)
+        stack_convertor.convert_image_stack()
+
+        with Image.open(tmp_path / 'output' / 'Layer_00001.tif') as written:
+            assert written.size == (128, 96)
+            assert written.mode == '1'
+
+
+class TestIncrementalConversion:
+
+    def test_no_op_rerun_skips_layers(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp',
+                       incremental=True).convert_image_stack()
+        output_path = tmp_path / 'output' / 'Layer_00001.bmp'
+        modified = output_path.stat().st_mtime_ns
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp',
+                                         incremental=True)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.skipped_layers == 2
+        assert stack_convertor.completed_jobs == []
+        assert output_path.stat().st_mtime_ns == modified
+
+    def test_changed_source_reconverted(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp',
+                       incremental=True).convert_image_stack()
+
+        Image.new('L', (8, 8)).save(stack_directory / 'slice_2.png')
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp',
+                                         incremental=True)
+        stack_convertor.convert_image_stack()
+        assert [job.source_path.name for job in stack_convertor.completed_jobs] == \
+            ['slice_2.png']
+        assert Image.open(tmp_path / 'output' / 'Layer_00002.bmp').size == (8, 8)
+
+    def test_changed_settings_reconverted(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp',
+                       incremental=True).convert_image_stack()
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 10,
+                                         10, incremental=True)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.skipped_layers == 0
+        assert Image.open(tmp_path / 'output' / 'Layer_00001.bmp').size == (10, 10)
+
+    def test_stale_outputs_removed(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp', copies=2,
+                       incremental=True).convert_image_stack()
+        (tmp_path / 'output' / 'unrelated.txt').write_text('keep')
+
+        StackConvertor(stack_directory, 'Layer', '.bmp',
+                       incremental=True).convert_image_stack()
+        names = sorted(file.name for file in (tmp_path / 'output').iterdir()
+                       if not file.name.startswith('.'))
+        assert names == ['Layer_00001.bmp', 'Layer_00002.bmp', 'unrelated.txt']
+
+
+class TestResumableConversion:
+
+    def test_journal_removed_when_complete(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp').convert_image_stack()
+        assert [file.name for file in (tmp_path / 'output').iterdir()] == \
+            ['Layer_00001.bmp']
+
+    def test_resume_after_cancel(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png',
+                                                'slice_3.png'])
+        cancel_event = threading.Event()
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp')
+        stack_convertor.convert_image_stack(
+            lambda done, total: done == 2 and cancel_event.set(), cancel_event)
+        assert (tmp_path / 'output' / '.binder_jet_journal').is_file()
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp',
+                                         resume=True)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.skipped_layers == 2
+        assert [job.layer_number for job in stack_convertor.completed_jobs] == \
+            [1, 2, 3]
+        assert sorted(file.name for file in (tmp_path / 'output').iterdir()) == \
+            ['Layer_00001.bmp', 'Layer_00002.bmp', 'Layer_00003.bmp']
+
+    def test_resume_with_changed_settings_redoes_layers(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png'])
+        cancel_event = threading.Event()
+        StackConvertor(stack_directory, 'Layer', '.bmp').convert_image_stack(
+            lambda done, total: cancel_event.set(), cancel_event)
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 10,
+                                         10, resume=True)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.skipped_layers == 0
+        assert Image.open(tmp_path / 'output' / 'Layer_00001.bmp').size == (10, 10)
+
+    def test_save_leaves_no_temporary_file(self, tmp_path):
+        image_path = make_stack(tmp_path, ['slice.png']) / 'slice.png'
+        image_convertor = ImageConvertor(image_path)
+        image_convertor.open_image()
+        image_convertor.get_new_file_extension('.bmp')
+        image_convertor.save_file()
+        assert [file.name for file in (tmp_path / 'output').iterdir()] == \
+            ['slice.bmp']
+
+    def test_failed_save_keeps_previous_file(self, tmp_path):
+        image_path = make_stack(tmp_path, ['slice.png']) / 'slice.png'
+        image_convertor = ImageConvertor(image_path)
+        image_convertor.open_image()
+        image_convertor.get_new_file_extension('.bmp')
+        image_convertor.save_file()
+        previous = (tmp_path / 'output' / 'slice.bmp').read_bytes()
+
+        image_convertor.image = Image.new('I;16', (4, 4))
+        with pytest.raises(OSError):
+            image_convertor.save_file()
+        assert (tmp_path / 'output' / 'slice.bmp').read_bytes() == previous
+        assert len(list((tmp_path / 'output').iterdir())) == 1
+
+
+class TestPipelineConversion:
+
+    def test_pipeline_matches_serial(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png', 'c.png'])
+        StackConvertor(stack_directory, 'Layer', '.tiff', 40, 50, 1, 2,
+                       dither='bayer').convert_image_stack()
+        serial = {file.name: file.read_bytes()
+                  for file in (tmp_path / 'output').iterdir()}
+        shutil.rmtree(tmp_path / 'output')
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.tiff', 40,
+                                         50, 1, 2, workers=3, dither='bayer',
+                                         pipeline=True, queue_depth=1)
+        stack_convertor.convert_image_stack()
+        pipelined = {file.name: file.read_bytes()
+                     for file in (tmp_path / 'output').iterdir()}
+        assert pipelined == serial
+        assert len(stack_convertor.completed_jobs) == 3
+
+    def test_pipeline_collects_errors(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'c.png'])
+        (stack_directory / 'b.png').write_bytes(b'not an image')
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.png',
+                                         pipeline=True)
+        stack_convertor.convert_image_stack()
+        assert list(stack_convertor.errors) == [2]
+        assert sorted(file.name for file in (tmp_path / 'output').glob('*.png')) == \
+            ['Layer_00001.png', 'Layer_00003.png']
+
+    def test_pipeline_cancel(self, tmp_path):
+        stack_directory = make_stack(tmp_path, [f'slice_{number}.png'
+                                                for number in range(10)])
+        cancel_event = threading.Event()
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.png',
+                                         pipeline=True, queue_depth=1)
+        stack_convertor.convert_image_stack(lambda done, total: cancel_event.set(),
+                                            cancel_event)
+        assert stack_convertor.cancelled
+        assert len(stack_convertor.completed_jobs) < 10
+
+    def test_pipeline_with_strips(self):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, 'Layer', '.tif', pipeline=True,
+                           strip_height=16)
+
+
+class TestDeduplication:
+
+    def make_mixed_stack(self, tmp_path):
+        """
+        Stack of five layers: two copies of the test png, two blank layers
+        saved with different settings, and one other layer
+        """
+        stack_directory = make_stack(tmp_path, ['slice_1.png', 'slice_2.png'])
+        Image.new('L', (40, 50), 0).save(stack_directory / 'slice_3.png')
+        Image.new('L', (40, 50), 0).save(stack_directory / 'slice_4.png',
+                                         compress_level=0)
+        random_image('L', (40, 50)).save(stack_directory / 'slice_5.png')
+        return stack_directory
+
+    @pytest.mark.parametrize('settings', [{}, {'pipeline': True, 'workers': 2},
+                                          {'workers': 2}])
+    def test_dedup_matches_full_conversion(self, tmp_path, settings):
+        stack_directory = self.make_mixed_stack(tmp_path)
+        StackConvertor(stack_directory, 'Layer', '.bmp', 40, 50, 1,
+                       dither='threshold').convert_image_stack()
+        expected = {file.name: file.read_bytes()
+                    for file in (tmp_path / 'output').iterdir()}
+        shutil.rmtree(tmp_path / 'output')
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 40,
+                                         50, 1, dither='threshold',
+                                         deduplicate=True, **settings)
+        stack_convertor.convert_image_stack()
+        deduplicated = {file.name: file.read_bytes()
+                        for file in (tmp_path / 'output').iterdir()}
+        assert deduplicated == expected
+        assert stack_convertor.errors == {}
+        assert stack_convertor.dedup_stats.layers == 5
+
+    def test_dedup_ratio(self, tmp_path):
+        stack_directory = self.make_mixed_stack(tmp_path)
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp',
+                                         copies=2, deduplicate=True)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.dedup_stats.layers == 10
+        assert stack_convertor.dedup_stats.encoded_layers == 3
+        assert stack_convertor.dedup_stats.ratio == pytest.approx(10 / 3)
+
+    def test_dedup_hardlinks_duplicates(self, tmp_path):
+        stack_directory = self.make_mixed_stack(tmp_path)
+        StackConvertor(stack_directory, 'Layer', '.bmp', copy_mode='hardlink',
+                       deduplicate=True).convert_image_stack()
+        output_directory = tmp_path / 'output'
+        assert (output_directory / 'Layer_00001.bmp').stat().st_ino == \
+            (output_directory / 'Layer_00002.bmp').stat().st_ino
+
+
+class TestCompression:
+
+    def make_convertor(self, extension, bit_depth, compression, rows_per_strip=None):
+        image_convertor = ImageConvertor(TEST_IMAGES_DIR / 'test_image.png')
+        image_convertor.open_image()
+        image_convertor.convert_image_depth(bit_depth)
+        image_convertor.get_new_file_extension(extension)
+        image_convertor.set_encoder_options(compression, rows_per_strip)
+        return image_convertor
+
+    @pytest.mark.parametrize('compression, tiff_compression',
+                             [('none', 'raw'), ('packbits', 'packbits'),
+                              ('lzw', 'tiff_lzw'), ('group4', 'group4')])
+    def test_tiff_compression_round_trip(self, compression, tiff_compression):
+        image_convertor = self.make_convertor('.tif', 1, compression)
+        with Image.open(io.BytesIO(image_convertor.encode_file())) as image:
+            assert image.info['compression'] == tiff_compression
+            assert np.array_equal(np.asarray(image), np.asarray(image_convertor.image))
+
+    def test_group4_smaller_than_uncompressed(self):
+        uncompressed = self.make_convertor('.tif', 1, 'none').encode_file()
+        compressed = self.make_convertor('.tif', 1, 'group4').encode_file()
+        assert len(compressed) < len(uncompressed)
+
+    def test_group4_needs_1_bit(self):
+        image_convertor = self.make_convertor('.tif', 8, 'group4')
+        with pytest.raises(ValueError):
+            image_convertor.encode_file()
+
+    @pytest.mark.parametrize('bit_depth, compression', [(1, 'packbits'), (1, 'none'),
+                                                        (8, 'none')])
+    def test_rows_per_strip(self, bit_depth, compression):
+        image_convertor = self.make_convertor('.tif', bit_depth, compression,
+                                              rows_per_strip=16)
+        with Image.open(io.BytesIO(image_convertor.encode_file())) as image:
+            assert image.tag_v2[278] == 16
+            assert len(image.tag_v2[273]) == -(-image.height // 16)
+            assert image.mode == image_convertor.image.mode
+            assert image.tobytes() == image_convertor.image.tobytes()
+
+    def test_compression_not_available_for_format(self):
+        image_convertor = self.make_convertor('.png', 8, 'group4')
+        with pytest.raises(ValueError):
+            image_convertor.encode_file()
+
+    @pytest.mark.parametrize('mode', ['L', 'P'])
+    def test_rle8_round_trip(self, mode):
+        noise = random_image(mode, (300, 20))
+        # Runs of 7 pixels, with some rows of runs longer than 255 pixels
+        pixels = np.repeat(np.asarray(noise)[:, :43], 7, axis=1)[:, :300].copy()
+        pixels[3:9, 10:290] = 5
+        image = Image.fromarray(pixels, mode)
+        if mode == 'P':
+            image.putpalette(noise.getpalette())
+        data = encode_bmp_rle8(image)
+        assert struct.unpack_from('<I', data, 30)[0] == 1
+        with Image.open(io.BytesIO(data)) as decoded:
+            assert decoded.size == image.size
+            assert np.array_equal(np.asarray(decoded.convert('RGB')),
+                                  np.asarray(image.convert('RGB')))
+
+    def test_rle8_noise_stored_uncompressed(self):
+        image = random_image('L', (1000, 100))
+        data = encode_bmp_rle8(image)
+        assert struct.unpack_from('<I', data, 30)[0] == 0
+        assert len(data) <= 14 + 40 + 1024 + 1000 * 100
+        with Image.open(io.BytesIO(data)) as decoded:
+            assert decoded.tobytes() == image.tobytes()
+
+    def test_rle8_needs_8_bit(self):
+        with pytest.raises(ValueError):
+            encode_bmp_rle8(Image.new('RGB', (4, 4)))
+
+    def test_stack_written_compressed(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        StackConvertor(stack_directory, 'Layer', '.tif', bit_depth=1,
+                       compression='group4', rows_per_strip=32).convert_image_stack()
+        for file in (tmp_path / 'output').glob('*.tif'):
+            with Image.open(file) as image:
+                assert image.info['compression'] == 'group4'
+
+    def test_stack_rle8_bmp(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp', bit_depth=8,
+                       compression='rle8').convert_image_stack()
+        with Image.open(tmp_path / 'output' / 'Layer_00001.bmp') as image:
+            assert image.info['compression'] == 1
+
+    @pytest.mark.parametrize('settings', [{'compression': 'jpeg'},
+                                          {'compression': 'rle8', 'new_file_extension': '.tif'},
+                                          {'compression': 'group4', 'strip_height': 64,
+                                           'new_file_extension': '.tif'},
+                                          {'rows_per_strip': 0}])
+    def test_invalid_compression_settings(self, settings):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, **settings)
+
+
+class TestMetrics:
+
+    @pytest.mark.parametrize('settings, stages', [
+        ({}, {'open_image', 'resize', 'convert_image_depth', 'save_file', 'copies'}),
+        ({'workers': 2}, {'open_image', 'resize', 'convert_image_depth', 'save_file',
+                          'copies'}),
+        ({'pipeline': True, 'workers': 2}, {'read', 'open_image', 'resize',
+                                            'convert_image_depth', 'encode_file',
+                                            'write_output_file', 'copies'})])
+    def test_stages_recorded(self, tmp_path, settings, stages):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png', 'c.png'])
+        metrics = ConversionMetrics()
+        StackConvertor(stack_directory, 'Layer', '.bmp', 40, 50, 8, copies=2,
+                       metrics=metrics, **settings).convert_image_stack()
+
+        assert sorted(metrics.layers) == [1, 3, 5]
+        for layer_metrics in metrics.layers.values():
+            assert set(layer_metrics.stage_seconds) == stages
+            assert layer_metrics.output_pixels == 40 * 50
+        source_bytes = (TEST_SINGLE_IMAGE_DIR / 'test_image.png').stat().st_size
+        output_bytes = sum(file.stat().st_size
+                           for file in (tmp_path / 'output').glob('*.bmp'))
+        summary = metrics.get_summary()
+        assert summary['bytes_read'] == 3 * source_bytes
+        assert summary['bytes_written'] == output_bytes
+        assert summary['wall_seconds'] > 0
+
+    def test_linked_copies_not_counted_as_written(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        metrics = ConversionMetrics()
+        StackConvertor(stack_directory, 'Layer', '.bmp', copies=3, copy_mode='hardlink',
+                       metrics=metrics).convert_image_stack()
+        assert metrics.layers[1].bytes_written == \
+            (tmp_path / 'output' / 'Layer_00001.bmp').stat().st_size
+
+    def test_failed_layers_not_recorded(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        (stack_directory / 'b.png').write_bytes(b'not an image')
+        metrics = ConversionMetrics()
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', workers=2,
+                                         metrics=metrics)
+        stack_convertor.convert_image_stack()
+        assert list(stack_convertor.errors) == [2]
+        assert list(metrics.layers) == [1]
+
+    @pytest.mark.parametrize('settings', [{}, {'workers': 2},
+                                          {'pipeline': True, 'workers': 2}])
+    def test_profile_one_layer(self, tmp_path, settings):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png', 'c.png'])
+        profile_path = tmp_path / 'layer.prof'
+        metrics = ConversionMetrics(profile_path=profile_path)
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', bit_depth=1,
+                                         metrics=metrics, **settings)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.profiled_layer == 2
+        assert pstats.Stats(str(profile_path)).total_calls > 0
+
+    def test_write_json(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        metrics = ConversionMetrics()
+        StackConvertor(stack_directory, 'Layer', '.bmp', bit_depth=8,
+                       metrics=metrics).convert_image_stack()
+        metrics.write_json(tmp_path / 'metrics.json', include_layers=True)
+
+        summary = json.loads((tmp_path / 'metrics.json').read_text())
+        assert summary['layers'] == 2
+        assert set(summary['stages']['save_file']) == {'total_seconds', 'mean_seconds',
+                                                       'max_seconds'}
+        assert [layer['layer_number'] for layer in summary['layer_metrics']] == [1, 2]
+
+
+class TestResampling:
+
+    def open_array(self, tmp_path, pixels, extension='.png', **save_options):
+        image_path = tmp_path / f'layer{extension}'
+        Image.fromarray(pixels).save(image_path, **save_options)
+        image_convertor = ImageConvertor(image_path)
+        image_convertor.open_image()
+        return image_convertor
+
+    def test_box_reduce_matches_box_resize(self, tmp_path):
+        pixels = np.asarray(random_image('L', (400, 200)))
+        image_convertor = self.open_array(tmp_path, pixels)
+        image_convertor.resize(100, 50, 'box')
+        expected = Image.fromarray(pixels).resize((100, 50), Image.Resampling.BOX)
+        difference = np.abs(np.asarray(image_convertor.image, dtype=int)
+                            - np.asarray(expected, dtype=int))
+        assert difference.max() <= 1
+
+    def test_nearest_keeps_binary_edges(self, tmp_path):
+        pixels = np.zeros((200, 400), dtype=np.uint8)
+        pixels[40:160, 100:300] = 255
+        image_convertor = self.open_array(tmp_path, pixels)
+        image_convertor.resize(100, 50, 'nearest')
+        assert set(np.unique(np.asarray(image_convertor.image))) == {0, 255}
+
+    @pytest.mark.parametrize('resample', [None, 'bilinear', 'bicubic', 'lanczos'])
+    def test_reduced_resample_close_to_full(self, tmp_path, resample):
+        # Smooth content, as the reduced resample only approximates noise
+        pixels = np.asarray(random_image('L', (50, 25)).resize((400, 200)))
+        image_convertor = self.open_array(tmp_path, pixels)
+        image_convertor.resize(100, 50, resample)
+        full = Image.fromarray(pixels).resize((100, 50), RESAMPLE_FILTERS.get(
+            resample, Image.Resampling.BICUBIC))
+        difference = np.abs(np.asarray(image_convertor.image, dtype=int)
+                            - np.asarray(full, dtype=int))
+        assert difference.mean() < 2
+
+    def test_jpeg_decoded_at_reduced_size(self, tmp_path):
+        pixels = np.asarray(random_image('RGB', (800, 400)))
+        image_convertor = self.open_array(tmp_path, pixels, '.jpg')
+        image_convertor.draft(200, 100, mode='L')
+        assert image_convertor.image.size == (200, 100)
+        assert image_convertor.image.mode == 'L'
+        image_convertor.resize(150, 75)
+        assert image_convertor.image.size == (150, 75)
+
+    def test_draft_ignored_once_loaded(self, tmp_path):
+        image_convertor = self.open_array(tmp_path, np.zeros((400, 800, 3), np.uint8),
+                                          '.jpg')
+        image_convertor.image.load()
+        image_convertor.draft(200, 100)
+        assert image_convertor.image.size == (800, 400)
+
+    @pytest.mark.parametrize('x_dim, y_dim, resize_mode, expected', [
+        (100, 100, 'stretch', ((100, 100), (100, 100))),
+        (100, None, 'stretch', ((100, 200), (100, 200))),
+        (100, 100, 'fit', ((100, 50), (100, 50))),
+        (None, 100, 'fit', ((200, 100), (200, 100))),
+        (100, 100, 'pad', ((100, 50), (100, 100))),
+        (None, None, 'fit', ((400, 200), (400, 200))),
+        (None, None, 'pad', ((400, 200), (400, 200)))])
+    def test_resized_size(self, x_dim, y_dim, resize_mode, expected):
+        assert get_resized_size((400, 200), x_dim, y_dim, resize_mode) == expected
+
+    @pytest.mark.parametrize('resize_mode', ['fit', 'pad'])
+    def test_fit_without_dimensions_keeps_size(self, tmp_path, resize_mode):
+        stack_directory = tmp_path / 'stack'
+        stack_directory.mkdir()
+        Image.new('L', (60, 30), 200).save(stack_directory / 'a.jpg')
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp',
+                                         resize_mode=resize_mode)
+        assert stack_convertor.validate().is_valid
+        stack_convertor.convert_image_stack()
+        with Image.open(tmp_path / 'output' / 'Layer_00001.bmp') as image:
+            assert image.size == (60, 30)
+
+    def test_pad_centres_image(self, tmp_path):
+        image_convertor = self.open_array(tmp_path, np.full((200, 400), 255, np.uint8))
+        image_convertor.resize(100, 100, resize_mode='pad')
+        pixels = np.asarray(image_convertor.image)
+        assert pixels.shape == (100, 100)
+        assert (pixels[:25] == 0).all() and (pixels[75:] == 0).all()
+        assert (pixels[25:75] == 255).all()
+
+    def test_invalid_resample(self, tmp_path):
+        image_convertor = self.open_array(tmp_path, np.zeros((20, 20), np.uint8))
+        with pytest.raises(ValueError):
+            image_convertor.resize(10, 10, 'sinc')
+        with pytest.raises(ValueError):
+            image_convertor.resize(10, 10, resize_mode='crop')
+
+    def test_stack_fit_and_pad(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 300, 300,
+                                         resample='lanczos', resize_mode='pad')
+        assert stack_convertor.validate().projected_output_bytes > 0
+        stack_convertor.convert_image_stack()
+        with Image.open(tmp_path / 'output' / 'Layer_00001.bmp') as image:
+            assert image.size == (300, 300)
+
+    @pytest.mark.parametrize('settings', [{'resample': 'sinc'}, {'resize_mode': 'crop'},
+                                          {'resize_mode': 'fit', 'strip_height': 64,
+                                           'new_file_extension': '.tif'}])
+    def test_invalid_stack_settings(self, settings):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, **settings)
+
+
+class TestWatch:
+
+    def start_watch(self, stack_convertor, **settings):
+        cancel_event = threading.Event()
+        thread = threading.Thread(target=stack_convertor.watch, daemon=True,
+                                  kwargs={'poll_interval': 0.02, 'settle_time': 0.1,
+                                          'cancel_event': cancel_event, **settings})
+        thread.start()
+        return thread, cancel_event
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.02)
+
+    def test_layers_converted_as_they_arrive(self, tmp_path):
+        stack_directory = tmp_path / 'stack'
+        stack_directory.mkdir()
+        output_directory = tmp_path / 'output'
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 40, 50, 8)
+        thread, _ = self.start_watch(stack_convertor, idle_timeout=0.5)
+
+        for layer_number in range(1, 4):
+            shutil.copyfile(TEST_SINGLE_IMAGE_DIR / 'test_image.png',
+                            stack_directory / f'slice{layer_number}.png')
+            self.wait_for(lambda layer_number=layer_number:
+                          (output_directory / f'Layer_{layer_number:05d}.bmp').is_file())
+        thread.join(10)
+        assert not thread.is_alive()
+        assert sorted(file.name for file in output_directory.glob('*.bmp')) == \
+            ['Layer_00001.bmp', 'Layer_00002.bmp', 'Layer_00003.bmp']
+
+    def test_waits_for_file_to_be_written(self, tmp_path):
+        stack_directory = tmp_path / 'stack'
+        stack_directory.mkdir()
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp')
+        data = (TEST_SINGLE_IMAGE_DIR / 'test_image.png').read_bytes()
+        thread, cancel_event = self.start_watch(stack_convertor)
+
+        with open(stack_directory / 'slice1.png', 'wb') as layer_file:
+            for start in range(0, len(data), len(data) // 10):
+                layer_file.write(data[start:start + len(data) // 10])
+                layer_file.flush()
+                time.sleep(0.03)
+                assert not (tmp_path / 'output' / 'Layer_00001.bmp').exists()
+        self.wait_for(lambda: (tmp_path / 'output' / 'Layer_00001.bmp').is_file())
+        cancel_event.set()
+        thread.join(10)
+        assert stack_convertor.errors == {}
+
+    def test_restart_keeps_converted_layers(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['1.png', '2.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp').watch(
+            poll_interval=0.02, settle_time=0.05, idle_timeout=0.1)
+        output_path = tmp_path / 'output' / 'Layer_00002.bmp'
+        modified = output_path.stat().st_mtime_ns
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp')
+        stack_convertor.watch(poll_interval=0.02, settle_time=5, idle_timeout=0.1)
+        assert output_path.stat().st_mtime_ns == modified
+        assert stack_convertor.skipped_layers == 2
+
+    def test_rewritten_layer_keeps_its_place(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['1.png', '2.png', '3.png'])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp')
+        thread, cancel_event = self.start_watch(stack_convertor, settle_time=0.3)
+        output_directory = tmp_path / 'output'
+        self.wait_for(lambda: (output_directory / 'Layer_00003.bmp').is_file())
+        third_modified = (output_directory / 'Layer_00003.bmp').stat().st_mtime_ns
+
+        Image.new('RGB', (30, 20), 'white').save(stack_directory / '2.png')
+        time.sleep(0.1)
+        assert (output_directory / 'Layer_00002.bmp').is_file()
+        self.wait_for(lambda: Image.open(output_directory / 'Layer_00002.bmp').size
+                      == (30, 20))
+        cancel_event.set()
+        thread.join(10)
+        assert (output_directory / 'Layer_00003.bmp').stat().st_mtime_ns == third_modified
+
+    @pytest.mark.parametrize('settings', [{'poll_interval': 0}, {'settle_time': -1}])
+    def test_invalid_settings(self, settings):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR).watch(**settings)
+
+
+class TestMemoryBudget:
+
+    def get_options(self, **settings):
+        return ConversionOptions('Layer', '.bmp', **settings)
+
+    def get_layer_info(self, size, mode, streamable=False):
+        return LayerInfo(Path('layer.png'), size, mode, 'PNG', 1000, streamable)
+
+    def test_estimate_scales_with_size(self):
+        options = self.get_options()
+        small = estimate_layer_memory(self.get_layer_info((1000, 1000), 'L'), options)
+        large = estimate_layer_memory(self.get_layer_info((4000, 4000), 'L'), options)
+        assert small > LAYER_MEMORY_OVERHEAD
+        assert large - LAYER_MEMORY_OVERHEAD == \
+            pytest.approx(16 * (small - LAYER_MEMORY_OVERHEAD), rel=0.01)
+
+    def test_estimate_depends_on_mode_and_settings(self):
+        layer_info = self.get_layer_info((2000, 1000), 'RGB')
+        full = estimate_layer_memory(layer_info, self.get_options())
+        assert estimate_layer_memory(self.get_layer_info((2000, 1000), 'L'),
+                                     self.get_options()) < full
+        assert estimate_layer_memory(layer_info, self.get_options(
+            x_dim=500, y_dim=250)) < full
+        streamed = estimate_layer_memory(self.get_layer_info((2000, 1000), 'RGB', True),
+                                         self.get_options(strip_height=10))
+        assert streamed - LAYER_MEMORY_OVERHEAD < (full - LAYER_MEMORY_OVERHEAD) / 10
+
+    def test_compressed_strips_decoded_in_full(self):
+        strips = estimate_layer_memory(self.get_layer_info((2000, 1000), 'RGB'),
+                                       self.get_options(strip_height=10))
+        assert strips - LAYER_MEMORY_OVERHEAD > 2000 * 1000 * 4
+
+    def test_budget_admits_oversized_work_when_idle(self):
+        budget = MemoryBudget(100)
+        assert budget.try_acquire(500)
+        assert not budget.try_acquire(1)
+        budget.release(500)
+        assert budget.try_acquire(60)
+        assert budget.try_acquire(40)
+        assert not budget.try_acquire(1)
+        assert budget.peak_running == 2
+
+    def test_acquire_waits_for_release(self):
+        budget = MemoryBudget(100)
+        budget.try_acquire(80)
+        timer = threading.Timer(0.1, budget.release, [80])
+        timer.start()
+        assert budget.acquire(50)
+        assert budget.in_use == 50
+        timer.join()
+
+    def test_acquire_cancelled(self):
+        budget = MemoryBudget(100)
+        budget.try_acquire(80)
+        cancel_event = threading.Event()
+        cancel_event.set()
+        assert not budget.acquire(50, cancel_event)
+        assert budget.in_use == 80
+
+    @pytest.mark.parametrize('pipeline', [False, True])
+    def test_budget_limits_concurrent_layers(self, tmp_path, pipeline):
+        stack_directory = make_stack(tmp_path, [f'{number}.png' for number in range(4)])
+        StackConvertor(stack_directory, 'Layer', '.bmp', 40, 50, 8).convert_image_stack()
+        expected = {file.name: file.read_bytes()
+                    for file in (tmp_path / 'output').iterdir()}
+        shutil.rmtree(tmp_path / 'output')
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 40, 50, 8,
+                                         workers=3, pipeline=pipeline, memory_budget=1)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.memory_tracker.peak_running == 1
+        assert {file.name: file.read_bytes()
+                for file in (tmp_path / 'output').iterdir()} == expected
+
+    def test_large_budget_runs_in_parallel(self, tmp_path):
+        stack_directory = make_stack(tmp_path, [f'{number}.png' for number in range(6)])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', workers=2,
+                                         memory_budget=2**40)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.memory_tracker.peak_running == 2
+        assert stack_convertor.memory_tracker.in_use == 0
+
+    def test_unreadable_layer_uses_overhead(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        (stack_directory / 'b.png').write_bytes(b'not an image')
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', workers=2,
+                                         memory_budget=2**30)
+        stack_convertor.convert_image_stack()
+        assert list(stack_convertor.errors) == [2]
+
+    def test_workers_default_to_cpu_count(self):
+        assert StackConvertor(TEST_IMAGES_DIR, workers=None).workers == \
+            (os.cpu_count() or 1)
+
+    @pytest.mark.parametrize('memory_budget', [0, -1, 1.5, '8G'])
+    def test_invalid_budget(self, memory_budget):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, memory_budget=memory_budget)
+
+
+class TestVolumeSources:
+
+    def make_pages(self, count=4, size=(80, 60)):
+        rows, columns = np.indices(size[::-1])
+        return [Image.fromarray(((rows + columns) * page % 256).astype(np.uint8))
+                for page in range(1, count + 1)]
+
+    def make_tiff_volume(self, tmp_path, pages):
+        volume_path = tmp_path / 'volume.tif'
+        pages[0].save(volume_path, save_all=True, append_images=pages[1:])
+        return volume_path
+
+    def convert_folder(self, tmp_path, pages, **settings):
+        """
+        Converts the pages saved as separate files, returning the outputs
+        """
+        stack_directory = tmp_path / 'folder' / 'stack'
+        stack_directory.mkdir(parents=True)
+        for number, page in enumerate(pages):
+            page.save(stack_directory / f'{number}.png')
+        StackConvertor(stack_directory, 'Layer', **settings).convert_image_stack()
+        return {file.name: file.read_bytes()
+                for file in (tmp_path / 'folder' / 'output').iterdir()}
+
+    @pytest.mark.parametrize('settings', [{'workers': 1}, {'workers': 2},
+                                          {'pipeline': True, 'workers': 2}])
+    def test_tiff_pages_match_folder(self, tmp_path, settings):
+        pages = self.make_pages()
+        volume_path = self.make_tiff_volume(tmp_path, pages)
+        options = {'new_file_extension': '.bmp', 'x_dim': 40, 'y_dim': 30,
+                   'bit_depth': 1, 'dither': 'bayer'}
+        expected = self.convert_folder(tmp_path, pages, **options)
+
+        stack_convertor = StackConvertor(volume_path, 'Layer', **options, **settings)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.errors == {}
+        assert {file.name: file.read_bytes()
+                for file in (tmp_path / 'output').iterdir()
+                if file.suffix == '.bmp'} == expected
+
+    def test_npy_volume_is_memory_mapped(self, tmp_path):
+        volume = np.random.default_rng(0).random((5, 20, 30)) > 0.5
+        np.save(tmp_path / 'part.npy', volume)
+        stack_index = VolumeIndex(tmp_path / 'part.npy')
+        assert len(stack_index) == 5
+        assert stack_index.get_layer_info(3).mode == '1'
+
+        StackConvertor(tmp_path / 'part.npy', None, '.png').convert_image_stack()
+        for page in range(5):
+            with Image.open(tmp_path / 'output' / f'part_{page:05d}.png') as image:
+                assert np.array_equal(np.asarray(image), volume[page])
+
+    def test_raw_volume(self, tmp_path):
+        volume = np.arange(3 * 20 * 30 * 3, dtype=np.uint8).reshape(3, 20, 30, 3)
+        volume.tofile(tmp_path / 'part.raw')
+        stack_convertor = StackConvertor(tmp_path / 'part.raw', 'Layer', '.png',
+                                         volume_shape=[3, 20, 30, 3])
+        stack_convertor.convert_image_stack()
+        with Image.open(tmp_path / 'output' / 'Layer_00002.png') as image:
+            assert image.mode == 'RGB'
+            assert np.array_equal(np.asarray(image), volume[1])
+
+    def test_read_single_page(self, tmp_path):
+        pages = self.make_pages()
+        volume_path = self.make_tiff_volume(tmp_path, pages)
+        for page in (3, 1, 2):
+            assert read_volume_page(volume_path, page).tobytes() == pages[page].tobytes()
+
+    def test_strip_conversion_of_pages(self, tmp_path):
+        pages = self.make_pages()
+        volume_path = self.make_tiff_volume(tmp_path, pages)
+        StackConvertor(volume_path, 'Layer', '.tif', strip_height=16).convert_image_stack()
+        with Image.open(tmp_path / 'output' / 'Layer_00004.tif') as image:
+            assert image.tobytes() == pages[3].tobytes()
+
+    def test_incremental_and_deduplicated_pages(self, tmp_path):
+        pages = self.make_pages(2)
+        volume_path = self.make_tiff_volume(tmp_path, [pages[0], pages[1], pages[0]])
+        stack_convertor = StackConvertor(volume_path, 'Layer', '.bmp', incremental=True,
+                                         deduplicate=True)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.dedup_stats.encoded_layers == 2
+        assert (tmp_path / 'output' / 'Layer_00003.bmp').read_bytes() == \
+            (tmp_path / 'output' / 'Layer_00001.bmp').read_bytes()
+
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.skipped_layers == 3
+
+    @pytest.mark.parametrize('compression', ['raw', 'tiff_lzw', 'packbits'])
+    def test_page_hash_follows_pixels(self, tmp_path, compression):
+        pages = self.make_pages(2)
+        volume_path = tmp_path / 'volume.tif'
+        pages[0].save(volume_path, save_all=True, append_images=[pages[1], pages[0]],
+                      compression=compression)
+        page_hashes = [get_page_hash(volume_path, page) for page in range(3)]
+        assert page_hashes[0] == page_hashes[2] != page_hashes[1]
+
+        np.save(tmp_path / 'volume.npy', np.stack([np.asarray(page) for page in
+                                                   (pages[1], pages[0], pages[1])]))
+        page_hashes = [get_page_hash(tmp_path / 'volume.npy', page) for page in range(3)]
+        assert page_hashes[0] == page_hashes[2] != page_hashes[1]
+
+    def test_duplicate_pages_found_without_decoding(self, tmp_path, monkeypatch):
+        pages = self.make_pages(2)
+        volume_path = self.make_tiff_volume(tmp_path, [pages[0], pages[1], pages[0]])
+        stack_convertor = StackConvertor(volume_path, 'Layer', '.bmp', deduplicate=True)
+        jobs = stack_convertor.get_layer_jobs()
+        monkeypatch.setattr('binder_jet_convertor.read_volume_page', None)
+        unique_jobs, duplicate_sources = stack_convertor.find_duplicate_sources(jobs)
+        assert unique_jobs == jobs[:2]
+        assert duplicate_sources == {jobs[2]: jobs[0]}
+
+    def test_unreadable_page_reported(self, tmp_path):
+        volume_path = self.make_tiff_volume(tmp_path, self.make_pages(3))
+        # Give the second page a bit depth Pillow has no mode for
+        data = bytearray(volume_path.read_bytes())
+        first_directory = struct.unpack_from('<I', data, 4)[0]
+        entries = struct.unpack_from('<H', data, first_directory)[0]
+        directory = struct.unpack_from('<I', data, first_directory + 2 + 12 * entries)[0]
+        for entry in range(struct.unpack_from('<H', data, directory)[0]):
+            if struct.unpack_from('<H', data, directory + 2 + 12 * entry)[0] == 258:
+                struct.pack_into('<H', data, directory + 2 + 12 * entry + 8, 7)
+        volume_path.write_bytes(bytes(data))
+
+        stack_convertor = StackConvertor(volume_path, 'Layer', '.bmp')
+        report = stack_convertor.validate()
+        assert report.layer_count == 3
+        assert list(report.unreadable) == [1]
+        assert isinstance(report.unreadable[1], SyntaxError)
+        assert report.sizes == {(80, 60): 2}
+        jobs = stack_convertor.get_layer_jobs()
+        assert stack_convertor.estimate_job_memory(jobs[1]) == LAYER_MEMORY_OVERHEAD
+
+    def test_validate_reports_pages(self, tmp_path):
+        volume_path = self.make_tiff_volume(tmp_path, self.make_pages(2) +
+                                            self.make_pages(1, (40, 30)))
+        report = StackConvertor(volume_path).validate()
+        assert report.layer_count == 3
+        assert report.inconsistent_sizes == [2]
+
+    @pytest.mark.parametrize('volume, settings', [
+        (np.zeros((2, 5, 5), dtype=np.float32), {'new_file_extension': '.png'}),
+        (np.zeros((2, 5), dtype=np.uint8), {'new_file_extension': '.png'}),
+        (np.zeros((2, 5, 5), dtype=np.uint8), {})])
+    def test_invalid_npy_volume(self, tmp_path, volume, settings):
+        np.save(tmp_path / 'part.npy', volume)
+        with pytest.raises(ValueError):
+            StackConvertor(tmp_path / 'part.npy', **settings)
+
+    def test_raw_volume_needs_shape(self, tmp_path):
+        (tmp_path / 'part.raw').write_bytes(bytes(100))
+        with pytest.raises(ValueError):
+            StackConvertor(tmp_path / 'part.raw', new_file_extension='.png')
+
+    def test_volume_cannot_be_watched(self, tmp_path):
+        volume_path = self.make_tiff_volume(tmp_path, self.make_pages(1))
+        with pytest.raises(ValueError):
+            StackConvertor(volume_path).watch()
+
+
+class TestSwathSplitting:
+
+    def make_layer(self, size=(100, 40)):
+        rows, columns = np.indices(size[::-1])
+        return Image.fromarray((columns * 2 + rows).astype(np.uint8))
+
+    def test_split_with_overlap(self):
+        layer = self.make_layer()
+        swaths = split_swaths(layer, SwathLayout(3, 40, overlap=10))
+        pixels = np.asarray(layer)
+        assert [swath.size for swath in swaths] == [(40, 40)] * 3
+        assert np.array_equal(np.asarray(swaths[0]), pixels[:, :40])
+        assert np.array_equal(np.asarray(swaths[1]), pixels[:, 30:70])
+        # The last swath runs past the edge of the layer and is padded
+        assert np.array_equal(np.asarray(swaths[2])[:, :40], pixels[:, 60:100])
+
+    def test_split_with_stagger(self):
+        layer = self.make_layer()
+        swaths = split_swaths(layer, SwathLayout(2, 50, stagger=(0, 8)))
+        pixels = np.asarray(layer)
+        assert [swath.size for swath in swaths] == [(50, 48)] * 2
+        assert np.array_equal(np.asarray(swaths[0])[:40], pixels[:, :50])
+        assert not np.asarray(swaths[0])[40:].any()
+        assert not np.asarray(swaths[1])[:8].any()
+        assert np.array_equal(np.asarray(swaths[1])[8:], pixels[:, 50:])
+
+    def test_split_palette_image(self):
+        layer = self.make_layer().convert('P')
+        swaths = split_swaths(layer, SwathLayout(2, 60, stagger=(4, 0)))
+        assert all(swath.mode == 'P' for swath in swaths)
+        assert swaths[0].getpalette() == layer.getpalette()
+
+    @pytest.mark.parametrize('settings', [{'workers': 1}, {'workers': 2},
+                                          {'pipeline': True, 'workers': 2},
+                                          {'deduplicate': True}])
+    def test_stack_writes_head_folders(self, tmp_path, settings):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        swath = SwathLayout(3, 20, overlap=4, stagger=(0, 6, 0))
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 50, 30, 8,
+                                         copies=2, swath=swath, **settings)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.errors == {}
+
+        for head in range(1, 4):
+            head_directory = tmp_path / 'output' / f'head_{head:02d}'
+            assert sorted(file.name for file in head_directory.iterdir()) == \
+                ['Layer_00001.bmp', 'Layer_00002.bmp', 'Layer_00003.bmp',
+                 'Layer_00004.bmp']
+            with Image.open(head_directory / 'Layer_00003.bmp') as image:
+                assert image.size == (20, 36)
+        assert not list((tmp_path / 'output').glob('*.bmp'))
+
+    def test_deduplicated_swaths_count_layers(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png', 'c.png'])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 40, 20,
+                                         swath=SwathLayout(2, 20), deduplicate=True)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.dedup_stats == DeduplicationStats(layers=3, encoded_layers=1)
+
+    def test_swaths_match_full_layer(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        StackConvertor(stack_directory, 'Layer', '.png', 50, 30, 8).convert_image_stack()
+        with Image.open(tmp_path / 'output' / 'Layer_00001.png') as image:
+            expected = split_swaths(image, SwathLayout(2, 30, overlap=10))
+        StackConvertor(stack_directory, 'Layer', '.png', 50, 30, 8,
+                       swath=SwathLayout(2, 30, overlap=10)).convert_image_stack()
+        for head, swath in enumerate(expected, 1):
+            with Image.open(tmp_path / 'output' / f'head_{head:02d}' /
+                            'Layer_00001.png') as image:
+                assert image.tobytes() == swath.tobytes()
+
+    def test_incremental_keeps_head_outputs(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        swath = SwathLayout(2, 30)
+        StackConvertor(stack_directory, 'Layer', '.png', 60, 20, incremental=True,
+                       swath=swath).convert_image_stack()
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.png', 60, 20,
+                                         incremental=True, swath=swath)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.skipped_layers == 2
+
+        (stack_directory / 'b.png').unlink()
+        StackConvertor(stack_directory, 'Layer', '.png', 60, 20, incremental=True,
+                       swath=swath).convert_image_stack()
+        assert not (tmp_path / 'output' / 'head_02' / 'Layer_00002.png').exists()
+        assert (tmp_path / 'output' / 'head_02' / 'Layer_00001.png').is_file()
+
+    def test_validate_projects_every_head(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        report = StackConvertor(stack_directory, 'Layer', '.tif', 64, 10, 8,
+                                swath=SwathLayout(3, 32, stagger=(0, 2, 4))).validate()
+        assert report.projected_output_bytes == 3 * 32 * 14
+
+    def test_split_undersized_layout(self):
+        with pytest.raises(ValueError):
+            split_swaths(self.make_layer(), SwathLayout(2, 30))
+
+    def test_undersized_layout_reported(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 100, 20,
+                                         swath=SwathLayout(2, 30))
+        report = stack_convertor.validate()
+        assert not report.is_valid
+        assert sorted(file.name for file in report.uncovered_layers) == ['a.png', 'b.png']
+        assert StackConvertor(stack_directory, 'Layer', '.bmp', 100, 20,
+                              swath=SwathLayout(5, 30, overlap=10)).validate().is_valid
+
+        stack_convertor.convert_image_stack()
+        assert list(stack_convertor.errors) == [1, 2]
+        assert all(isinstance(error, ValueError) for error in stack_convertor.errors.values())
+        assert not (tmp_path / 'output' / 'head_01' / 'Layer_00001.bmp').exists()
+
+    @pytest.mark.parametrize('settings', [{'heads': 0, 'swath_width': 10},
+                                          {'heads': 2, 'swath_width': 0},
+                                          {'heads': 2, 'swath_width': 10, 'overlap': 10},
+                                          {'heads': 2, 'swath_width': 10, 'stagger': (1,)},
+                                          {'heads': 2, 'swath_width': 10,
+                                           'stagger': (1, -1)}])
+    def test_invalid_layout(self, settings):
+        with pytest.raises(ValueError):
+            SwathLayout(**settings)
+
+    def test_swath_with_strips(self):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, 'Layer', '.tif', strip_height=16,
+                           swath=SwathLayout(2, 10))
+
+
+class TestBedCompositing:
+
+    def make_part(self, tmp_path, name, layers, size, value):
+        """
+        Saves a part stack of solid layers of the given value
+        """
+        stack_directory = tmp_path / name
+        stack_directory.mkdir()
+        for layer in range(layers):
+            Image.new('L', size, value).save(stack_directory / f'{layer}.png')
+        return stack_directory
+
+    def make_bed(self, tmp_path, parts, size=None):
+        bed = {'parts': parts}
+        if size is not None:
+            bed['size'] = size
+        bed_path = tmp_path / 'bed.json'
+        bed_path.write_text(json.dumps(bed))
+        return bed_path
+
+    def read_outputs(self, tmp_path):
+        return {file.name: np.asarray(Image.open(file))
+                for file in sorted((tmp_path / 'output').glob('*.png'))}
+
+    def test_parts_placed_on_bed(self, tmp_path):
+        self.make_part(tmp_path, 'first', 2, (10, 5), 100)
+        volume = np.full((2, 4, 6), 200, dtype=np.uint8)
+        np.save(tmp_path / 'second.npy', volume)
+        bed_path = self.make_bed(tmp_path, [{'path': 'first', 'x': 2, 'y': 1},
+                                            {'path': 'second.npy', 'x': 20, 'y': 3,
+                                             'z': 1}], size=[30, 10])
+
+        StackConvertor(bed_path, 'Layer', '.png').convert_image_stack()
+        outputs = self.read_outputs(tmp_path)
+        assert list(outputs) == ['Layer_00001.png', 'Layer_00002.png',
+                                 'Layer_00003.png']
+
+        expected = np.zeros((10, 30), dtype=np.uint8)
+        expected[1:6, 2:12] = 100
+        assert np.array_equal(outputs['Layer_00001.png'], expected)
+        expected[3:7, 20:26] = 200
+        assert np.array_equal(outputs['Layer_00002.png'], expected)
+        expected[1:6, 2:12] = 0
+        assert np.array_equal(outputs['Layer_00003.png'], expected)
+
+    def test_overlapping_parts_keep_maximum(self, tmp_path):
+        self.make_part(tmp_path, 'dark', 1, (10, 10), 50)
+        self.make_part(tmp_path, 'light', 1, (10, 10), 150)
+        bed_path = self.make_bed(tmp_path, [{'path': 'light', 'x': 5},
+                                            {'path': 'dark'}])
+        layer = BedIndex(bed_path).get_bed_layer(0)
+        composed = np.asarray(compose_bed_layer(layer))
+        assert composed.shape == (10, 15)
+        assert (composed[:, :5] == 50).all()
+        assert (composed[:, 5:] == 150).all()
+
+    def test_duplicate_bed_layers_found_without_composing(self, tmp_path, monkeypatch):
+        self.make_part(tmp_path, 'first', 3, (10, 5), 100)
+        self.make_part(tmp_path, 'second', 1, (10, 5), 100)
+        bed_path = self.make_bed(tmp_path, [{'path': 'first'},
+                                            {'path': 'second', 'x': 10, 'z': 1}])
+        stack_convertor = StackConvertor(bed_path, 'Layer', '.png', deduplicate=True)
+        jobs = stack_convertor.get_layer_jobs()
+        monkeypatch.setattr('binder_jet_convertor.compose_bed_layer', None)
+        unique_jobs, duplicate_sources = stack_convertor.find_duplicate_sources(jobs)
+        assert unique_jobs == jobs[:2]
+        assert duplicate_sources == {jobs[2]: jobs[0]}
+
+    def test_parts_clipped_to_bed(self, tmp_path):
+        self.make_part(tmp_path, 'part', 1, (10, 10), 255)
+        bed_path = self.make_bed(tmp_path, [{'path': 'part', 'x': 15, 'y': 5}],
+                                 size=[20, 20])
+        composed = np.asarray(compose_bed_layer(BedIndex(bed_path).get_bed_layer(0)))
+        assert composed.shape == (20, 20)
+        assert composed.sum() == 255 * 5 * 10
+
+    def test_size_defaults_to_parts_extent(self, tmp_path):
+        self.make_part(tmp_path, 'part', 3, (10, 5), 255)
+        bed_index = BedIndex(self.make_bed(tmp_path, [{'path': 'part', 'x': 4,
+                                                      'y': 2, 'z': 2}]))
+        assert bed_index.size == (14, 7)
+        assert len(bed_index) == 5
+        assert bed_index.get_bed_layer(0).part_slices == ()
+        assert bed_index.get_layer_info(3).size == (14, 7)
+
+    @pytest.mark.parametrize('settings', [{'workers': 2},
+                                          {'pipeline': True, 'workers': 2}])
+    def test_parallel_matches_serial(self, tmp_path, settings):
+        self.make_part(tmp_path, 'first', 3, (10, 5), 100)
+        self.make_part(tmp_path, 'second', 2, (8, 8), 200)
+        bed_path = self.make_bed(tmp_path, [{'path': 'first', 'x': 3},
+                                            {'path': 'second', 'y': 2, 'z': 1}])
+        StackConvertor(bed_path, 'Layer', '.png', bit_depth=1).convert_image_stack()
+        expected = self.read_outputs(tmp_path)
+        shutil.rmtree(tmp_path / 'output')
+
+        stack_convertor = StackConvertor(bed_path, 'Layer', '.png', bit_depth=1,
+                                         **settings)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.errors == {}
+        outputs = self.read_outputs(tmp_path)
+        assert list(outputs) == list(expected)
+        assert all(np.array_equal(outputs[name], expected[name]) for name in expected)
+
+    def test_changed_part_reconverts_its_layers(self, tmp_path):
+        first = self.make_part(tmp_path, 'first', 2, (10, 5), 100)
+        self.make_part(tmp_path, 'second', 2, (10, 5), 200)
+        bed_path = self.make_bed(tmp_path, [{'path': 'first'},
+                                            {'path': 'second', 'y': 5, 'z': 1}])
+        StackConvertor(bed_path, 'Layer', '.png', incremental=True).convert_image_stack()
+
+        Image.new('L', (10, 5), 50).save(first / '1.png')
+        os.utime(first / '1.png', ns=(1, 1))
+        stack_convertor = StackConvertor(bed_path, 'Layer', '.png', incremental=True)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.skipped_layers == 2
+        assert (self.read_outputs(tmp_path)['Layer_00002.png'][:5] == 50).all()
+
+    @pytest.mark.parametrize('bed', [{'parts': []}, {'parts': [{'x': 1}]},
+                                     {'parts': [{'path': 'part', 'x': -1}]},
+                                     {'parts': [{'path': 'part'}], 'size': [0, 10]},
+                                     {'parts': [{'path': 'part'}], 'size': 10},
+                                     {'parts': [{'path': 'part'}], 'size': [10, 5, 1]},
+                                     {'parts': [{'path': 'part'}], 'size': [10.5, 5]}])
+    def test_invalid_bed_file(self, tmp_path, bed):
+        self.make_part(tmp_path, 'part', 1, (10, 5), 255)
+        bed_path = tmp_path / 'bed.json'
+        bed_path.write_text(json.dumps(bed))
+        with pytest.raises(ValueError):
+            BedIndex(bed_path)
+
+    @pytest.mark.parametrize('settings', [{}, {'new_file_extension': '.png',
+                                               'strip_height': 10}])
+    def test_invalid_bed_settings(self, tmp_path, settings):
+        self.make_part(tmp_path, 'part', 1, (10, 5), 255)
+        bed_path = self.make_bed(tmp_path, [{'path': 'part'}])
+        with pytest.raises(ValueError):
+            StackConvertor(bed_path, 'Layer', **settings)
+
+
+class TestOutputArchives:
+
+    def convert_directory(self, tmp_path, **settings):
+        """
+        Converts the stack to a folder, returning the outputs by name
+        """
+        tmp_path.mkdir()
+        stack_directory = make_stack(tmp_path, [f'{layer}.png' for layer in range(5)])
+        StackConvertor(stack_directory, 'Layer', '.bmp', 40, 30, 1,
+                       **settings).convert_image_stack()
+        return {file.relative_to(tmp_path / 'output').as_posix(): file.read_bytes()
+                for file in sorted((tmp_path / 'output').rglob('*.bmp'))}
+
+    @pytest.mark.parametrize('settings', [{}, {'workers': 3},
+                                          {'pipeline': True, 'workers': 3}])
+    def test_tar_in_layer_order(self, tmp_path, settings):
+        expected = self.convert_directory(tmp_path / 'folder', copies=2)
+        stack_directory = make_stack(tmp_path, [f'{layer}.png' for layer in range(5)])
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 40, 30, 1,
+                                         copies=2, output_format='tar', **settings)
+        stack_convertor.convert_image_stack()
+
+        assert stack_convertor.errors == {}
+        assert not (tmp_path / 'output').exists()
+        with tarfile.open(tmp_path / 'output.tar') as archive:
+            assert archive.getnames() == list(expected)
+            for name, data in expected.items():
+                assert archive.extractfile(name).read() == data
+
+    @pytest.mark.parametrize('output_format, compression',
+                             [('zip', zipfile.ZIP_STORED),
+                              ('zip-deflate', zipfile.ZIP_DEFLATED)])
+    def test_zip(self, tmp_path, output_format, compression):
+        expected = self.convert_directory(tmp_path / 'folder')
+        stack_directory = make_stack(tmp_path, [f'{layer}.png' for layer in range(5)])
+        StackConvertor(stack_directory, 'Layer', '.bmp', 40, 30, 1, workers=2,
+                       output_path=tmp_path / 'transfer' / 'part.zip',
+                       output_format=output_format).convert_image_stack()
+
+        with zipfile.ZipFile(tmp_path / 'transfer' / 'part.zip') as archive:
+            assert archive.namelist() == list(expected)
+            assert {info.compress_type for info in archive.infolist()} == {compression}
+            assert {name: archive.read(name) for name in expected} == expected
+
+    def test_swaths_in_archive(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp', 40, 20, swath=SwathLayout(2, 20),
+                       output_format='zip').convert_image_stack()
+        with zipfile.ZipFile(tmp_path / 'output.zip') as archive:
+            assert archive.namelist() == ['head_01/Layer_00001.bmp',
+                                          'head_02/Layer_00001.bmp',
+                                          'head_01/Layer_00002.bmp',
+                                          'head_02/Layer_00002.bmp']
+
+    def test_linked_copies_in_tar(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        metrics = ConversionMetrics()
+        StackConvertor(stack_directory, 'Layer', '.bmp', copies=3, copy_mode='hardlink',
+                       output_format='tar', metrics=metrics).convert_image_stack()
+        with tarfile.open(tmp_path / 'output.tar') as archive:
+            first, *copies = archive.getmembers()
+            assert [member.islnk() for member in copies] == [True, True]
+            assert archive.extractfile(copies[1]).read() == \
+                archive.extractfile(first).read()
+            assert metrics.layers[1].bytes_written == first.size
+
+    def test_failed_layer_left_out(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'c.png'])
+        (stack_directory / 'b.png').write_bytes(b'not an image')
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', workers=2,
+                                         output_format='tar')
+        stack_convertor.convert_image_stack()
+        assert list(stack_convertor.errors) == [2]
+        with tarfile.open(tmp_path / 'output.tar') as archive:
+            assert archive.getnames() == ['Layer_00001.bmp', 'Layer_00003.bmp']
+
+    def test_cancelled_archive_discarded(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png', 'c.png'])
+        cancel_event = threading.Event()
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp',
+                                         output_format='tar')
+        stack_convertor.convert_image_stack(lambda done, total: cancel_event.set(),
+                                            cancel_event)
+        assert stack_convertor.cancelled
+        assert list(tmp_path.iterdir()) == [stack_directory]
+
+    def test_layers_held_for_archive_bounded(self, tmp_path):
+        stack_directory = make_stack(tmp_path, [f'{layer:02d}.png' for layer in range(1, 13)])
+        noise = np.random.default_rng(0).integers(0, 256, (3000, 3000), dtype=np.uint8)
+        Image.fromarray(noise).save(stack_directory / '00.png')
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', 40, 30, 1,
+                                         workers=2, output_format='tar')
+        finish_encoded_layer = stack_convertor.finish_encoded_layer
+        held_layers = []
+
+        def record_held_layers(job, *arguments):
+            finish_encoded_layer(job, *arguments)
+            held_layers.append(len(stack_convertor.encoded_layers))
+
+        stack_convertor.finish_encoded_layer = record_held_layers
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.errors == {}
+        assert max(held_layers) < 2 * ARCHIVE_LAYERS_PER_WORKER
+        with tarfile.open(tmp_path / 'output.tar') as archive:
+            assert len(archive.getnames()) == 13
+
+    def test_file_closed_when_archive_cannot_be_finished(self, tmp_path, monkeypatch):
+        def fail_sync(file_descriptor):
+            raise OSError('disk full')
+
+        archive_output = ArchiveOutput(tmp_path / 'part.tar')
+        archive_output.write_member('Layer_00001.bmp', b'layer')
+        monkeypatch.setattr('binder_jet_convertor.os.fsync', fail_sync)
+        with pytest.raises(OSError):
+            archive_output.close()
+        assert archive_output.file.closed
+        assert not (tmp_path / 'part.tar').exists()
+
+    def test_output_directory(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp', workers=2, incremental=True,
+                       output_path=tmp_path / 'printer').convert_image_stack()
+        assert sorted(file.name for file in (tmp_path / 'printer').glob('*.bmp')) == \
+            ['Layer_00001.bmp', 'Layer_00002.bmp']
+        assert (tmp_path / 'printer' / '.binder_jet_manifest.json').is_file()
+        assert not (tmp_path / 'output').exists()
+
+    @pytest.mark.parametrize('settings', [{'output_format': 'rar'},
+                                          {'output_format': 'tar', 'incremental': True},
+                                          {'output_format': 'zip', 'resume': True},
+                                          {'output_format': 'zip', 'deduplicate': True},
+                                          {'output_format': 'tar', 'strip_height': 16}])
+    def test_invalid_settings(self, settings):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, 'Layer', '.tif', **settings)
+
+    def test_archive_cannot_be_watched(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        with pytest.raises(ValueError):
+            StackConvertor(stack_directory, 'Layer', output_format='tar').watch()
+
+
+class TestLayerStatistics:
+
+    def make_layer(self):
+        layer = np.zeros((30, 40), dtype=np.uint8)
+        layer[5:10, 8:20] = 255
+        layer[20, 30] = 51
+        return Image.fromarray(layer)
+
+    def read_csv(self, path):
+        with open(path, newline='') as statistics_file:
+            return list(csv.DictReader(statistics_file))
+
+    def test_counts_and_bounding_box(self):
+        statistics = get_layer_statistics(self.make_layer())
+        assert statistics.ink_pixels == 5 * 12 + 1
+        assert statistics.coverage == pytest.approx(61 / 1200)
+        assert statistics.ink_fraction == pytest.approx((60 + 0.2) / 1200)
+        assert statistics.bbox == (8, 5, 31, 21)
+
+    def test_one_bit_and_empty_layers(self):
+        statistics = get_layer_statistics(self.make_layer().convert('1', dither=None))
+        assert statistics.ink_pixels == 60
+        assert statistics.ink_fraction == statistics.coverage
+        empty = get_layer_statistics(Image.new('1', (10, 10)))
+        assert (empty.ink_pixels, empty.coverage, empty.bbox) == (0, 0.0, None)
+
+    def test_bands_match_whole_layer(self):
+        layer = self.make_layer()
+        statistics = LayerStatistics()
+        for top in range(0, 30, 7):
+            statistics.add_band(layer.crop((0, top, 40, min(top + 7, 30))), top)
+        assert statistics == get_layer_statistics(layer)
+
+    @pytest.mark.parametrize('settings', [{}, {'workers': 2},
+                                          {'pipeline': True, 'workers': 2},
+                                          {'output_format': 'tar', 'workers': 2}])
+    def test_csv_matches_outputs(self, tmp_path, settings):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp', 60, 40, 1, copies=2,
+                       statistics_path=tmp_path / 'ink.csv',
+                       **settings).convert_image_stack()
+
+        rows = self.read_csv(tmp_path / 'ink.csv')
+        assert [row['layer'] for row in rows] == ['1', '2', '3', '4']
+        assert [row['source'] for row in rows] == ['a.png', 'a.png', 'b.png', 'b.png']
+        if 'output_format' in settings:
+            with tarfile.open(tmp_path / 'output.tar') as archive:
+                output = Image.open(archive.extractfile('Layer_00003.bmp'))
+                output.load()
+        else:
+            output = Image.open(tmp_path / 'output' / 'Layer_00003.bmp')
+        expected = get_layer_statistics(output)
+        assert int(rows[2]['ink_pixels']) == expected.ink_pixels
+        assert float(rows[2]['coverage']) == pytest.approx(expected.coverage)
+        assert tuple(int(rows[2][edge]) for edge in ('left', 'top', 'right', 'bottom')) \
+            == expected.bbox
+
+    def test_json_totals(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        StackConvertor(stack_directory, 'Layer', '.bmp', bit_depth=1, deduplicate=True,
+                       statistics_path=tmp_path / 'ink.json').convert_image_stack()
+        statistics = json.loads((tmp_path / 'ink.json').read_text())
+        assert len(statistics['layers']) == 2
+        assert statistics['layers'][0]['ink_pixels'] == \
+            statistics['layers'][1]['ink_pixels'] > 0
+        assert statistics['ink_pixels'] == 2 * statistics['layers'][0]['ink_pixels']
+
+    def test_strips_match_whole_layers(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png'])
+        StackConvertor(stack_directory, 'Layer', '.tif', bit_depth=1, dither='bayer',
+                       statistics_path=tmp_path / 'whole.csv').convert_image_stack()
+        StackConvertor(stack_directory, 'Layer', '.tif', bit_depth=1, dither='bayer',
+                       strip_height=16,
+                       statistics_path=tmp_path / 'strips.csv').convert_image_stack()
+        assert self.read_csv(tmp_path / 'strips.csv') == \
+            self.read_csv(tmp_path / 'whole.csv')
+
+    def test_incremental_keeps_skipped_layers(self, tmp_path):
+        stack_directory = make_stack(tmp_path, ['a.png', 'b.png'])
+        settings = {'incremental': True, 'statistics_path': tmp_path / 'ink.csv'}
+        StackConvertor(stack_directory, 'Layer', '.bmp', **settings).convert_image_stack()
+        expected = self.read_csv(tmp_path / 'ink.csv')
+
+        stack_convertor = StackConvertor(stack_directory, 'Layer', '.bmp', **settings)
+        stack_convertor.convert_image_stack()
+        assert stack_convertor.skipped_layers == 2
+        assert self.read_csv(tmp_path / 'ink.csv') == expected
+
+    def test_invalid_statistics_path(self):
+        with pytest.raises(ValueError):
+            StackConvertor(TEST_IMAGES_DIR, 'Layer', '.tif', statistics_path='ink.txt')
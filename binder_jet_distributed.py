@@ -0,0 +1,452 @@
+"""
+Shares the conversion of a stack between workers on several machines
+through a job folder on a shared filesystem, such as a NAS
+The stack is split into batches of layers, each a file in the job folder,
+and a worker claims a batch by renaming its file into the claimed folder
+under the worker's name, which only one worker can do. While it converts
+the batch it touches the claim file as a heartbeat, and when it finishes
+it saves the result and moves the claim to the done folder
+A claim whose heartbeat has stopped, because its worker died, is moved
+back to the pending folder by the other workers and converted again
+Every worker numbers the layers from the whole stack, so the outputs are
+named exactly as a single StackConvertor would name them
+"""
+
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+from binder_jet_cli import build_parser, get_jobs
+from binder_jet_convertor import (StackConvertor, SwathLayout, save_statistics,
+                                  write_output_file)
+
+# Files and folders of a job folder
+JOB_FILE_NAME = 'job.json'
+PENDING_DIRECTORY = 'pending'
+CLAIMED_DIRECTORY = 'claimed'
+RESULTS_DIRECTORY = 'results'
+DONE_DIRECTORY = 'done'
+
+# Name of the file of each batch, from the index of its first layer and the
+# index after its last layer
+BATCH_NAME_FORMAT = 'batch_{:06d}_{:06d}'
+
+# StackConvertor settings that are paths, saved relative to the job folder
+PATH_SETTINGS = ('output_path', 'statistics_path')
+
+
+def get_worker_id() -> str:
+    """
+    Returns a name for this process that is unique across the machines
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def get_batch_range(batch: str) -> tuple[int, int]:
+    """
+    Returns the start and stop layer index of a batch from its name
+    """
+    _, start, stop = batch.split('_')
+    return int(start), int(stop)
+
+
+def _save_path(path: Path, job_directory: Path) -> str:
+    """
+    Returns path relative to the job folder where possible, so machines
+    that mount the shared folder in different places can find it
+    """
+    path = Path(path).resolve()
+    try:
+        return os.path.relpath(path, job_directory.resolve())
+    except ValueError:  # On another Windows drive
+        return str(path)
+
+
+def create_job(job_directory: Path, stack_path: Path, batch_size: int = 50,
+               **settings) -> int:
+    """
+    Creates a job folder for converting the stack at stack_path with the
+    StackConvertor settings given, split into batches of batch_size
+    layers, and returns the number of batches
+    Outputs go to a folder, as archives need a single writer, and
+    incremental and resumed conversion are replaced by the batches
+    """
+    job_directory = Path(job_directory)
+    if not isinstance(batch_size, (int)) or batch_size <= 0:
+        raise ValueError('Batch size must be a positive, non-zero integer')
+
+    if settings.get('output_format', 'directory') != 'directory' or \
+            settings.get('incremental') or settings.get('resume'):
+        raise ValueError('Shared conversions write to a directory, without '
+                         'incremental or resumed conversion')
+
+    if (job_directory / JOB_FILE_NAME).exists():
+        raise ValueError(f'{job_directory} already holds a job')
+
+    # Checks the settings and counts the layers
+    layers = len(StackConvertor(stack_path, **settings).get_layer_jobs())
+
+    saved_settings = dict(settings)
+    for setting in PATH_SETTINGS:
+        if saved_settings.get(setting) is not None:
+            saved_settings[setting] = _save_path(saved_settings[setting], job_directory)
+    if saved_settings.get('swath') is not None:
+        saved_settings['swath'] = asdict(saved_settings['swath'])
+
+    for directory in (PENDING_DIRECTORY, CLAIMED_DIRECTORY, RESULTS_DIRECTORY,
+                      DONE_DIRECTORY):
+        (job_directory / directory).mkdir(parents=True, exist_ok=True)
+    batches = [BATCH_NAME_FORMAT.format(start, min(start + batch_size, layers))
+               for start in range(0, layers, batch_size)]
+    for batch in batches:
+        (job_directory / PENDING_DIRECTORY / batch).touch()
+
+    # Written last, so workers only start on a complete job folder
+    write_output_file(job_directory / JOB_FILE_NAME, json.dumps({
+        'path': _save_path(stack_path, job_directory), 'settings': saved_settings,
+        'layers': layers, 'batch_size': batch_size}, indent=1).encode())
+    return len(batches)
+
+
+def load_job(job_directory: Path) -> dict:
+    """
+    Reads the job file of a job folder, with its paths made usable on this
+    machine
+    """
+    job_directory = Path(job_directory)
+    try:
+        with open(job_directory / JOB_FILE_NAME) as job_file:
+            job = json.load(job_file)
+    except OSError:
+        raise ValueError(f'{job_directory} does not hold a job') from None
+
+    job['path'] = job_directory / job['path']
+    settings = job['settings']
+    for setting in PATH_SETTINGS:
+        if settings.get(setting) is not None:
+            settings[setting] = job_directory / settings[setting]
+    if settings.get('swath') is not None:
+        settings['swath'] = SwathLayout(**settings['swath'])
+    return job
+
+
+def load_stack_convertor(job_directory: Path) -> StackConvertor:
+    """
+    Returns a StackConvertor for the stack of a job, checking the stack
+    still has the layers it had when the job was created
+    """
+    job = load_job(job_directory)
+    stack_convertor = StackConvertor(job['path'], **job['settings'])
+    if len(stack_convertor.get_layer_jobs()) != job['layers']:
+        raise ValueError(f'{job["path"]} has changed since the job was created')
+    return stack_convertor
+
+
+def claim_batch(job_directory: Path, worker_id: str) -> str | None:
+    """
+    Claims the first pending batch for the worker, returning its name, or
+    None if there are no pending batches
+    """
+    job_directory = Path(job_directory)
+    for batch in sorted(os.listdir(job_directory / PENDING_DIRECTORY)):
+        claim_path = job_directory / CLAIMED_DIRECTORY / f'{batch}.{worker_id}'
+        try:
+            os.rename(job_directory / PENDING_DIRECTORY / batch, claim_path)
+        except FileNotFoundError:
+            # Claimed by another worker first
+            continue
+        os.utime(claim_path)
+        return batch
+    return None
+
+
+def reclaim_stale_claims(job_directory: Path, claim_signatures: dict,
+                         stale_after: float, worker_id: str = None) -> list[str]:
+    """
+    Moves the claims of other workers whose heartbeat has not changed for
+    stale_after seconds back to pending, returning the batches reclaimed
+    claim_signatures holds the last modification time seen of each claim
+    and when it was seen to change, by this machine's clock, so the clocks
+    of the machines do not need to agree; pass the same dictionary on each
+    call
+    """
+    job_directory = Path(job_directory)
+    now = time.monotonic()
+    reclaimed = []
+    claims = set(os.listdir(job_directory / CLAIMED_DIRECTORY))
+    for claim in claims:
+        batch, _, claim_worker = claim.partition('.')
+        if claim_worker == worker_id:
+            continue
+        claim_path = job_directory / CLAIMED_DIRECTORY / claim
+        try:
+            signature = claim_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            continue
+        previous_signature, changed_at = claim_signatures.get(claim, (None, now))
+        if previous_signature != signature:
+            changed_at = now
+        claim_signatures[claim] = (signature, changed_at)
+        if now - changed_at < stale_after:
+            continue
+        try:
+            os.rename(claim_path, job_directory / PENDING_DIRECTORY / batch)
+        except FileNotFoundError:
+            # Finished, or reclaimed by another worker first
+            continue
+        reclaimed.append(batch)
+
+    for claim in set(claim_signatures) - claims:
+        del claim_signatures[claim]
+    return reclaimed
+
+
+class ClaimHeartbeat:
+    """
+    Touches a claim file every interval seconds on a background thread, so
+    the other workers can tell the claim is still being worked on
+    lost is set if the claim was reclaimed in the meantime
+    Stands in for the cancel event of the conversion, is_set is True once
+    the claim is lost or cancel_event is set
+    """
+
+    def __init__(self, path: Path, interval: float, cancel_event=None):
+        self.path = Path(path)
+        self.interval = interval
+        self.cancel_event = cancel_event
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+    def is_set(self) -> bool:
+        """
+        True once the claim is lost or the worker is cancelled
+        """
+        return self.lost or (self.cancel_event is not None and self.cancel_event.is_set())
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+
+def convert_batch(job_directory: Path, batch: str, worker_id: str,
+                  stack_convertor: StackConvertor, heartbeat_interval: float = 5.0,
+                  cancel_event=None) -> bool:
+    """
+    Converts a claimed batch, saves its result and marks it done
+    Layers that fail are recorded in the result, and a batch that fails
+    as a whole is recorded as failed rather than converted again
+    If cancelled, the claim is returned to pending and False is returned
+    If the claim is lost to another worker, the conversion stops and
+    nothing is saved, leaving the batch to the worker that claimed it next
+    """
+    job_directory = Path(job_directory)
+    claim_path = job_directory / CLAIMED_DIRECTORY / f'{batch}.{worker_id}'
+    start, stop = get_batch_range(batch)
+
+    result = {'worker': worker_id, 'errors': {}, 'statistics': []}
+    with ClaimHeartbeat(claim_path, heartbeat_interval, cancel_event) as heartbeat:
+        try:
+            jobs = stack_convertor.convert_layer_range(start, stop,
+                                                       cancel_event=heartbeat)
+        except Exception as error:
+            result['failure'] = f'{type(error).__name__}: {error}'
+        else:
+            result['errors'] = {str(layer_number): f'{type(error).__name__}: {error}'
+                                for layer_number, error in stack_convertor.errors.items()}
+            result['statistics'] = stack_convertor.get_statistics_rows(jobs)
+
+    # The heartbeat only notices a lost claim when it next beats
+    if heartbeat.lost or not claim_path.exists():
+        return False
+
+    if stack_convertor.cancelled:
+        try:
+            os.rename(claim_path, job_directory / PENDING_DIRECTORY / batch)
+        except FileNotFoundError:
+            pass
+        return False
+
+    write_output_file(job_directory / RESULTS_DIRECTORY / f'{batch}.json',
+                      json.dumps(result).encode())
+    try:
+        os.rename(claim_path, job_directory / DONE_DIRECTORY / batch)
+    except (FileNotFoundError, FileExistsError):
+        # Reclaimed after the check above, the worker that claimed it next
+        # writes the same outputs and marks it done
+        pass
+    return True
+
+
+def run_worker(job_directory: Path, worker_id: str = None,
+               heartbeat_interval: float = 5.0, stale_after: float = 60.0,
+               poll_interval: float = 1.0, cancel_event=None) -> int:
+    """
+    Claims and converts batches of a job until none are left, returning the
+    number of batches this worker converted
+    Once there are no pending batches, the worker waits for the batches
+    claimed by others to finish, reclaiming any whose heartbeat stops for
+    stale_after seconds, which should be several heartbeat intervals
+    Stops early when cancel_event (a threading.Event) is set
+    """
+    job_directory = Path(job_directory)
+    if worker_id is None:
+        worker_id = get_worker_id()
+
+    if not isinstance(heartbeat_interval, (int, float)) or heartbeat_interval <= 0:
+        raise ValueError('Heartbeat interval must be a positive, non-zero number')
+
+    if not isinstance(stale_after, (int, float)) or stale_after <= heartbeat_interval:
+        raise ValueError('Claims can only be stale after more than one heartbeat interval')
+
+    stack_convertor = load_stack_convertor(job_directory)
+    claim_signatures = {}
+    batches_done = 0
+    while cancel_event is None or not cancel_event.is_set():
+        reclaim_stale_claims(job_directory, claim_signatures, stale_after, worker_id)
+        batch = claim_batch(job_directory, worker_id)
+        if batch is not None:
+            if convert_batch(job_directory, batch, worker_id, stack_convertor,
+                             heartbeat_interval, cancel_event):
+                batches_done += 1
+            continue
+
+        if not os.listdir(job_directory / CLAIMED_DIRECTORY):
+            break
+        if cancel_event is not None:
+            cancel_event.wait(poll_interval)
+        else:
+            time.sleep(poll_interval)
+    return batches_done
+
+
+def get_job_status(job_directory: Path) -> dict:
+    """
+    Returns the number of batches pending, claimed and done, the batches
+    that failed and the errors of any layers that failed, by layer number
+    """
+    job_directory = Path(job_directory)
+    job = load_job(job_directory)
+    done = sorted(os.listdir(job_directory / DONE_DIRECTORY))
+    status = {'layers': job['layers'],
+              'pending': len(os.listdir(job_directory / PENDING_DIRECTORY)),
+              'claimed': len(os.listdir(job_directory / CLAIMED_DIRECTORY)),
+              'done': len(done), 'failed_batches': {}, 'errors': {}}
+    for batch in done:
+        result = read_result(job_directory, batch)
+        if 'failure' in result:
+            status['failed_batches'][batch] = result['failure']
+        status['errors'].update({int(layer_number): error
+                                 for layer_number, error in result['errors'].items()})
+    return status
+
+
+def read_result(job_directory: Path, batch: str) -> dict:
+    """
+    Returns the saved result of a finished batch
+    """
+    with open(Path(job_directory) / RESULTS_DIRECTORY / f'{batch}.json') as result_file:
+        return json.load(result_file)
+
+
+def finish_job(job_directory: Path) -> dict:
+    """
+    Checks every batch of a job is done, saves the ink statistics of the
+    whole stack if the job collects them, and returns the job status
+    """
+    job_directory = Path(job_directory)
+    status = get_job_status(job_directory)
+    if status['pending'] or status['claimed']:
+        raise ValueError(f'{job_directory} still has batches to convert')
+
+    statistics_path = load_job(job_directory)['settings'].get('statistics_path')
+    if statistics_path is not None:
+        rows = [row for batch in sorted(os.listdir(job_directory / DONE_DIRECTORY))
+                for row in read_result(job_directory, batch)['statistics']]
+        save_statistics(statistics_path, sorted(rows, key=lambda row: row['layer']))
+    return status
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Share the conversion of a stack '
+                                     'between machines through a job folder')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help='split a stack into batches in a '
+                                 'new job folder, followed by the stack and its '
+                                 'conversion options as for binder_jet_cli')
+    create.add_argument('job_directory', type=Path)
+    create.add_argument('--batch-size', type=int, default=50,
+                        help='layers each worker claims at a time')
+
+    work = commands.add_parser('work', help='convert batches until the job is done')
+    work.add_argument('job_directory', type=Path)
+    work.add_argument('--worker-id', help='name of this worker, by default the '
+                      'host name and process id')
+    work.add_argument('--heartbeat-interval', type=float, default=5.0,
+                      help='seconds between touches of the claim file')
+    work.add_argument('--stale-after', type=float, default=60.0,
+                      help='seconds without a heartbeat before a claim is taken over')
+    work.add_argument('--poll-interval', type=float, default=1.0)
+
+    for command, help_text in (('status', 'show the progress of a job'),
+                               ('finish', 'check a job is done and save its statistics')):
+        commands.add_parser(command, help=help_text).add_argument('job_directory',
+                                                                   type=Path)
+    # The rest of the create arguments are the stack and its settings
+    arguments, stack_argv = parser.parse_known_args(argv)
+    if stack_argv and arguments.command != 'create':
+        parser.error(f'unrecognized arguments: {" ".join(stack_argv)}')
+
+    try:
+        if arguments.command == 'create':
+            stack_arguments = build_parser().parse_args(stack_argv)
+            jobs = get_jobs(stack_arguments)
+            if len(jobs) != 1:
+                parser.error('give exactly one stack to share')
+            job = jobs[0]
+            batches = create_job(arguments.job_directory, job.pop('path'),
+                                 arguments.batch_size, **job)
+            print(f'{arguments.job_directory}: {batches} batches')
+            return 0
+
+        if arguments.command == 'work':
+            batches = run_worker(arguments.job_directory, arguments.worker_id,
+                                 arguments.heartbeat_interval, arguments.stale_after,
+                                 arguments.poll_interval)
+            print(f'{arguments.job_directory}: converted {batches} batches')
+            return 0
+
+        if arguments.command == 'status':
+            print(json.dumps(get_job_status(arguments.job_directory), indent=2))
+            return 0
+
+        status = finish_job(arguments.job_directory)
+    except (OSError, ValueError) as error:
+        print(f'{arguments.job_directory}: {error}', file=sys.stderr)
+        return 1
+
+    print(json.dumps(status, indent=2))
+    return 1 if status['errors'] or status['failed_batches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
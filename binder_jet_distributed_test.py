@@ -0,0 +1,198 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from pathlib import Path
+from binder_jet_convertor import StackConvertor, SwathLayout
+from binder_jet_distributed import (CLAIMED_DIRECTORY, DONE_DIRECTORY, PENDING_DIRECTORY,
+                                    RESULTS_DIRECTORY, ClaimHeartbeat, claim_batch,
+                                    convert_batch, create_job, finish_job,
+                                    get_job_status, load_job, load_stack_convertor,
+                                    main, reclaim_stale_claims, run_worker)
+
+TEST_SINGLE_IMAGE_DIR = Path('test_image_single_directory')
+
+
+def make_stack(tmp_path, layers):
+    """
+    Copies the test png into a new stack directory with the given number
+    of layers
+    """
+    stack_directory = tmp_path / 'part' / 'stack'
+    stack_directory.mkdir(parents=True)
+    for layer in range(layers):
+        shutil.copyfile(TEST_SINGLE_IMAGE_DIR / 'test_image.png',
+                        stack_directory / f'{layer}.png')
+    return stack_directory
+
+
+def read_outputs(directory):
+    return {file.name: file.read_bytes() for file in sorted(directory.glob('*.bmp'))}
+
+
+def start_worker(job_directory, worker_id):
+    return subprocess.Popen([sys.executable, 'binder_jet_distributed.py', 'work',
+                             str(job_directory), '--worker-id', worker_id,
+                             '--heartbeat-interval', '0.1', '--stale-after', '5',
+                             '--poll-interval', '0.05'])
+
+
+class TestJobFolder:
+
+    def test_create_batches(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 7)
+        assert create_job(tmp_path / 'job', stack_directory, 3,
+                          new_file_extension='.bmp', swath=SwathLayout(2, 20)) == 3
+        assert sorted(os.listdir(tmp_path / 'job' / PENDING_DIRECTORY)) == \
+            ['batch_000000_000003', 'batch_000003_000006', 'batch_000006_000007']
+        job = load_job(tmp_path / 'job')
+        assert job['path'].resolve() == stack_directory.resolve()
+        assert job['layers'] == 7
+        assert job['settings']['swath'] == SwathLayout(2, 20)
+
+    @pytest.mark.parametrize('settings', [{'output_format': 'tar'}, {'incremental': True},
+                                          {'resume': True}, {'copies': 0}])
+    def test_invalid_settings(self, tmp_path, settings):
+        stack_directory = make_stack(tmp_path, 2)
+        with pytest.raises(ValueError):
+            create_job(tmp_path / 'job', stack_directory, **settings)
+
+    def test_job_not_replaced(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 2)
+        create_job(tmp_path / 'job', stack_directory)
+        with pytest.raises(ValueError):
+            create_job(tmp_path / 'job', stack_directory)
+
+    def test_claimed_once(self, tmp_path):
+        create_job(tmp_path / 'job', make_stack(tmp_path, 4), 2)
+        assert claim_batch(tmp_path / 'job', 'first') == 'batch_000000_000002'
+        assert claim_batch(tmp_path / 'job', 'second') == 'batch_000002_000004'
+        assert claim_batch(tmp_path / 'job', 'third') is None
+        assert sorted(os.listdir(tmp_path / 'job' / CLAIMED_DIRECTORY)) == \
+            ['batch_000000_000002.first', 'batch_000002_000004.second']
+
+    def test_changed_stack_rejected(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 3)
+        create_job(tmp_path / 'job', stack_directory)
+        (stack_directory / '2.png').unlink()
+        with pytest.raises(ValueError):
+            run_worker(tmp_path / 'job', 'worker', 0.1, 1)
+
+
+class TestWorkers:
+
+    def test_workers_match_single_conversion(self, tmp_path):
+        settings = {'new_file_name_format': 'Layer', 'new_file_extension': '.bmp',
+                    'bit_depth': 1, 'copies': 2}
+        expected_stack = make_stack(tmp_path / 'single', 9)
+        StackConvertor(expected_stack, **settings).convert_image_stack()
+        expected = read_outputs(tmp_path / 'single' / 'part' / 'output')
+
+        stack_directory = make_stack(tmp_path, 9)
+        create_job(tmp_path / 'job', stack_directory, 2, **settings)
+        workers = [start_worker(tmp_path / 'job', f'worker{number}') for number in range(3)]
+        assert [worker.wait(timeout=60) for worker in workers] == [0, 0, 0]
+
+        assert read_outputs(tmp_path / 'part' / 'output') == expected
+        status = finish_job(tmp_path / 'job')
+        assert (status['pending'], status['claimed'], status['done']) == (0, 0, 5)
+        assert status['errors'] == {}
+
+    def test_dead_worker_claim_reclaimed(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 4)
+        create_job(tmp_path / 'job', stack_directory, 2, new_file_name_format='Layer',
+                   new_file_extension='.bmp')
+        # A worker that claimed a batch and then died
+        claim_batch(tmp_path / 'job', 'dead')
+
+        assert run_worker(tmp_path / 'job', 'worker', heartbeat_interval=0.05,
+                          stale_after=0.2, poll_interval=0.05) == 2
+        assert sorted(os.listdir(tmp_path / 'job' / DONE_DIRECTORY)) == \
+            ['batch_000000_000002', 'batch_000002_000004']
+        assert os.listdir(tmp_path / 'job' / CLAIMED_DIRECTORY) == []
+        assert list(read_outputs(tmp_path / 'part' / 'output')) == \
+            [f'Layer_0000{layer}.bmp' for layer in range(1, 5)]
+
+    def test_heartbeat_keeps_claim(self, tmp_path):
+        create_job(tmp_path / 'job', make_stack(tmp_path, 2))
+        claim_batch(tmp_path / 'job', 'alive')
+        claim_path = tmp_path / 'job' / CLAIMED_DIRECTORY / 'batch_000000_000002.alive'
+        claim_signatures = {}
+        with ClaimHeartbeat(claim_path, 0.02):
+            for _ in range(10):
+                assert reclaim_stale_claims(tmp_path / 'job', claim_signatures, 0.15) == []
+                time.sleep(0.05)
+
+        time.sleep(0.2)
+        reclaim_stale_claims(tmp_path / 'job', claim_signatures, 0.15)
+        time.sleep(0.2)
+        assert reclaim_stale_claims(tmp_path / 'job', claim_signatures, 0.15) == \
+            ['batch_000000_000002']
+
+    def test_lost_claim_stops_heartbeat(self, tmp_path):
+        cancel_event = threading.Event()
+        with ClaimHeartbeat(tmp_path / 'missing', 0.02, cancel_event) as heartbeat:
+            time.sleep(0.1)
+            assert heartbeat.lost
+            assert heartbeat.is_set()
+        assert not cancel_event.is_set()
+
+    def test_lost_claim_not_saved(self, tmp_path):
+        create_job(tmp_path / 'job', make_stack(tmp_path, 2), new_file_extension='.bmp')
+        batch = claim_batch(tmp_path / 'job', 'slow')
+        # Another worker reclaims the batch while this one converts it
+        os.rename(tmp_path / 'job' / CLAIMED_DIRECTORY / f'{batch}.slow',
+                  tmp_path / 'job' / PENDING_DIRECTORY / batch)
+        assert not convert_batch(tmp_path / 'job', batch, 'slow',
+                                 load_stack_convertor(tmp_path / 'job'), 0.01)
+        assert os.listdir(tmp_path / 'job' / RESULTS_DIRECTORY) == []
+        assert os.listdir(tmp_path / 'job' / DONE_DIRECTORY) == []
+        assert get_job_status(tmp_path / 'job')['pending'] == 1
+
+    def test_failed_layers_reported(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 3)
+        (stack_directory / '1.png').write_bytes(b'not an image')
+        create_job(tmp_path / 'job', stack_directory, 2, new_file_name_format='Layer',
+                   new_file_extension='.bmp', workers=2)
+        run_worker(tmp_path / 'job', 'worker', 0.05, 1, 0.05)
+        assert list(get_job_status(tmp_path / 'job')['errors']) == [2]
+
+    def test_cancelled_worker_returns_claim(self, tmp_path):
+        create_job(tmp_path / 'job', make_stack(tmp_path, 2))
+        cancel_event = threading.Event()
+        cancel_event.set()
+        assert run_worker(tmp_path / 'job', 'worker', cancel_event=cancel_event) == 0
+        assert get_job_status(tmp_path / 'job')['pending'] == 1
+
+    def test_statistics_of_whole_stack(self, tmp_path):
+        stack_directory = make_stack(tmp_path, 5)
+        create_job(tmp_path / 'job', stack_directory, 2, new_file_extension='.bmp',
+                   bit_depth=1, statistics_path=tmp_path / 'ink.json')
+        with pytest.raises(ValueError):
+            finish_job(tmp_path / 'job')
+
+        run_worker(tmp_path / 'job', 'worker', 0.05, 1, 0.05)
+        finish_job(tmp_path / 'job')
+        statistics = json.loads((tmp_path / 'ink.json').read_text())
+        assert [row['layer'] for row in statistics['layers']] == [1, 2, 3, 4, 5]
+
+
+class TestCommandLine:
+
+    def test_create_work_and_finish(self, tmp_path, capsys):
+        stack_directory = make_stack(tmp_path, 3)
+        job_directory = tmp_path / 'job'
+        assert main(['create', str(job_directory), '--batch-size', '2',
+                     str(stack_directory), '--extension', '.bmp']) == 0
+        assert '2 batches' in capsys.readouterr().out
+        assert main(['work', str(job_directory), '--poll-interval', '0.05']) == 0
+        assert main(['finish', str(job_directory)]) == 0
+        assert len(list((tmp_path / 'part' / 'output').glob('*.bmp'))) == 3
+
+    def test_status_of_missing_job(self, tmp_path, capsys):
+        assert main(['status', str(tmp_path)]) == 1
+        assert 'does not hold a job' in capsys.readouterr().err
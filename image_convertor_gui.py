@@ -3,11 +3,160 @@
 GUI and controller for the binder jet convertor program
 """
 
+import threading
+import time
 from pathlib import Path
-from PyQt6.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget, QLabel, QLineEdit, QPushButton, QFileDialog, QHBoxLayout, QRadioButton, QButtonGroup, QListWidget, QListWidgetItem, QScrollArea
-from PyQt6.QtGui import QIntValidator, QPixmap
-from PyQt6.QtCore import Qt
-from binder_jet_convertor import StackConvertor
+from collections import OrderedDict
+from PyQt6.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget, QLabel, QLineEdit, QPushButton, QFileDialog, QHBoxLayout, QRadioButton, QButtonGroup, QListView, QProgressBar
+from PyQt6.QtGui import QImage, QIntValidator, QPixmap
+from PyQt6.QtCore import Qt, QAbstractListModel, QObject, QRunnable, QSize, QThread, QThreadPool, pyqtSignal
+from binder_jet_convertor import LAYER_ERRORS, StackConvertor, StackIndex, SwathLayout
+from thumbnail_cache import ThumbnailCache
+
+THUMBNAIL_SIZE = (100, 200)
+
+# Swath width and overlap in pixels filled in by the Xaar XPM preset, a
+# Xaar 1003 head has 1000 nozzles across its swath
+XAAR_SWATH = (1000, 0)
+
+# TIFF strip height in rows filled in by the Meteor HDC preset
+METEOR_ROWS_PER_STRIP = 256
+
+
+class ThumbnailSignals(QObject):
+    """
+    Carries decoded thumbnails from the loader threads back to the model
+    """
+    loaded = pyqtSignal(int, int, QImage)
+
+
+class ThumbnailLoader(QRunnable):
+    """
+    Decodes one thumbnail on a thread pool thread
+    """
+
+    def __init__(self, cache: ThumbnailCache, path: Path, generation: int,
+                 row: int, signals: ThumbnailSignals):
+        super().__init__()
+        self.cache = cache
+        self.path = path
+        self.generation = generation
+        self.row = row
+        self.signals = signals
+
+    def run(self):
+        """
+        Loads the thumbnail and sends it back as a QImage
+        """
+        try:
+            thumbnail = self.cache.load(self.path).convert('RGBA')
+        except OSError:
+            return
+        image = QImage(thumbnail.tobytes(), thumbnail.width, thumbnail.height,
+                       thumbnail.width * 4, QImage.Format.Format_RGBA8888).copy()
+        self.signals.loaded.emit(self.generation, self.row, image)
+
+
+class ThumbnailListModel(QAbstractListModel):
+    """
+    List of the images in a folder, where thumbnails are only decoded when
+    the view asks for an item, on background threads
+    Pixmaps of recently shown items are kept in memory
+    """
+
+    def __init__(self, cache: ThumbnailCache, max_pixmaps: int = 256):
+        super().__init__()
+        self.cache = cache
+        self.max_pixmaps = max_pixmaps
+        self.image_files = []
+        self.pixmaps = OrderedDict()
+        self.pending = set()
+        self.generation = 0
+        self.thread_pool = QThreadPool()
+        self.signals = ThumbnailSignals()
+        self.signals.loaded.connect(self.thumbnail_loaded)
+
+    def set_image_files(self, image_files: list):
+        """
+        Replaces the listed files, ignoring thumbnails still being loaded
+        for the previous folder
+        """
+        self.beginResetModel()
+        self.generation += 1
+        self.image_files = list(image_files)
+        self.pixmaps.clear()
+        self.pending.clear()
+        self.thread_pool.clear()
+        self.endResetModel()
+
+    def rowCount(self, parent=None):
+        if parent is not None and parent.isValid():
+            return 0
+        return len(self.image_files)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.image_files[row].name
+        if role == Qt.ItemDataRole.DecorationRole:
+            if row in self.pixmaps:
+                self.pixmaps.move_to_end(row)
+                return self.pixmaps[row]
+            if row not in self.pending:
+                self.pending.add(row)
+                self.thread_pool.start(ThumbnailLoader(
+                    self.cache, self.image_files[row], self.generation, row,
+                    self.signals))
+        return None
+
+    def thumbnail_loaded(self, generation: int, row: int, image: QImage):
+        """
+        Stores the pixmap of a decoded thumbnail and refreshes its item
+        """
+        if generation != self.generation:
+            return
+        self.pending.discard(row)
+        self.pixmaps[row] = QPixmap.fromImage(image)
+        while len(self.pixmaps) > self.max_pixmaps:
+            self.pixmaps.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DecorationRole])
+
+
+class ConversionWorker(QObject):
+    """
+    Runs a stack conversion on a background thread, reporting progress
+    through signals so the window stays responsive
+    """
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(bool)
+    failed = pyqtSignal(str)
+
+    def __init__(self, stack_converter: StackConvertor):
+        super().__init__()
+        self.stack_converter = stack_converter
+        self.cancel_event = threading.Event()
+
+    def run(self):
+        """
+        Converts the stack, then emits finished with whether it was cancelled
+        """
+        try:
+            self.stack_converter.convert_image_stack(self.progress.emit,
+                                                     self.cancel_event)
+        except (*LAYER_ERRORS, TypeError) as error:
+            self.failed.emit(str(error))
+            return
+        self.finished.emit(self.stack_converter.cancelled)
+
+    def cancel(self):
+        """
+        Asks the conversion to stop after the current layer
+        """
+        self.cancel_event.set()
+
 
 class ImageConverterController:
     """
@@ -16,11 +165,15 @@ class ImageConverterController:
     """
     def __init__(self, view):
         self.view = view
+        self.thread = None
+        self.worker = None
 
     def convert_images(self):
         """
         Passes the variables that are set in the view through to the 
         model function to start converting images
+        The conversion runs on a background thread, and the view is updated
+        through the worker signals
         """
         path = self.view.selected_directory
         rename_file_style = self.view.rename_style
@@ -29,12 +182,40 @@ class ImageConverterController:
         y_dim_resize = self.view.y_dimension_resize
         bit_depth = self.view.bit_depth
         copies = self.view.copies
+        compression = self.view.compression
+        rows_per_strip = self.view.rows_per_strip
+        resample = self.view.resample
+        resize_mode = self.view.resize_mode
+        swath = self.view.swath
 
         stack_converter = StackConvertor(path, new_file_name_format=rename_file_style,
                                          new_file_extension=new_file_extension,
                                          x_dim=x_dim_resize, y_dim=y_dim_resize,
-                                         bit_depth=bit_depth, copies=copies)
-        stack_converter.convert_image_stack()
+                                         bit_depth=bit_depth, copies=copies,
+                                         compression=compression,
+                                         rows_per_strip=rows_per_strip,
+                                         resample=resample,
+                                         resize_mode=resize_mode,
+                                         swath=swath)
+
+        self.thread = QThread()
+        self.worker = ConversionWorker(stack_converter)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.view.update_progress)
+        self.worker.finished.connect(self.view.conversion_finished)
+        self.worker.failed.connect(self.view.conversion_failed)
+        self.worker.finished.connect(self.thread.quit)
+        self.worker.failed.connect(self.thread.quit)
+        self.view.conversion_started(len(stack_converter.stack_index))
+        self.thread.start()
+
+    def cancel_conversion(self):
+        """
+        Stops the running conversion once the current layer is saved
+        """
+        if self.worker is not None:
+            self.worker.cancel()
 
 class ImageConverterView(QMainWindow):
     """
@@ -125,6 +306,40 @@ class ImageConverterView(QMainWindow):
         resize_entry_layout.addWidget(self.x_dim_entry)
         resize_entry_layout.addWidget(self.y_dim_label)
         resize_entry_layout.addWidget(self.y_dim_entry)
+        # Radio buttons for the resize filter and whether the aspect ratio
+        # is kept
+        resample_layout = QHBoxLayout()
+        self.resample_default = QRadioButton('Default Filter')
+        self.resample_nearest = QRadioButton('Nearest')
+        self.resample_box = QRadioButton('Box')
+        self.resample_lanczos = QRadioButton('Lanczos')
+        resample_layout.addWidget(self.resample_default)
+        resample_layout.addWidget(self.resample_nearest)
+        resample_layout.addWidget(self.resample_box)
+        resample_layout.addWidget(self.resample_lanczos)
+        self.resample_default.setChecked(True)
+        self.resample_radio_group = QButtonGroup(self)
+        self.resample_radio_group.addButton(self.resample_default)
+        self.resample_radio_group.addButton(self.resample_nearest)
+        self.resample_radio_group.addButton(self.resample_box)
+        self.resample_radio_group.addButton(self.resample_lanczos)
+        self.process_resample(self.resample_default)  # Run to set default value
+        self.resample_radio_group.buttonClicked.connect(self.process_resample)
+
+        resize_mode_layout = QHBoxLayout()
+        self.resize_stretch = QRadioButton('Stretch')
+        self.resize_fit = QRadioButton('Fit')
+        self.resize_pad = QRadioButton('Fit and Pad')
+        resize_mode_layout.addWidget(self.resize_stretch)
+        resize_mode_layout.addWidget(self.resize_fit)
+        resize_mode_layout.addWidget(self.resize_pad)
+        self.resize_stretch.setChecked(True)
+        self.resize_mode_radio_group = QButtonGroup(self)
+        self.resize_mode_radio_group.addButton(self.resize_stretch)
+        self.resize_mode_radio_group.addButton(self.resize_fit)
+        self.resize_mode_radio_group.addButton(self.resize_pad)
+        self.process_resize_mode(self.resize_stretch)  # Run to set default value
+        self.resize_mode_radio_group.buttonClicked.connect(self.process_resize_mode)
 
         self.bit_depth_label = QLabel('Bit Depth:')
         # Radio buttons for selecting bit depth
@@ -150,6 +365,64 @@ class ImageConverterView(QMainWindow):
         self.process_bit_depth(bit_depth_default)  # Run to set default value
         self.bit_depth_radio_group.buttonClicked.connect(self.process_bit_depth)
 
+        self.compression_label = QLabel('Compression:')
+        # Radio buttons for selecting the printer compression of the output
+        compression_layout = QHBoxLayout()
+        self.compression_none = QRadioButton('None')
+        self.compression_packbits = QRadioButton('PackBits')
+        self.compression_lzw = QRadioButton('LZW')
+        self.compression_group4 = QRadioButton('Group 4')
+        self.compression_rle8 = QRadioButton('RLE8')
+        compression_layout.addWidget(self.compression_none)
+        compression_layout.addWidget(self.compression_packbits)
+        compression_layout.addWidget(self.compression_lzw)
+        compression_layout.addWidget(self.compression_group4)
+        compression_layout.addWidget(self.compression_rle8)
+        self.compression_none.setChecked(True)
+        # Add radio buttons to their button group
+        self.compression_radio_group = QButtonGroup(self)
+        self.compression_radio_group.addButton(self.compression_none)
+        self.compression_radio_group.addButton(self.compression_packbits)
+        self.compression_radio_group.addButton(self.compression_lzw)
+        self.compression_radio_group.addButton(self.compression_group4)
+        self.compression_radio_group.addButton(self.compression_rle8)
+        self.process_compression(self.compression_none)  # Run to set default value
+        self.compression_radio_group.buttonClicked.connect(self.process_compression)
+        # Numerical entry box for the TIFF strip height, left blank to let
+        # Pillow pick it
+        self.rows_per_strip_label = QLabel('TIFF Rows per Strip:')
+        self.rows_per_strip_entry = QLineEdit()
+        self.rows_per_strip_entry.setValidator(QIntValidator())
+        self.rows_per_strip_entry.setPlaceholderText('Auto')
+        compression_layout.addWidget(self.rows_per_strip_label)
+        compression_layout.addWidget(self.rows_per_strip_entry)
+
+        # Numerical entry boxes for splitting each layer into the swath of
+        # each printhead, left blank to save whole layers
+        self.swath_label = QLabel('Printhead Swaths')
+        swath_layout = QHBoxLayout()
+        self.heads_label = QLabel('Heads:')
+        self.heads_entry = QLineEdit()
+        self.heads_entry.setValidator(QIntValidator())
+        self.swath_width_label = QLabel('Swath Width (px):')
+        self.swath_width_entry = QLineEdit()
+        self.swath_width_entry.setValidator(QIntValidator())
+        self.overlap_label = QLabel('Overlap (px):')
+        self.overlap_entry = QLineEdit()
+        self.overlap_entry.setValidator(QIntValidator())
+        self.overlap_entry.setPlaceholderText('0')
+        self.stagger_label = QLabel('Stagger (rows):')
+        self.stagger_entry = QLineEdit()
+        self.stagger_entry.setPlaceholderText('0,0')
+        swath_layout.addWidget(self.heads_label)
+        swath_layout.addWidget(self.heads_entry)
+        swath_layout.addWidget(self.swath_width_label)
+        swath_layout.addWidget(self.swath_width_entry)
+        swath_layout.addWidget(self.overlap_label)
+        swath_layout.addWidget(self.overlap_entry)
+        swath_layout.addWidget(self.stagger_label)
+        swath_layout.addWidget(self.stagger_entry)
+
         # Numerical entry box for setting the number of copies of each image
         copies_layout = QHBoxLayout()
         self.copy_number_label = QLabel('Number of Copies of Each Image:')
@@ -163,6 +436,16 @@ class ImageConverterView(QMainWindow):
         self.convert_button = QPushButton('Convert')
         self.convert_button.clicked.connect(self.process_selections)
 
+        # Progress of the running conversion, with a button to stop it
+        progress_layout = QHBoxLayout()
+        self.progress_bar = QProgressBar()
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_conversion)
+        progress_layout.addWidget(self.progress_bar)
+        progress_layout.addWidget(self.cancel_button)
+        self.progress_label = QLabel('')
+
         layout.addWidget(self.path_label)
         layout.addWidget(directory_button)
         layout.addWidget(self.preset_label)
@@ -174,19 +457,29 @@ class ImageConverterView(QMainWindow):
         layout.addLayout(extension_button_layout)
         layout.addWidget(self.resize_label)
         layout.addLayout(resize_entry_layout)
+        layout.addLayout(resample_layout)
+        layout.addLayout(resize_mode_layout)
         layout.addWidget(self.bit_depth_label)
         layout.addLayout(bit_depth_layout)
+        layout.addWidget(self.compression_label)
+        layout.addLayout(compression_layout)
+        layout.addWidget(self.swath_label)
+        layout.addLayout(swath_layout)
         layout.addLayout(copies_layout)
 
         layout.addWidget(self.convert_button)
+        layout.addLayout(progress_layout)
+        layout.addWidget(self.progress_label)
 
-        # Create a scrollable area for showing the thumbnails of the images
+        # List showing the thumbnails of the images, only the visible
+        # thumbnails are decoded
         thumbnail_layout = QVBoxLayout()
-        scroll_area = QScrollArea(self)
-        scroll_area.setWidgetResizable(True)
-        self.thumbnail_list = QListWidget()
-        scroll_area.setWidget(self.thumbnail_list)
-        thumbnail_layout.addWidget(scroll_area)
+        self.thumbnail_model = ThumbnailListModel(ThumbnailCache(size=THUMBNAIL_SIZE))
+        self.thumbnail_list = QListView()
+        self.thumbnail_list.setUniformItemSizes(True)
+        self.thumbnail_list.setIconSize(QSize(*THUMBNAIL_SIZE))
+        self.thumbnail_list.setModel(self.thumbnail_model)
+        thumbnail_layout.addWidget(self.thumbnail_list)
         self.selected_directory = None
 
         central_layout = QHBoxLayout()
@@ -214,45 +507,56 @@ class ImageConverterView(QMainWindow):
         """
         Updates the list of thumbnails from the selected folder,
         accepts png, bmp, tif, tiff, jpg, and jpeg images
+        The thumbnails are loaded in the background as they are scrolled into
+        view
         """
-        self.thumbnail_list.clear()
-
+        image_files = []
         if self.selected_directory:
-            image_files = list(Path(self.selected_directory).glob('*.png')) + \
-                            list(Path(self.selected_directory).glob('*.bmp')) + \
-                            list(Path(self.selected_directory).glob('*.tif')) + \
-                            list(Path(self.selected_directory).glob('*.tiff')) + \
-                            list(Path(self.selected_directory).glob('*.jpg')) + \
-                            list(Path(self.selected_directory).glob('*.jpeg'))
-
-            for image_file in image_files:
-                pixmap = QPixmap(str(image_file))
-                thumbnail = QLabel(self)
-                thumbnail.setPixmap(pixmap.scaled(100, 200,
-                                                  aspectRatioMode=Qt.AspectRatioMode.KeepAspectRatio))
-
-                # Create a new widget for each thumbnail and add it to the list widget
-                item = QListWidgetItem(self.thumbnail_list)
-                item.setSizeHint(thumbnail.sizeHint())
-                self.thumbnail_list.addItem(item)
-                self.thumbnail_list.setItemWidget(item, thumbnail)
+            image_files = StackIndex(Path(self.selected_directory)).files
+        self.thumbnail_model.set_image_files(image_files)
 
     def load_xaar_presets(self):
         """
         Automatically selects the correct parameters for the Xaar XPM system
+        Fills in the swath width of a head, leaving the number of heads to
+        be entered for the machine
         """
-        self.layer_radio.setChecked(True)
-        self.bmp_radio.setChecked(True)
-        self.bit_depth_8.setChecked(True)
+        self.select_preset_buttons(self.layer_radio, self.bmp_radio, self.bit_depth_8,
+                                   self.compression_none)
+        self.rows_per_strip_entry.clear()
+        swath_width, overlap = XAAR_SWATH
+        self.swath_width_entry.setText(str(swath_width))
+        self.overlap_entry.setText(str(overlap))
 
     def load_meteor_presets(self):
         """
         Automatically selects the correct parameters for the Meteor HDC system
-        Currently picks 1 bit depth.
+        Currently picks 1 bit depth, compressed with CCITT Group 4 in
+        strips of METEOR_ROWS_PER_STRIP rows, saving whole layers
+        """
+        self.select_preset_buttons(self.layer_radio, self.tif_radio, self.bit_depth_1,
+                                   self.compression_group4)
+        self.rows_per_strip_entry.setText(str(METEOR_ROWS_PER_STRIP))
+        for entry in (self.heads_entry, self.swath_width_entry, self.overlap_entry,
+                      self.stagger_entry):
+            entry.clear()
+
+    def select_preset_buttons(self, rename_button: QRadioButton,
+                              extension_button: QRadioButton,
+                              bit_depth_button: QRadioButton,
+                              compression_button: QRadioButton):
+        """
+        Checks the radio buttons picked by a preset and sets the matching
+        variables, as setChecked does not emit buttonClicked
         """
-        self.layer_radio.setChecked(True)
-        self.tif_radio.setChecked(True)
-        self.bit_depth_1.setChecked(True)
+        rename_button.setChecked(True)
+        self.process_file_rename_style(rename_button)
+        extension_button.setChecked(True)
+        self.process_file_extension(extension_button)
+        bit_depth_button.setChecked(True)
+        self.process_bit_depth(bit_depth_button)
+        compression_button.setChecked(True)
+        self.process_compression(compression_button)
 
     def process_selections(self):
         """
@@ -267,7 +571,67 @@ class ImageConverterView(QMainWindow):
         self.x_dimension_resize = self.process_x_dim()
         self.y_dimension_resize = self.process_y_dim()
         self.copies = self.process_copy_entry()
-        self.controller.convert_images()
+        self.rows_per_strip = self.process_rows_per_strip()
+        try:
+            self.swath = self.process_swath()
+            self.controller.convert_images()
+        except (ValueError, FileNotFoundError) as error:
+            self.progress_label.setText(str(error))
+
+    def conversion_started(self, total_layers: int):
+        """
+        Resets the progress display and locks the Convert button while the
+        conversion runs
+        """
+        self.conversion_start_time = time.monotonic()
+        self.progress_bar.setMaximum(max(total_layers, 1))
+        self.progress_bar.setValue(0)
+        self.progress_label.setText(f'Converting {total_layers} layers')
+        self.convert_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+
+    def update_progress(self, layers_done: int, total_layers: int):
+        """
+        Shows the number of layers converted, the throughput and the
+        estimated time remaining
+        """
+        elapsed = time.monotonic() - self.conversion_start_time
+        layers_per_second = layers_done / elapsed if elapsed > 0 else 0
+        if layers_per_second:
+            remaining = (total_layers - layers_done) / layers_per_second
+            eta = time.strftime('%H:%M:%S', time.gmtime(remaining))
+        else:
+            eta = '--:--:--'
+        self.progress_bar.setValue(layers_done)
+        self.progress_label.setText(
+            f'{layers_done}/{total_layers} layers, '
+            f'{layers_per_second:.1f} layers/s, ETA {eta}')
+
+    def conversion_finished(self, cancelled: bool):
+        """
+        Unlocks the Convert button once the conversion has stopped
+        """
+        self.convert_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        elapsed = time.monotonic() - self.conversion_start_time
+        status = 'Cancelled' if cancelled else 'Finished'
+        self.progress_label.setText(f'{status} after {elapsed:.1f} s')
+
+    def conversion_failed(self, message: str):
+        """
+        Shows the error that stopped the conversion
+        """
+        self.convert_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.progress_label.setText(f'Conversion failed: {message}')
+
+    def cancel_conversion(self):
+        """
+        Stops the conversion after the current layer
+        """
+        self.cancel_button.setEnabled(False)
+        self.progress_label.setText('Cancelling after the current layer')
+        self.controller.cancel_conversion()
 
     def process_file_rename_style(self, button: QPushButton):
         """
@@ -329,6 +693,64 @@ class ImageConverterView(QMainWindow):
             return
         self.bit_depth = int(button.text())
 
+    def process_resample(self, button: QPushButton):
+        """
+        Determines what radio button the user has checked, and sets the
+        variable self.resample to the matching resize filter
+        Called when the user changes the radio button selection
+        """
+        filters = {'Default Filter': None, 'Nearest': 'nearest', 'Box': 'box',
+                   'Lanczos': 'lanczos'}
+        self.resample = filters[button.text()]
+
+    def process_resize_mode(self, button: QPushButton):
+        """
+        Determines what radio button the user has checked, and sets the
+        variable self.resize_mode to the matching resize mode
+        Called when the user changes the radio button selection
+        """
+        modes = {'Stretch': 'stretch', 'Fit': 'fit', 'Fit and Pad': 'pad'}
+        self.resize_mode = modes[button.text()]
+
+    def process_compression(self, button: QPushButton):
+        """
+        Determines what radio button the user has checked, and sets the
+        variable self.compression to the matching compression option
+        Called when the user changes the radio button selection
+        """
+        compressions = {'None': None, 'PackBits': 'packbits', 'LZW': 'lzw',
+                        'Group 4': 'group4', 'RLE8': 'rle8'}
+        self.compression = compressions[button.text()]
+
+    def process_rows_per_strip(self) -> int | None:
+        """
+        Gets the user entry for the TIFF strip height from the text entry box
+        Converts the input to an int
+        If empty, passes None
+        """
+        if self.rows_per_strip_entry.text():
+            rows_per_strip = int(self.rows_per_strip_entry.text())
+        else:
+            rows_per_strip = None
+        return rows_per_strip
+
+    def process_swath(self) -> SwathLayout | None:
+        """
+        Gets the user entries for the printhead swaths from the text entry
+        boxes
+        If the number of heads is empty, passes None to save whole layers
+        """
+        if not self.heads_entry.text():
+            return None
+        if not self.swath_width_entry.text():
+            raise ValueError('Enter the swath width of each head')
+        stagger = ()
+        if self.stagger_entry.text():
+            stagger = tuple(int(offset) for offset in self.stagger_entry.text().split(','))
+        return SwathLayout(int(self.heads_entry.text()),
+                           int(self.swath_width_entry.text()),
+                           int(self.overlap_entry.text() or 0), stagger)
+
     def process_copy_entry(self) -> int:
         """
         Gets the user entry for the number of copies from the text entry box
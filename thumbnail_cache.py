@@ -0,0 +1,109 @@
+"""
+Thumbnail cache for previewing image stacks
+"""
+
+
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from PIL import Image
+
+DEFAULT_CACHE_DIRECTORY = Path.home() / '.cache' / 'binder_jet_convertor' / 'thumbnails'
+
+
+class ThumbnailCache:
+    """
+    Reduced resolution previews of layer images
+    Thumbnails are kept in a least recently used memory cache, backed by a
+    folder on disk, both keyed by the file path, modification time and size,
+    so reopening a folder does not decode the images again and a rewritten
+    file gets a new thumbnail
+    Safe to use from several threads at once
+    """
+
+    def __init__(self, cache_directory: Path = DEFAULT_CACHE_DIRECTORY,
+                 max_items: int = 512, size: tuple[int, int] = (100, 200)):
+        self.cache_directory = Path(cache_directory) if cache_directory else None
+        self.max_items = max_items
+        self.size = size
+        self.thumbnails = OrderedDict()
+        self.lock = threading.Lock()
+
+        if not isinstance(max_items, (int)) or max_items <= 0:
+            raise ValueError('Max items must be a positive, non-zero integer')
+
+    def get_cache_key(self, path: Path) -> str:
+        """
+        Returns a key that changes whenever the file is modified
+        """
+        stat = path.stat()
+        key = f'{path.resolve()}|{stat.st_mtime_ns}|{stat.st_size}|{self.size}'
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, path: Path) -> Image.Image | None:
+        """
+        Returns the thumbnail if it is held in memory for the current version
+        of the file, without reading the image or the disk cache
+        """
+        try:
+            key = self.get_cache_key(Path(path))
+        except OSError:
+            return None
+        return self.get_by_key(key)
+
+    def get_by_key(self, key: str) -> Image.Image | None:
+        """
+        Returns the thumbnail held in memory under a cache key
+        """
+        with self.lock:
+            thumbnail = self.thumbnails.get(key)
+            if thumbnail is not None:
+                self.thumbnails.move_to_end(key)
+            return thumbnail
+
+    def load(self, path: Path) -> Image.Image:
+        """
+        Returns the thumbnail of an image, from memory, the disk cache, or by
+        decoding the image at reduced resolution
+        """
+        path = Path(path)
+        key = self.get_cache_key(path)
+        thumbnail = self.get_by_key(key)
+        if thumbnail is not None:
+            return thumbnail
+
+        cache_path = None
+        if self.cache_directory is not None:
+            cache_path = self.cache_directory / (key + '.png')
+
+        if cache_path is not None and cache_path.is_file():
+            with Image.open(cache_path) as cached:
+                thumbnail = cached.copy()
+        else:
+            thumbnail = self.create_thumbnail(path)
+            if cache_path is not None:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                temporary_path = cache_path.with_suffix(f'.{threading.get_ident()}.tmp')
+                thumbnail.save(temporary_path, 'PNG')
+                temporary_path.replace(cache_path)
+
+        with self.lock:
+            self.thumbnails[key] = thumbnail
+            self.thumbnails.move_to_end(key)
+            while len(self.thumbnails) > self.max_items:
+                self.thumbnails.popitem(last=False)
+        return thumbnail
+
+    def create_thumbnail(self, path: Path) -> Image.Image:
+        """
+        Decodes the image at reduced resolution and scales it to fit the
+        thumbnail size
+        JPEG files are decoded at a fraction of their size using draft mode
+        """
+        with Image.open(path) as image:
+            image.draft('RGB', self.size)
+            image.thumbnail(self.size)
+            if image.mode not in ('RGB', 'RGBA'):
+                return image.convert('RGBA' if 'A' in image.mode else 'RGB')
+            return image.copy()
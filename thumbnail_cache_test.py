@@ -0,0 +1,73 @@
+import os
+import shutil
+import pytest
+from pathlib import Path
+from PIL import Image
+from thumbnail_cache import ThumbnailCache
+
+TEST_IMAGES_DIR = Path('test_image_directory')
+
+
+class TestThumbnailCache:
+
+    def test_thumbnail_fits_size(self, tmp_path):
+        cache = ThumbnailCache(tmp_path / 'cache', size=(50, 60))
+        thumbnail = cache.load(TEST_IMAGES_DIR / 'test_image.jpg')
+        assert thumbnail.width <= 50
+        assert thumbnail.height <= 60
+        assert thumbnail.mode in ('RGB', 'RGBA')
+
+    def test_memory_hit(self, tmp_path):
+        cache = ThumbnailCache(tmp_path / 'cache')
+        image_path = TEST_IMAGES_DIR / 'test_image.png'
+        assert cache.get(image_path) is None
+        thumbnail = cache.load(image_path)
+        assert cache.get(image_path) is thumbnail
+
+    def test_disk_cache_reused(self, tmp_path):
+        image_path = tmp_path / 'layer.png'
+        shutil.copyfile(TEST_IMAGES_DIR / 'test_image.png', image_path)
+        ThumbnailCache(tmp_path / 'cache').load(image_path)
+        assert len(list((tmp_path / 'cache').iterdir())) == 1
+
+        cache = ThumbnailCache(tmp_path / 'cache')
+        cache.create_thumbnail = None
+        assert cache.load(image_path).size == \
+            ThumbnailCache(None).load(image_path).size
+
+    def test_modified_file_invalidates(self, tmp_path):
+        image_path = tmp_path / 'layer.png'
+        shutil.copyfile(TEST_IMAGES_DIR / 'test_image.png', image_path)
+        cache = ThumbnailCache(tmp_path / 'cache')
+        old_key = cache.get_cache_key(image_path)
+
+        Image.new('L', (8, 8)).save(image_path)
+        os.utime(image_path, ns=(0, 0))
+        assert cache.get_cache_key(image_path) != old_key
+
+    def test_rewritten_file_reloaded_from_memory(self, tmp_path):
+        image_path = tmp_path / 'layer.png'
+        Image.new('RGB', (8, 8), 'red').save(image_path)
+        cache = ThumbnailCache(None)
+        assert cache.load(image_path).getpixel((0, 0)) == (255, 0, 0)
+
+        Image.new('RGB', (8, 8), 'blue').save(image_path)
+        os.utime(image_path, ns=(0, 0))
+        assert cache.get(image_path) is None
+        assert cache.load(image_path).getpixel((0, 0)) == (0, 0, 255)
+
+    def test_least_recently_used_evicted(self, tmp_path):
+        cache = ThumbnailCache(None, max_items=2)
+        first, second, third = (TEST_IMAGES_DIR / name for name in
+                                ('test_image.jpg', 'test_image.jpeg',
+                                 'test_image.png'))
+        cache.load(first)
+        cache.load(second)
+        cache.get(first)
+        cache.load(third)
+        assert cache.get(first) is not None
+        assert cache.get(second) is None
+
+    def test_invalid_max_items(self):
+        with pytest.raises(ValueError):
+            ThumbnailCache(None, max_items=0)